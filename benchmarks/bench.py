@@ -0,0 +1,407 @@
+# Copyright 2021 RelationalAI, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+"""Benchmarks of the SDK overhead on the transaction hot paths.
+
+Each benchmark runs against a `railib.mock.MockServer` in its own process,
+and is itself run in a fresh process, so that its CPU time and peak memory
+only account for the SDK. For each benchmark, it reports the calls per
+second, the latency percentiles of the calls, the CPU time per call, the
+peak resident memory of the process, and the number of HTTP requests per
+call. The `import` benchmarks measure the time to import railib modules
+in a fresh interpreter, on top of the interpreter's own startup time, and
+the heavy dependencies they import eagerly. To
+compare a run against the baseline committed in `benchmarks/baseline.json`:
+
+    python3 benchmarks/bench.py run --output current.json
+    python3 benchmarks/bench.py compare current.json
+
+`compare` exits with status 1 when a metric regressed by more than the
+given threshold, an import takes longer than its budget, or imports a
+dependency that should be imported on first use. To compare against another baseline, pass `--baseline`,
+and to update the committed baseline, run the benchmarks with
+`--output benchmarks/baseline.json` on the reference machine.
+"""
+
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+import railib
+from railib import __version__, api, rest
+from railib.mock import MockServer
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+# the committed baseline results
+_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+_UNITS = {"KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+
+# modules whose import time is measured, and the median import time in
+# milliseconds above which `compare` reports a regression, whatever the
+# baseline
+_IMPORTS = {"railib.api": 100, "railib.aio": 150}
+
+# modules that importing railib must not import, they are imported on
+# first use
+_LAZY_MODULES = ["pyarrow", "google.protobuf", "requests_toolbelt"]
+
+# metrics compared by `compare`, and whether higher values are better
+_METRICS = [
+    ("calls_per_sec", True),
+    ("latency_ms.p50", False),
+    ("latency_ms.p90", False),
+    ("latency_ms.p99", False),
+    ("cpu_ms_per_call", False),
+    ("peak_rss_mb", False),
+    ("requests_per_call", False),
+]
+
+
+# Counts the requests sent with a context.
+class _CountingTransport(rest.ConnectionPool):
+    count = 0
+
+    def urlopen(self, req, timeout=None):
+        self.count += 1
+        return super().urlopen(req, timeout)
+
+
+# A benchmark, `run(ctx, state)` is the benchmarked call, where state is
+# the result of `setup(ctx)`, and `server` the settings of the mock server.
+class Benchmark(object):
+    def __init__(self, name: str, run, server: dict = None, iterations: int = 100, setup=None):
+        self.name = name
+        self.run = run
+        self.server = server or {}
+        self.iterations = iterations
+        self.setup = setup
+
+
+def _parse_size(size: str) -> int:
+    size = size.strip().upper()
+    for unit, n in _UNITS.items():
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * n)
+    return int(size)
+
+
+def _exec(ctx, state):
+    api.exec(ctx, "db", "e", "def output = 1")
+
+
+def _exec_async(ctx, state):
+    api.exec_async(ctx, "db", "e", "def output = 1")
+
+
+def _transaction(ctx):
+    return api.exec_async(ctx, "db", "e", "def output = 1").transaction["id"]
+
+
+def _get_transaction_results(ctx, id):
+    results = api.get_transaction_results(ctx, id)
+    for result in results:
+        result["table"]  # decode
+
+
+def _csv(size: int) -> str:
+    line = "1,2.0,three\n"
+    return "a,b,c\n" + line * (size // len(line))
+
+
+def _load_csv(ctx, data):
+    api.load_csv(ctx, "db", "e", "data", data)
+
+
+# Returns the benchmarks, with results and CSV data of the given sizes.
+def benchmarks(sizes, csv_size: int, duration: float) -> list:
+    result = [
+        Benchmark("exec", _exec, iterations=200),
+        Benchmark("exec_async", _exec_async, iterations=500),
+    ]
+    for size in sizes:
+        rows = max(1, _parse_size(size) // 8)  # one Int64 column
+        iterations = max(2, min(200, 640 * 1024 ** 2 // (rows * 8)))
+        result.append(Benchmark(
+            f"get_transaction_results[{size}]", _get_transaction_results,
+            server={"rows": rows}, iterations=iterations, setup=_transaction,
+        ))
+    result.append(Benchmark(
+        f"load_csv[{csv_size}]", _load_csv, iterations=50,
+        setup=lambda ctx: _csv(_parse_size(csv_size)),
+    ))
+    for long_poll in (False, True):
+        name = "long_polling" if long_poll else "polling"
+        result.append(Benchmark(
+            f"{name}[{duration}s]", _exec, iterations=5,
+            server={"duration": duration, "long_poll": long_poll},
+            setup=(lambda ctx: setattr(ctx, "server_wait", 30)) if long_poll else None,
+        ))
+    return result
+
+
+def _serve(settings: dict, conn):
+    server = MockServer(**settings)
+    server.start()
+    conn.send(server.port)
+    conn.recv()
+    server.stop()
+
+
+def _percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _peak_rss_mb() -> float:
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return rss / (1024 ** 2 if sys.platform == "darwin" else 1024)
+
+
+def _measure(args: dict, index: int, port: int, conn):
+    benchmark = benchmarks(**args)[index]
+    transport = _CountingTransport()
+    ctx = api.Context(host="127.0.0.1", port=str(port), scheme="http", transport=transport)
+    state = benchmark.setup(ctx) if benchmark.setup is not None else None
+    iterations = benchmark.iterations
+    benchmark.run(ctx, state)  # warm up
+    transport.count = 0
+    latencies = []
+    cpu_time = time.process_time()
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        t = time.perf_counter()
+        benchmark.run(ctx, state)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start_time
+    cpu_time = time.process_time() - cpu_time
+    conn.send({
+        "calls": iterations,
+        "calls_per_sec": iterations / elapsed,
+        "latency_ms": {
+            "p50": _percentile(latencies, 0.5) * 1000,
+            "p90": _percentile(latencies, 0.9) * 1000,
+            "p99": _percentile(latencies, 0.99) * 1000,
+        },
+        "cpu_ms_per_call": cpu_time / iterations * 1000,
+        "peak_rss_mb": _peak_rss_mb(),
+        "requests_per_call": transport.count / iterations,
+    })
+
+
+# Runs the given benchmark with its own server and client processes, and
+# returns its metrics.
+def _run_benchmark(mp, args: dict, index: int, benchmark: Benchmark) -> dict:
+    server_conn, conn = mp.Pipe()
+    server = mp.Process(target=_serve, args=(benchmark.server, conn), daemon=True)
+    server.start()
+    try:
+        port = server_conn.recv()
+        client_conn, conn = mp.Pipe()
+        client = mp.Process(target=_measure, args=(args, index, port, conn))
+        client.start()
+        client.join()
+        if client.exitcode != 0:
+            raise Exception(f"benchmark {benchmark.name} failed")
+        return client_conn.recv()
+    finally:
+        server_conn.send(None)
+        server.join()
+
+
+def _print_metrics(name: str, metrics: dict):
+    latency = metrics["latency_ms"]
+    print(
+        f"{name:36} {metrics['calls_per_sec'] or 0:10.1f} calls/s"
+        f"  p50 {latency['p50']:9.2f} ms  p99 {latency['p99']:9.2f} ms"
+        f"  cpu {metrics['cpu_ms_per_call']:8.2f} ms/call"
+        f"  rss {metrics['peak_rss_mb'] or 0:8.1f} MB"
+        f"  {metrics['requests_per_call']:5.1f} req/call"
+    )
+
+
+def run(args: dict, names: list = None, output: str = None):
+    mp = multiprocessing.get_context("spawn")
+    results = {}
+    for i, benchmark in enumerate(benchmarks(**args)):
+        if names and not any(benchmark.name.startswith(name) for name in names):
+            continue
+        metrics = _run_benchmark(mp, args, i, benchmark)
+        results[benchmark.name] = metrics
+        _print_metrics(benchmark.name, metrics)
+    for module in _IMPORTS:
+        name = f"import[{module}]"
+        if names and not any(name.startswith(prefix) for prefix in names):
+            continue
+        results[name] = _measure_import(module)
+        _print_metrics(name, results[name])
+        if results[name]["eager_modules"]:
+            print(f"{name}: imports {', '.join(results[name]['eager_modules'])}")
+    report = {
+        "sdk_version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created_on": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "benchmarks": results,
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+def _child_cpu_time() -> float:
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+# Runs the given code in a new interpreter, with the railib package being
+# benchmarked, and returns its wall clock and CPU times.
+def _run_python(code: str, root: str) -> tuple:
+    cpu_time = _child_cpu_time()
+    start_time = time.perf_counter()
+    # the working directory comes first in the path of `python -c`
+    subprocess.run([sys.executable, "-c", code], env=_python_env(root), cwd=root, check=True)
+    return time.perf_counter() - start_time, _child_cpu_time() - cpu_time
+
+
+# Returns the environment of the interpreters run by the import benchmarks,
+# which write bytecode, so that imports after the first don't compile.
+def _python_env(root: str) -> dict:
+    env = dict(os.environ, PYTHONPATH=root)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    return env
+
+
+# Returns the modules of `_LAZY_MODULES` imported by importing the given
+# module in a new interpreter.
+def _eager_modules(module: str, root: str) -> list:
+    code = f"import json, sys, {module}; print(json.dumps(sorted(sys.modules)))"
+    result = subprocess.run(
+        [sys.executable, "-c", code], env=_python_env(root), cwd=root, check=True, capture_output=True
+    )
+    modules = json.loads(result.stdout)
+    return [name for name in _LAZY_MODULES if name in modules]
+
+
+# Returns the metrics of importing the given module, without the startup
+# time of the interpreter.
+def _measure_import(module: str, iterations: int = 20) -> dict:
+    root = os.path.dirname(os.path.dirname(os.path.abspath(railib.__file__)))
+    _run_python(f"import {module}", root)  # warm up
+    latencies, cpu_time = [], 0
+    for _ in range(iterations):
+        startup, startup_cpu = _run_python("pass", root)
+        elapsed, cpu = _run_python(f"import {module}", root)
+        latencies.append(max(0, elapsed - startup))
+        cpu_time += max(0, cpu - startup_cpu)
+    return {
+        "calls": iterations,
+        "calls_per_sec": iterations / sum(latencies) if sum(latencies) else None,
+        "latency_ms": {
+            "p50": _percentile(latencies, 0.5) * 1000,
+            "p90": _percentile(latencies, 0.9) * 1000,
+            "p99": _percentile(latencies, 0.99) * 1000,
+        },
+        "cpu_ms_per_call": cpu_time / iterations * 1000,
+        "peak_rss_mb": None,
+        "requests_per_call": 0,
+        "eager_modules": _eager_modules(module, root),
+    }
+
+
+def _metric(metrics: dict, name: str) -> float:
+    for key in name.split("."):
+        metrics = metrics[key]
+    return metrics
+
+
+# Prints the change of each metric between the two reports, and returns
+# the number of metrics that regressed by more than `threshold`, plus the
+# imports over their budget or importing heavy dependencies.
+def compare(baseline: str, current: str, threshold: float) -> int:
+    with open(baseline) as f:
+        baseline = json.load(f)
+    with open(current) as f:
+        current = json.load(f)
+    regressions = 0
+    for module, budget in _IMPORTS.items():
+        metrics = current["benchmarks"].get(f"import[{module}]")
+        if metrics is None:
+            continue
+        if metrics["latency_ms"]["p50"] > budget:
+            regressions += 1
+            print(f"import[{module}]: {metrics['latency_ms']['p50']:.2f} ms over the budget of {budget} ms")
+        if metrics.get("eager_modules"):
+            regressions += 1
+            print(f"import[{module}]: imports {', '.join(metrics['eager_modules'])} eagerly")
+    for name, metrics in current["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if base is None:
+            print(f"{name}: not in baseline")
+            continue
+        for metric, higher_is_better in _METRICS:
+            old, new = _metric(base, metric), _metric(metrics, metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            regressed = -change > threshold if higher_is_better else change > threshold
+            regressions += regressed
+            flag = "REGRESSION" if regressed else ""
+            print(f"{name:36} {metric:18} {old:12.2f} {new:12.2f} {change:+8.1%} {flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    p = ArgumentParser(description="SDK overhead benchmarks")
+    commands = p.add_subparsers(dest="command", required=True)
+    r = commands.add_parser("run", help="run the benchmarks")
+    r.add_argument("names", nargs="*", help="only run the benchmarks with these prefixes")
+    r.add_argument(
+        "--sizes", type=str, default="1KB,1MB,64MB",
+        help="results sizes (default: 1KB,1MB,64MB, up to eg 1GB)",
+    )
+    r.add_argument("--csv-size", type=str, default="1MB", help="CSV data size (default: 1MB)")
+    r.add_argument(
+        "--duration", type=float, default=0.5, help="transaction duration of the polling benchmarks (default: 0.5)"
+    )
+    r.add_argument("-o", "--output", type=str, help="write the results to this JSON file")
+    c = commands.add_parser("compare", help="compare results with a baseline")
+    c.add_argument("current", type=str, help="current results JSON file")
+    c.add_argument(
+        "--baseline", type=str, default=_BASELINE,
+        help="baseline results JSON file (default: benchmarks/baseline.json)",
+    )
+    c.add_argument(
+        "--threshold", type=float, default=0.1, help="regression threshold (default: 0.1, ie 10%%)"
+    )
+    args = p.parse_args()
+    if args.command == "run":
+        sizes = [size for size in args.sizes.split(",") if size]
+        run({"sizes": sizes, "csv_size": args.csv_size, "duration": args.duration}, args.names, args.output)
+    else:
+        sys.exit(1 if compare(args.baseline, args.current, args.threshold) else 0)
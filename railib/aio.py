@@ -0,0 +1,675 @@
+# Copyright 2021 RelationalAI, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Asyncio interface to the RelationalAI REST API.
+
+Mirrors `railib.api`, with each operation available as a coroutine that
+runs on a non-blocking HTTP/1.1 transport, eg:
+
+    ctx = aio.Context(**config.read())
+    rsp = await aio.exec(ctx, database, engine, "def output = 1")
+"""
+
+import asyncio
+import http.client
+import io
+import ssl
+import time
+from collections import deque
+from email.parser import Parser
+from typing import Dict, List
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+
+from . import api, rest
+from .api import (
+    PATH_DATABASE,
+    PATH_ENGINE,
+    PATH_TRANSACTION,
+    PATH_TRANSACTIONS,
+    Mode,
+    Transaction,
+    TransactionAsync,
+    TransactionAsyncResponse,
+    _mkurl,
+)
+from .credentials import ClientCredentials
+
+__all__ = [
+    "Context",
+    "cancel_transaction",
+    "create_database",
+    "create_engine",
+    "create_engine_wait",
+    "delete_database",
+    "delete_engine",
+    "exec",
+    "exec_async",
+    "get_database",
+    "get_engine",
+    "get_transaction",
+    "get_transaction_metadata",
+    "get_transaction_problems",
+    "get_transaction_query",
+    "get_transaction_results",
+    "list_databases",
+    "list_engines",
+    "list_transactions",
+    "load_csv",
+    "load_json",
+    "resume_engine",
+    "resume_engine_wait",
+    "suspend_engine",
+]
+
+logger = rest.logger
+
+
+# A response whose body has been fully read from the connection.
+class Response(object):
+    def __init__(self, method: str, url: str, status: int, reason: str, headers, content: bytes):
+        self._method = method
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.version = 11
+        self.content = content
+
+    def read(self) -> bytes:
+        return self.content
+
+
+# A pool of keep-alive connections, keyed by event loop and
+# (scheme, host, port). Connections can only be used from the event loop
+# that opened them.
+class ConnectionPool(object):
+    def __init__(self, maxsize: int = 10, idle_timeout: float = 60):
+        if maxsize < 0:
+            raise ValueError("maxsize must be a non-negative integer")
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._ssl_context = None
+
+    async def _connect(self, key: tuple):
+        _, scheme, host, port = key
+        ssl_context = None
+        if scheme == "https":
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            ssl_context = self._ssl_context
+        return await asyncio.open_connection(host, port, ssl=ssl_context)
+
+    # Returns an idle connection for the given key, or a new one if there
+    # is none, along with a flag indicating if the connection is reused.
+    async def _get(self, key: tuple):
+        now = time.monotonic()
+        idle = self._idle.get(key)
+        while idle:
+            reader, writer, last_used = idle.pop()
+            if now - last_used < self.idle_timeout and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await self._connect(key)
+        return reader, writer, False
+
+    def _put(self, key: tuple, reader, writer):
+        idle = self._idle.setdefault(key, deque())
+        if len(idle) < self.maxsize:
+            idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+
+    # Closes all idle connections.
+    def clear(self):
+        idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for _, writer, _ in conns:
+                writer.close()
+
+    # Issues the given request on a pooled connection, raising `HTTPError`
+    # on error status codes and `URLError` on connection failures.
+    async def urlopen(self, method: str, url: str, headers: dict, data: bytes = None) -> Response:
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (asyncio.get_running_loop(), scheme, parts.hostname, port)
+        target = parts.path or "/"
+        if parts.query:
+            target = f"{target}?{parts.query}"
+        request = _format_request(method, target, headers, data)
+
+        writer = None
+        try:
+            reader, writer, reused = await self._get(key)
+            try:
+                rsp, keep_alive = await _send(reader, writer, method, url, request)
+            except ConnectionError:
+                if not reused:
+                    raise
+                # the server closed the idle connection, retry on a new one
+                writer.close()
+                writer = None
+                reader, writer = await self._connect(key)
+                rsp, keep_alive = await _send(reader, writer, method, url, request)
+        except BaseException as e:
+            if writer is not None:
+                writer.close()
+            if isinstance(e, OSError) and not isinstance(e, ConnectionError):
+                raise URLError(e)
+            raise
+
+        if keep_alive:
+            self._put(key, reader, writer)
+        else:
+            writer.close()
+
+        if rsp.status >= 400:
+            raise HTTPError(url, rsp.status, rsp.reason, rsp.headers, io.BytesIO(rsp.content))
+        return rsp
+
+
+def _format_request(method: str, target: str, headers: dict, data: bytes = None) -> bytes:
+    lines = [f"{method} {target} HTTP/1.1"]
+    lines += [f"{k}: {v}" for k, v in headers.items()]
+    if data is not None or method in ("POST", "PUT", "PATCH"):
+        lines.append(f"Content-Length: {len(data or b'')}")
+    head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+    return head + data if data else head
+
+
+# Writes the given request and reads the response, returning the response
+# along with a flag indicating if the connection can be reused.
+async def _send(reader, writer, method: str, url: str, request: bytes):
+    writer.write(request)
+    await writer.drain()
+
+    line = await reader.readline()
+    if not line:
+        raise http.client.RemoteDisconnected("remote end closed connection without response")
+    version, status, reason = (line.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+    status = int(status)
+
+    head = []
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        head.append(line.decode("latin-1"))
+    headers = Parser(_class=http.client.HTTPMessage).parsestr("".join(head))
+
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.0":
+        keep_alive = connection == "keep-alive"
+    else:
+        keep_alive = connection != "close"
+
+    if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+        content = b""
+    elif headers.get("transfer-encoding", "").lower() == "chunked":
+        content = await _read_chunked(reader)
+    elif headers.get("content-length") is not None:
+        content = await reader.readexactly(int(headers["content-length"]))
+    else:
+        content = await reader.read()
+        keep_alive = False
+
+    return Response(method, url, status, reason, headers, content), keep_alive
+
+
+async def _read_chunked(reader) -> bytes:
+    chunks = []
+    while True:
+        line = await reader.readline()
+        size = int(line.split(b";", 1)[0].strip(), 16)
+        if size == 0:
+            break
+        chunks.append(await reader.readexactly(size))
+        await reader.readexactly(2)
+    # skip trailers
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+    return b"".join(chunks)
+
+
+# Context contains the state required to make asynchronous rAI API calls.
+class Context(api.Context):
+    def __init__(self, *args, aio_pool: ConnectionPool = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.aio_pool = aio_pool if aio_pool is not None else ConnectionPool()
+
+    def close(self):
+        super().close()
+        self.aio_pool.clear()
+
+
+# Authenticate the request by adding an access token to the given headers.
+async def _authenticate(ctx: Context, url: str, headers: dict):
+    creds = ctx.credentials
+    if creds is None:
+        return
+    if isinstance(creds, ClientCredentials):
+        token = rest._get_access_token(ctx, url, block=False)
+        if token is None:
+            # tokens are rarely requested, so the blocking request is run in
+            # the default executor rather than the event loop
+            loop = asyncio.get_running_loop()
+            token = await loop.run_in_executor(None, rest._get_access_token, ctx, url)
+        headers["authorization"] = f"Bearer {token}"
+        return
+    raise Exception("unknown credential type")
+
+
+# Issues a single attempt of an HTTP request, through the context's circuit
+# breaker, if any.
+async def _urlopen(ctx: Context, method: str, url: str, headers: dict, data: bytes):
+    breaker = ctx.circuit_breaker
+    if breaker is None:
+        return await ctx.aio_pool.urlopen(method, url, headers, data)
+    host = urlsplit(url).netloc
+    breaker._admit(host)
+    start_time = time.monotonic()
+    try:
+        rsp = await ctx.aio_pool.urlopen(method, url, headers, data)
+    except BaseException as e:
+        breaker._record(host, rest._is_failure(e), time.monotonic() - start_time)
+        raise
+    breaker._record(host, False, time.monotonic() - start_time)
+    return rsp
+
+
+# Issues an HTTP request and retries failures as decided by the context's
+# retry policy. Each attempt, connecting and reading the response included,
+# is cancelled when the deadline passes.
+async def _urlopen_with_retry(
+    ctx: Context,
+    method: str,
+    url: str,
+    headers: dict,
+    data: bytes,
+    idempotent: bool = None,
+    deadline: float = None,
+):
+    policy = ctx.retry_policy
+    attempts = policy.retries + 1
+    policy._deposit()
+
+    for attempt in range(attempts):
+        try:
+            timeout = rest._socket_timeout(None, deadline)
+        except TimeoutError:
+            raise TimeoutError(f"deadline exceeded before {url} (attempt {attempt + 1}/{attempts})")
+        try:
+            return await asyncio.wait_for(_urlopen(ctx, method, url, headers, data), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"deadline exceeded waiting for {url} (attempt {attempt + 1}/{attempts})")
+        except (URLError, ConnectionError) as e:
+            delay = rest._retry_delay(policy, method, url, e, attempt, attempts, idempotent)
+            if deadline is not None and time.time() + delay >= deadline:
+                raise TimeoutError(f"deadline exceeded before retrying {url}") from e
+            await asyncio.sleep(delay)
+
+
+# Issues an RAI REST API request, and returns the response if successful.
+# As with `rest.request`, the request, including retries, must complete
+# within `timeout` seconds, or by the given `deadline`, otherwise
+# `TimeoutError` is raised, and the other keyword arguments, and the `query`
+# dict, are sent as query parameters.
+async def request(
+    ctx: Context,
+    method: str,
+    url: str,
+    headers={},
+    data=None,
+    timeout: float = None,
+    deadline: float = None,
+    idempotent: bool = None,
+    query: dict = None,
+    **kwargs
+) -> Response:
+    deadline = rest._deadline(timeout, deadline)
+    headers = rest._default_headers(url, dict(headers))
+    url = rest._with_query(url, query, kwargs)
+    data = rest._encode(data, ctx.json_codec)
+    await _authenticate(ctx, url, headers)
+    rsp = await _urlopen_with_retry(ctx, method, url, headers, data, idempotent, deadline)
+    agent = headers.get("User-Agent", "")
+    request_id = rsp.headers.get("X-Request-ID", "")
+    logger.debug(f"{method} HTTP/1.1 {headers.get('Content-Type', '')} {url} {rsp.status} {agent} {request_id}")
+    return rsp
+
+
+async def delete(ctx: Context, url: str, data, headers={}, **kwargs) -> Response:
+    return await request(ctx, "DELETE", url, headers=headers, data=data, **kwargs)
+
+
+async def get(ctx: Context, url: str, headers={}, **kwargs) -> Response:
+    return await request(ctx, "GET", url, headers=headers, **kwargs)
+
+
+async def put(ctx: Context, url: str, data, headers={}, **kwargs) -> Response:
+    return await request(ctx, "PUT", url, headers=headers, data=data, **kwargs)
+
+
+async def post(ctx: Context, url: str, data, headers={}, **kwargs) -> Response:
+    return await request(ctx, "POST", url, headers=headers, data=data, **kwargs)
+
+
+async def patch(ctx: Context, url: str, data, headers={}, **kwargs) -> Response:
+    return await request(ctx, "PATCH", url, headers=headers, data=data, **kwargs)
+
+
+# Retrieve an individual resource.
+async def _get_resource(ctx: Context, path: str, key=None, **kwargs) -> Dict:
+    rsp = await get(ctx, _mkurl(ctx, path), **kwargs)
+    return api._resource(api._decode(ctx, rsp, key))
+
+
+# Retrieve a generic collection of resources.
+async def _get_collection(ctx: Context, path: str, key=None, **kwargs):
+    rsp = await get(ctx, _mkurl(ctx, path), **kwargs)
+    return api._decode(ctx, rsp, key or None)
+
+
+# Asynchronous version of `api.poll_with_specified_overhead`, where `f` is
+# a coroutine function.
+async def poll_with_specified_overhead(
+    f,
+    overhead_rate: float,
+    start_time: float = None,
+    timeout: int = None,
+    max_tries: int = None,
+    max_delay: int = 120,
+):
+    if overhead_rate < 0:
+        raise ValueError("overhead_rate must be non-negative")
+
+    if start_time is None:
+        start_time = time.time()
+
+    tries = 0
+    max_time = time.time() + timeout if timeout is not None else None
+
+    while True:
+        if await f():
+            break
+
+        current_time = time.time()
+
+        if max_tries is not None and tries >= max_tries:
+            raise Exception(f'max tries {max_tries} exhausted')
+
+        if max_time is not None and current_time >= max_time:
+            raise TimeoutError(f'timed out after {timeout} seconds')
+
+        duration = (current_time - start_time) * overhead_rate
+        duration = min(duration, max_delay)
+        if max_time is not None:
+            duration = min(duration, max_time - current_time)
+
+        await asyncio.sleep(duration)
+        tries += 1
+
+
+async def _is_engine_term_state(ctx: Context, engine: str, **kwargs) -> bool:
+    return api.is_engine_term_state((await get_engine(ctx, engine, **kwargs))["state"])
+
+
+async def create_engine(ctx: Context, engine: str, size: str = "XS", **kwargs):
+    data = {"region": ctx.region, "name": engine, "size": size}
+    rsp = await put(ctx, _mkurl(ctx, PATH_ENGINE), data, **kwargs)
+    return api._decode(ctx, rsp)
+
+
+async def create_engine_wait(ctx: Context, engine: str, size: str = "XS", **kwargs):
+    deadline = api._with_deadline(kwargs)
+    await create_engine(ctx, engine, size, **kwargs)
+    await _wait_engine(ctx, engine, deadline)
+    return await get_engine(ctx, engine, deadline=deadline)
+
+
+# Waits for the given engine to reach a terminal state, for at most 30
+# minutes, or until the given deadline.
+async def _wait_engine(ctx: Context, engine: str, deadline: float = None):
+    timeout = 30 * 60
+    if deadline is not None:
+        timeout = min(timeout, deadline - time.time())
+    await poll_with_specified_overhead(
+        lambda: _is_engine_term_state(ctx, engine, deadline=deadline),
+        overhead_rate=0.2,
+        timeout=timeout,
+    )
+
+
+async def suspend_engine(ctx: Context, engine: str, **kwargs):
+    data = {"suspend": True}
+    rsp = await patch(ctx, _mkurl(ctx, f"{PATH_ENGINE}/{engine}"), data, **kwargs)
+    return api._decode(ctx, rsp)
+
+
+async def resume_engine(ctx: Context, engine: str, **kwargs):
+    data = {"suspend": False}
+    rsp = await patch(ctx, _mkurl(ctx, f"{PATH_ENGINE}/{engine}"), data, **kwargs)
+    return api._decode(ctx, rsp)
+
+
+async def resume_engine_wait(ctx: Context, engine: str, **kwargs):
+    deadline = api._with_deadline(kwargs)
+    await resume_engine(ctx, engine, **kwargs)
+    await _wait_engine(ctx, engine, deadline)
+    return await get_engine(ctx, engine, deadline=deadline)
+
+
+async def delete_engine(ctx: Context, engine: str, **kwargs) -> Dict:
+    data = {"name": engine}
+    rsp = await delete(ctx, _mkurl(ctx, PATH_ENGINE), data, **kwargs)
+    return api._decode(ctx, rsp)
+
+
+async def get_engine(ctx: Context, engine: str, **kwargs) -> Dict:
+    return await _get_resource(ctx, PATH_ENGINE, name=engine, deleted_on="", key="computes", **kwargs)
+
+
+async def list_engines(ctx: Context, state=None) -> List:
+    kwargs = {}
+    if state is not None:
+        kwargs["state"] = state
+    return await _get_collection(ctx, PATH_ENGINE, key="computes", **kwargs)
+
+
+async def create_database(ctx: Context, database: str, source: str = None, **kwargs) -> Dict:
+    data = {"name": database, "source_name": source}
+    rsp = await put(ctx, _mkurl(ctx, PATH_DATABASE), data, **kwargs)
+    return api._decode(ctx, rsp)
+
+
+async def delete_database(ctx: Context, database: str, **kwargs) -> Dict:
+    data = {"name": database}
+    rsp = await delete(ctx, _mkurl(ctx, PATH_DATABASE), data, **kwargs)
+    return api._decode(ctx, rsp)
+
+
+async def get_database(ctx: Context, database: str, **kwargs) -> Dict:
+    return await _get_resource(ctx, PATH_DATABASE, name=database, key="databases", **kwargs)
+
+
+async def list_databases(ctx: Context, state=None) -> List:
+    kwargs = {}
+    if state is not None:
+        kwargs["state"] = state
+    return await _get_collection(ctx, PATH_DATABASE, key="databases", **kwargs)
+
+
+async def cancel_transaction(ctx: Context, id: str, **kwargs) -> Dict:
+    rsp = await post(ctx, _mkurl(ctx, f"{PATH_TRANSACTIONS}/{id}/cancel"), {}, **kwargs)
+    return api._decode(ctx, rsp)
+
+
+async def get_transaction(ctx: Context, id: str, **kwargs) -> Dict:
+    return await _get_resource(ctx, f"{PATH_TRANSACTIONS}/{id}", key="transaction", **kwargs)
+
+
+async def get_transaction_metadata(ctx: Context, id: str, **kwargs):
+    headers = {"Accept": "application/x-protobuf"}
+    url = _mkurl(ctx, f"{PATH_TRANSACTIONS}/{id}/metadata")
+    rsp = await get(ctx, url, headers=headers, **kwargs)
+    content_type = rsp.headers.get("content-type", "")
+    if "application/x-protobuf" in content_type:
+        return api._parse_metadata_proto(rsp.read())
+
+    raise Exception(f"invalid content type for metadata proto: {content_type}")
+
+
+async def get_transaction_problems(ctx: Context, id: str, **kwargs) -> List:
+    return await _get_collection(ctx, f"{PATH_TRANSACTIONS}/{id}/problems", **kwargs)
+
+
+async def get_transaction_results(ctx: Context, id: str, **kwargs) -> List:
+    url = _mkurl(ctx, f"{PATH_TRANSACTIONS}/{id}/results")
+    rsp = await get(ctx, url, **kwargs)
+    content_type = rsp.headers.get("content-type", "")
+    if "multipart/form-data" in content_type:
+        parts = api._parse_multipart_form(content_type, rsp.read())
+        return api._parse_arrow_results(parts)
+
+    raise Exception("invalid response type")
+
+
+async def get_transaction_query(ctx: Context, id: str, **kwargs) -> str:
+    rsp = await get(ctx, _mkurl(ctx, f"{PATH_TRANSACTIONS}/{id}/query"), **kwargs)
+    return rsp.read().decode("utf-8")
+
+
+async def list_transactions(ctx: Context, **kwargs) -> List:
+    return await _get_collection(ctx, PATH_TRANSACTIONS, key="transactions", **kwargs)
+
+
+async def _run_transaction(ctx: Context, tx: Transaction, *args, **kwargs) -> Dict:
+    data, params = tx._request(ctx, *args)
+    rsp = await post(ctx, _mkurl(ctx, PATH_TRANSACTION), data, idempotent=tx.readonly, **params, **kwargs)
+    return api._decode(ctx, rsp)
+
+
+async def exec_v1(
+    ctx: Context,
+    database: str,
+    engine: str,
+    command: str,
+    inputs: dict = None,
+    readonly: bool = True,
+    **kwargs
+) -> Dict:
+    tx = Transaction(database, engine, mode=Mode.OPEN, readonly=readonly)
+    return await _run_transaction(ctx, tx, api._query_action(command, inputs=inputs), **kwargs)
+
+
+async def load_csv(
+    ctx: Context,
+    database: str,
+    engine: str,
+    relation: str,
+    data: str or io.TextIOBase,
+    syntax: dict = {},
+    **kwargs
+) -> Dict:
+    command, inputs = api._load_csv_query(relation, data, syntax)
+    return await exec_v1(ctx, database, engine, command, inputs=inputs, readonly=False, **kwargs)
+
+
+async def load_json(
+    ctx: Context,
+    database: str,
+    engine: str,
+    relation: str,
+    data: str or io.TextIOBase,
+    **kwargs
+) -> Dict:
+    command, inputs = api._load_json_query(relation, data)
+    return await exec_v1(ctx, database, engine, command, inputs=inputs, readonly=False, **kwargs)
+
+
+async def _is_txn_term_state(ctx: Context, id: str, **kwargs) -> bool:
+    return api.is_txn_term_state((await get_transaction(ctx, id, **kwargs))["state"])
+
+
+async def exec(
+    ctx: Context,
+    database: str,
+    engine: str,
+    command: str,
+    inputs: dict = None,
+    readonly: bool = True,
+    **kwargs
+) -> TransactionAsyncResponse:
+    logger.info('exec: database %s engine %s readonly %s' % (database, engine, readonly))
+    deadline = api._with_deadline(kwargs)
+    start_time = time.time()
+    txn = await exec_async(ctx, database, engine, command, inputs=inputs, readonly=readonly, deadline=deadline)
+    id = txn.transaction["id"]
+    logger.debug('exec: transaction id - %s' % id)
+
+    # in case of if short-path, return results directly, no need to poll for state
+    if not (txn.results is None):
+        return txn
+
+    logger.debug('exec: polling for transaction with id - %s' % id)
+    try:
+        await poll_with_specified_overhead(
+            lambda: _is_txn_term_state(ctx, id, **kwargs),
+            overhead_rate=0.2,
+            start_time=start_time,
+            timeout=deadline - time.time() if deadline is not None else None,
+        )
+    except Exception as e:
+        if deadline is None or time.time() < deadline:
+            raise
+        # don't leave the transaction running once the caller gave up on it
+        logger.info('exec: deadline exceeded, cancelling transaction %s' % id)
+        try:
+            await cancel_transaction(ctx, id, timeout=api._CANCEL_TIMEOUT)
+        except Exception as cancel_error:
+            logger.warning(f"exec: failed to cancel transaction {id}: {cancel_error}")
+        if isinstance(e, TimeoutError):
+            raise
+        raise TimeoutError(f"deadline exceeded waiting for transaction {id}") from e
+
+    # the requests are independent, so they are issued concurrently
+    transaction, metadata, problems, results = await asyncio.gather(
+        get_transaction(ctx, id, **kwargs),
+        get_transaction_metadata(ctx, id, **kwargs),
+        get_transaction_problems(ctx, id, **kwargs),
+        get_transaction_results(ctx, id, **kwargs),
+    )
+    return TransactionAsyncResponse(transaction, metadata, results, problems)
+
+
+async def exec_async(
+    ctx: Context,
+    database: str,
+    engine: str,
+    command: str,
+    readonly: bool = True,
+    inputs: dict = None,
+    language: str = "",
+    **kwargs,
+) -> TransactionAsyncResponse:
+    tx = TransactionAsync(database, engine, readonly=readonly)
+    data = tx._request(command, language, inputs)
+    rsp = await post(ctx, _mkurl(ctx, PATH_TRANSACTIONS), data, idempotent=readonly, **kwargs)
+    content_type = rsp.headers.get("content-type", None)
+    rsp = api._parse_run_response(content_type, rsp.read(), ctx.json_codec)
+    return api._transaction_async_response(rsp, ctx.json_codec)
@@ -14,18 +14,32 @@
 
 """Operation level interface to the RelationalAI REST API."""
 
+import copy
+import hashlib
 import json
-import pyarrow as pa
 import time
 import re
 import io
 import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import concurrent.futures
+from collections import deque
+from collections.abc import Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import Enum, unique
-from typing import Dict, List, Union
-from requests_toolbelt import multipart
+from typing import TYPE_CHECKING, Dict, List, Union
+from urllib.error import HTTPError
 from . import rest
 
-from .pb.message_pb2 import MetadataInfo
+# pyarrow and protobuf are imported on first use, so calls that don't need
+# them, eg the engine and database management calls, don't pay for importing
+# them
+if TYPE_CHECKING:
+    from .pb.message_pb2 import MetadataInfo
 
 
 PATH_ENGINE = "/compute"
@@ -103,10 +117,17 @@ class Permission(str, Enum):
 
 
 __all__ = [
+    "AdaptivePollingSchedule",
     "Context",
     "Mode",
     "Role",
     "Permission",
+    "SingleFlight",
+    "TransactionExecutor",
+    "TransactionFuture",
+    "TransactionPoller",
+    "TransactionResults",
+    "as_completed",
     "create_database",
     "create_engine",
     "create_user",
@@ -117,12 +138,14 @@ __all__ = [
     "disable_user",
     "enable_user",
     "delete_oauth_client",
+    "exec_batch",
     "get_database",
     "get_engine",
     "get_model",
     "get_oauth_client",
     "get_transaction",
     "get_transaction_metadata",
+    "get_transaction_results_stream",
     "list_transactions",
     "get_transaction_results_and_problems",
     "cancel_transaction",
@@ -140,6 +163,10 @@ __all__ = [
 ]
 
 
+# The number of threads of a context fetching transaction artifacts.
+_FETCH_WORKERS = 8
+
+
 # Context contains the state required to make rAI API calls.
 class Context(rest.Context):
     def __init__(
@@ -151,12 +178,47 @@ class Context(rest.Context):
         credentials=None,
         audience: str = None,
         retries: int = 0,
+        **kwargs,
     ):
-        super().__init__(region=region, credentials=credentials, retries=retries)
+        # additional arguments, eg `transport`, are passed through to rest.Context
+        super().__init__(region=region, credentials=credentials, retries=retries, **kwargs)
         self.host = host
         self.port = port or "443"
         self.scheme = scheme or "https"
         self.audience = audience
+        self.poller = None
+        self.result_cache = None
+        self.single_flight = None
+        # results larger than `spill_threshold` bytes are spilled to memory
+        # mapped files in `spill_directory` (default: the temp directory)
+        self.spill_threshold = None
+        self.spill_directory = None
+        # when set, `exec` asks the server to hold transaction status
+        # requests open for up to `server_wait` seconds, rather than polling
+        self.server_wait = None
+        self._server_wait_supported = None
+        self.polling_schedule = None
+        self._fetch_executor = None
+        self._fetch_lock = threading.Lock()
+
+    # Releases the resources held by the context, including the threads that
+    # fetch transaction artifacts.
+    def close(self):
+        with self._fetch_lock:
+            executor, self._fetch_executor = self._fetch_executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+        super().close()
+
+    # Returns the executor that fetches transaction artifacts concurrently,
+    # shared by the calls made with the context.
+    def _fetch_pool(self) -> ThreadPoolExecutor:
+        with self._fetch_lock:
+            if self._fetch_executor is None:
+                self._fetch_executor = ThreadPoolExecutor(
+                    max_workers=_FETCH_WORKERS, thread_name_prefix="rai-fetch"
+                )
+            return self._fetch_executor
 
 
 # Transaction async response class
@@ -164,7 +226,7 @@ class TransactionAsyncResponse:
     def __init__(
         self,
         transaction: dict = None,
-        metadata: MetadataInfo = None,
+        metadata: "MetadataInfo" = None,
         results: list = None,
         problems: list = None,
     ):
@@ -184,6 +246,18 @@ class TransactionAsyncResponse:
         )
 
 
+# Returns a copy of the given response that shares its results, which are
+# immutable, or their (immutable) tables, so that callers sharing a response
+# can't see each other's changes.
+def _copy_response(rsp: TransactionAsyncResponse) -> TransactionAsyncResponse:
+    result = copy.copy(rsp)
+    result.transaction = copy.deepcopy(rsp.transaction)
+    result.problems = copy.deepcopy(rsp.problems)
+    if rsp.results is not None and not isinstance(rsp.results, TransactionResults):
+        result.results = [dict(item) for item in rsp.results]
+    return result
+
+
 # Transaction async file class
 class TransactionAsyncFile:
     def __init__(
@@ -191,7 +265,7 @@ class TransactionAsyncFile:
         name: str = None,
         filename: str = None,
         content_type: str = None,
-        content: bytes = None,
+        content: memoryview = None,
     ):
         self.name = name
         self.filename = filename
@@ -220,7 +294,11 @@ def _mkurl(ctx: Context, path: str) -> str:
 def _get_resource(ctx: Context, path: str, key=None, **kwargs) -> Dict:
     url = _mkurl(ctx, path)
     rsp = rest.get(ctx, url, **kwargs)
-    rsp = json.loads(rsp.read())
+    return _resource(_decode(ctx, rsp, key))
+
+
+# Extract an individual resource from the given response.
+def _resource(rsp, key=None) -> Dict:
     if key:
         rsp = rsp[key]
     if rsp and isinstance(rsp, list):
@@ -232,42 +310,202 @@ def _get_resource(ctx: Context, path: str, key=None, **kwargs) -> Dict:
 # Retrieve a generic collection of resources.
 def _get_collection(ctx, path: str, key=None, **kwargs):
     rsp = rest.get(ctx, _mkurl(ctx, path), **kwargs)
-    rsp = json.loads(rsp.read())
-    return rsp[key] if key else rsp
+    return _decode(ctx, rsp, key or None)
+
+
+# Decodes the JSON body of the given response, or only the value of its
+# `key`, with the context's JSON codec.
+def _decode(ctx: Context, rsp, key: str = None):
+    return ctx.json_codec.decode(rsp.read(), key)
 
 
-# Parse "multipart/form-data" response
+# Returns the boundary of the given "multipart/form-data" content type.
+def _multipart_boundary(content_type: str) -> bytes:
+    boundary = re.search(r'boundary=(?:"([^"]+)"|([^;\s]+))', content_type)
+    if boundary is None:
+        raise Exception(f"missing multipart boundary: {content_type}")
+    return (boundary.group(1) or boundary.group(2)).encode()
+
+
+# Parse the headers of a multipart part, header names are lower cased.
+def _parse_part_headers(data: bytes) -> Dict[str, bytes]:
+    headers = {}
+    for line in data.split(b"\r\n"):
+        if not line:
+            continue
+        k, _, v = line.partition(b":")
+        headers[k.strip().decode().lower()] = v.strip()
+    return headers
+
+
+# Parse "multipart/form-data" response. The content of each part is a
+# memoryview into the response body, so parts are not copied.
 def _parse_multipart_form(
     content_type: str, content: bytes
 ) -> List[TransactionAsyncFile]:
     result = []
 
-    parts = multipart.decoder.MultipartDecoder(
-        content_type=content_type, content=content
-    ).parts
+    delimiter = b"--" + _multipart_boundary(content_type)
+    view = memoryview(content)
+    pos = content.find(delimiter)
+    if pos < 0:
+        raise Exception("invalid multipart response: missing boundary")
+
+    while True:
+        pos += len(delimiter)
+        if content[pos:pos + 2] == b"--":
+            break  # close delimiter
+        head_start = content.find(b"\r\n", pos) + 2
+        head_end = content.find(b"\r\n\r\n", head_start - 2)
+        end = content.find(b"\r\n" + delimiter, head_end)
+        if head_start < 2 or head_end < 0 or end < 0:
+            raise Exception("invalid multipart response: truncated part")
+        headers = _parse_part_headers(content[head_start:head_end])
 
-    for part in parts:
         txn_file = TransactionAsyncFile()
-        txn_file.content_type = part.headers[b"Content-Type"].decode()
-        txn_file.content = part.content
+        txn_file.content_type = headers.get("content-type", b"").decode()
+        txn_file.content = view[head_end + 4:end]
 
-        disposition = part.headers[b"Content-Disposition"]
+        disposition = headers.get("content-disposition", b"")
         name = re.match(b'.*; name="(.+?)"', disposition)
         if not (name is None):
             txn_file.name = name.group(1).decode()
         filename = re.match(b'.*filename="(.+?)"', disposition)
         if not (filename is None):
-            txn_file.filename = name.group(1).decode()
+            txn_file.filename = filename.group(1).decode()
 
         result.append(txn_file)
+        pos = end + 2
 
     return result
 
 
+# A part of a multipart response read by a _MultipartReader, whose content
+# is read from the response stream as it arrives.
+class _MultipartPart(io.RawIOBase):
+    def __init__(self, reader, headers: Dict[str, bytes]):
+        super().__init__()
+        self._reader = reader
+        self._end = False
+        self.content_type = headers.get("content-type", b"").decode()
+        self.name = None
+        self.filename = None
+        disposition = headers.get("content-disposition", b"")
+        name = re.match(b'.*; name="(.+?)"', disposition)
+        if not (name is None):
+            self.name = name.group(1).decode()
+        filename = re.match(b'.*filename="(.+?)"', disposition)
+        if not (filename is None):
+            self.filename = filename.group(1).decode()
+
+    def readable(self) -> bool:
+        return True
+
+    def _read_chunk(self, n: int) -> bytes:
+        if self._end:
+            return b""
+        data = self._reader._read_part(n)
+        if not data:
+            self._end = True
+        return data
+
+    def readinto(self, b) -> int:
+        data = self._read_chunk(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    # Unlike raw streams, reads block until `n` bytes or the end of the part
+    # is reached, as expected by the arrow stream reader.
+    def read(self, n: int = -1) -> bytes:
+        if n is None or n < 0:
+            return self.readall()
+        chunks = []
+        while n > 0:
+            data = self._read_chunk(n)
+            if not data:
+                break
+            chunks.append(data)
+            n -= len(data)
+        return b"".join(chunks)
+
+    # Skips the rest of the content.
+    def _drain(self):
+        while self._read_chunk(self._reader.chunk_size):
+            pass
+
+
+# Reads the parts of a "multipart/form-data" response from a stream as the
+# body arrives, without holding the whole body in memory. Parts must be
+# consumed in order, moving on to the next part skips whatever is left of
+# the current one.
+class _MultipartReader(object):
+    def __init__(self, stream, content_type: str, chunk_size: int = 64 * 1024):
+        self._stream = stream
+        self._delimiter = b"\r\n--" + _multipart_boundary(content_type)
+        # the leading CRLF lets the first delimiter match like the others
+        self._buffer = bytearray(b"\r\n")
+        self.chunk_size = chunk_size
+
+    def _fill(self):
+        data = self._stream.read(self.chunk_size)
+        if not data:
+            raise Exception("invalid multipart response: truncated body")
+        self._buffer += data
+
+    # Consumes the buffer up to and including the given separator, and
+    # returns the consumed content without the separator.
+    def _read_until(self, sep: bytes) -> bytes:
+        start = 0
+        while True:
+            i = self._buffer.find(sep, start)
+            if i >= 0:
+                data = bytes(self._buffer[:i])
+                del self._buffer[:i + len(sep)]
+                return data
+            start = max(0, len(self._buffer) - len(sep) + 1)
+            self._fill()
+
+    # Returns up to `n` bytes of the current part, or no bytes once the
+    # part's closing delimiter is reached.
+    def _read_part(self, n: int) -> bytes:
+        while True:
+            i = self._buffer.find(self._delimiter)
+            if i == 0:
+                del self._buffer[:len(self._delimiter)]
+                return b""
+            # without a delimiter, the tail of the buffer may be the start
+            # of one, so it's held back until more data arrives
+            available = i if i > 0 else len(self._buffer) - len(self._delimiter) + 1
+            if available > 0:
+                n = min(n, available)
+                data = bytes(self._buffer[:n])
+                del self._buffer[:n]
+                return data
+            self._fill()
+
+    def parts(self):
+        self._read_until(self._delimiter)  # skip the preamble
+        while True:
+            while len(self._buffer) < 2:
+                self._fill()
+            if self._buffer[:2] == b"--":
+                return  # close delimiter
+            self._read_until(b"\r\n")  # skip transport padding
+            if self._buffer[:2] == b"\r\n":
+                del self._buffer[:2]
+                headers = {}
+            else:
+                headers = _parse_part_headers(self._read_until(b"\r\n\r\n"))
+            part = _MultipartPart(self, headers)
+            yield part
+            part._drain()
+
+
 # Parse TransactionAsync response
 def _parse_transaction_async_response(
-    files: List[TransactionAsyncFile],
+    files: List[TransactionAsyncFile], codec: rest.JsonCodec = None,
 ) -> TransactionAsyncResponse:
+    codec = codec or rest.default_json_codec()
     txn_file = next(iter([file for file in files if file.name == "transaction"]), None)
     metadata_file = next(
         iter([file for file in files if file.name == "metadata.proto"]), None
@@ -283,10 +521,10 @@ def _parse_transaction_async_response(
     if problems_file is None:
         raise Exception("problems part is missing")
 
-    txn = json.loads(txn_file.content)
+    txn = codec.decode(txn_file.content)
     metadata = _parse_metadata_proto(metadata_file.content)
     results = _parse_arrow_results(files)
-    problems = json.loads(problems_file.content)
+    problems = codec.decode(problems_file.content)
 
     return TransactionAsyncResponse(txn, metadata, results, problems)
 
@@ -294,7 +532,9 @@ def _parse_transaction_async_response(
 # Parse Metadata from protobuf
 
 
-def _parse_metadata_proto(data: bytes) -> MetadataInfo:
+def _parse_metadata_proto(data: bytes) -> "MetadataInfo":
+    from .pb.message_pb2 import MetadataInfo
+
     metadata = MetadataInfo()
     metadata.ParseFromString(data)
     return metadata
@@ -304,20 +544,114 @@ def _parse_metadata_proto(data: bytes) -> MetadataInfo:
 
 
 def _parse_arrow_results(files: List[TransactionAsyncFile]):
-    results = []
     result_files = [
         file
         for file in files
         if file.content_type == "application/vnd.apache.arrow.stream"
     ]
+    return TransactionResults(result_files)
+
+
+# Decode the given Arrow stream.
+def _decode_arrow(content: memoryview):
+    import pyarrow as pa
+
+    # wrapping the content in a buffer lets arrow read it without a copy
+    with pa.ipc.open_stream(pa.py_buffer(content)) as reader:
+        return reader.read_all()
+
+
+# The Arrow results of a transaction, each result is only decoded on first
+# access. Like a list, results can be accessed by position as dicts with
+# the relation id and table, and like a mapping, tables can be accessed by
+# relation id, eg `rsp.results["/:output/Int64"]`.
+class TransactionResults(Sequence):
+    def __init__(self, files: List[TransactionAsyncFile]):
+        self._ids = [file.name for file in files]
+        self._contents = [file.content for file in files]
+        self._tables = [None] * len(files)
+        self._index = {id: i for i, id in enumerate(self._ids)}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.table(key)
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self)))]
+        return {"relationId": self._ids[key], "table": self._table(key)}
+
+    def __contains__(self, key) -> bool:
+        if isinstance(key, str):
+            return key in self._index
+        return super().__contains__(key)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (list, TransactionResults)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+    # Returns the ids of the result relations.
+    def keys(self) -> List[str]:
+        return list(self._ids)
+
+    # Returns the table of the given relation id.
+    def table(self, relation_id: str):
+        return self._table(self._index[relation_id])
+
+    # The size of the results, without decoding them: the size of the
+    # decoded tables, and of the Arrow streams of the others.
+    @property
+    def nbytes(self) -> int:
+        with self._lock:
+            return sum(
+                table.nbytes if table is not None else len(memoryview(content))
+                for table, content in zip(self._tables, self._contents)
+            )
+
+    # Returns the Arrow stream of the given result, if it hasn't been
+    # decoded, otherwise its table.
+    def _stream_or_table(self, i: int) -> tuple:
+        with self._lock:
+            return self._contents[i], self._tables[i]
+
+    def _table(self, i: int):
+        with self._lock:
+            table = self._tables[i]
+            if table is None:
+                table = self._tables[i] = _decode_arrow(self._contents[i])
+                self._contents[i] = None
+            return table
+
+    # Returns the results of the given (relation id, Arrow stream, table)
+    # items, without decoding the streams.
+    @classmethod
+    def _of(cls, items) -> "TransactionResults":
+        results = cls([])
+        for relation_id, stream, table in items:
+            results._index[relation_id] = len(results._ids)
+            results._ids.append(relation_id)
+            results._contents.append(stream)
+            results._tables.append(table)
+        return results
+
+
+# Yields the (relation id, Arrow stream, table) items of the given results,
+# the stream is None once the result is decoded, the table until then.
+def _result_items(results):
+    if isinstance(results, TransactionResults):
+        for i, relation_id in enumerate(results.keys()):
+            stream, table = results._stream_or_table(i)
+            yield relation_id, stream, table
+        return
+    for result in results or []:
+        yield result["relationId"], None, result["table"]
 
-    for file in result_files:
-        with pa.ipc.open_stream(file.content) as reader:
-            schema = reader.schema
-            batches = [batch for batch in reader]
-            table = pa.Table.from_batches(batches=batches, schema=schema)
-            results.append({"relationId": file.name, "table": table})
-    return results
 
 # polling with specified overhead
 # delay is the overhead % of the time the transaction has been running so far
@@ -350,15 +684,115 @@ def poll_with_specified_overhead(
             raise Exception(f'max tries {max_tries} exhausted')
 
         if max_time is not None and current_time >= max_time:
-            raise Exception(f'timed out after {timeout} seconds')
+            raise TimeoutError(f'timed out after {timeout} seconds')
 
         duration = (current_time - start_time) * overhead_rate
         duration = min(duration, max_delay)
+        if max_time is not None:
+            duration = min(duration, max_time - current_time)
 
         time.sleep(duration)
         tries += 1
 
 
+# Schedules transaction status polls around the expected completion time of
+# the query, based on a rolling window of the durations observed for the
+# same query fingerprint. The first poll is scheduled at the median of the
+# observed durations, the following ones at increasingly higher quantiles,
+# after which it falls back to polling with the given overhead rate. Until
+# `min_samples` durations are observed it only uses the overhead rate.
+# Delays are randomized by +/- `jitter` and are at least `min_interval`
+# seconds. To use it with `exec`:
+#
+#     ctx.polling_schedule = api.AdaptivePollingSchedule()
+class AdaptivePollingSchedule(object):
+    quantiles = (0.5, 0.75, 0.9, 0.99)
+
+    def __init__(
+        self,
+        window: int = 50,
+        min_samples: int = 3,
+        overhead_rate: float = 0.2,
+        min_interval: float = 0.05,
+        max_delay: int = 120,
+        jitter: float = 0.1,
+    ):
+        if overhead_rate < 0:
+            raise ValueError("overhead_rate must be non-negative")
+        self.window = window
+        self.min_samples = min_samples
+        self.overhead_rate = overhead_rate
+        self.min_interval = min_interval
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self._durations = {}
+        self._lock = threading.Lock()
+
+    # Returns the fingerprint of the given query, queries that only differ
+    # in whitespace have the same fingerprint.
+    @staticmethod
+    def fingerprint(command: str) -> str:
+        command = " ".join(command.split())
+        return hashlib.sha256(command.encode("utf8")).hexdigest()
+
+    # Records the duration of a query with the given fingerprint.
+    def record(self, fingerprint: str, duration: float):
+        with self._lock:
+            durations = self._durations.get(fingerprint)
+            if durations is None:
+                durations = self._durations[fingerprint] = deque(maxlen=self.window)
+            durations.append(duration)
+
+    # Returns the delay before the next poll of a query with the given
+    # fingerprint that has been running for `elapsed` seconds.
+    def delay(self, fingerprint: str, elapsed: float) -> float:
+        with self._lock:
+            durations = sorted(self._durations.get(fingerprint, ()))
+        delay = None
+        if len(durations) >= self.min_samples:
+            for q in self.quantiles:
+                expected = durations[min(int(q * len(durations)), len(durations) - 1)]
+                if expected - elapsed >= self.min_interval:
+                    delay = expected - elapsed
+                    break
+        if delay is None:
+            delay = elapsed * self.overhead_rate
+        delay = min(delay, self.max_delay)
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(delay, self.min_interval)
+
+    # Polls until `f` returns True, and records the duration of the query,
+    # estimated as halfway between the last two polls. Raises `TimeoutError`
+    # if `f` doesn't return True by the given deadline.
+    def poll(self, f, fingerprint: str, start_time: float = None, deadline: float = None):
+        if start_time is None:
+            start_time = time.time()
+        last_poll = start_time
+        while True:
+            now = time.time()
+            delay = self.delay(fingerprint, now - start_time)
+            if deadline is not None:
+                if now >= deadline:
+                    raise TimeoutError(f'timed out after {deadline - start_time:.1f} seconds')
+                delay = min(delay, deadline - now)
+            time.sleep(delay)
+            current_time = time.time()
+            if f():
+                self.record(fingerprint, (last_poll + current_time) / 2 - start_time)
+                return
+            last_poll = current_time
+
+
+# Replaces the `timeout` of a call that issues several requests with the
+# corresponding `deadline`, so that it bounds the call as a whole rather
+# than each of its requests, and returns the deadline.
+def _with_deadline(kwargs: dict) -> float:
+    deadline = rest._deadline(kwargs.pop("timeout", None), kwargs.get("deadline"))
+    if deadline is not None:
+        kwargs["deadline"] = deadline
+    return deadline
+
+
 def is_engine_term_state(state: str) -> bool:
     return state == "PROVISIONED" or ("FAILED" in state)
 
@@ -367,41 +801,49 @@ def create_engine(ctx: Context, engine: str, size: str = "XS", **kwargs):
     data = {"region": ctx.region, "name": engine, "size": size}
     url = _mkurl(ctx, PATH_ENGINE)
     rsp = rest.put(ctx, url, data, **kwargs)
-    return json.loads(rsp.read())
+    return _decode(ctx, rsp)
 
 
 def create_engine_wait(ctx: Context, engine: str, size: str = "XS", **kwargs):
+    deadline = _with_deadline(kwargs)
     create_engine(ctx, engine, size, **kwargs)
+    timeout = 30 * 60
+    if deadline is not None:
+        timeout = min(timeout, deadline - time.time())
     poll_with_specified_overhead(
-        lambda: is_engine_term_state(get_engine(ctx, engine)["state"]),
+        lambda: is_engine_term_state(get_engine(ctx, engine, deadline=deadline)["state"]),
         overhead_rate=0.2,
-        timeout=30 * 60,
+        timeout=timeout,
     )
-    return get_engine(ctx, engine)
+    return get_engine(ctx, engine, deadline=deadline)
 
 
 def suspend_engine(ctx: Context, engine: str, **kwargs):
     data = {"suspend": True}
     url = _mkurl(ctx, f"{PATH_ENGINE}/{engine}")
     rsp = rest.patch(ctx, url, data, **kwargs)
-    return json.loads(rsp.read())
+    return _decode(ctx, rsp)
 
 
 def resume_engine(ctx: Context, engine: str, **kwargs):
     data = {"suspend": False}
     url = _mkurl(ctx, f"{PATH_ENGINE}/{engine}")
     rsp = rest.patch(ctx, url, data, **kwargs)
-    return json.loads(rsp.read())
+    return _decode(ctx, rsp)
 
 
 def resume_engine_wait(ctx: Context, engine: str, **kwargs):
+    deadline = _with_deadline(kwargs)
     resume_engine(ctx, engine, **kwargs)
+    timeout = 30 * 60
+    if deadline is not None:
+        timeout = min(timeout, deadline - time.time())
     poll_with_specified_overhead(
-        lambda: is_engine_term_state(get_engine(ctx, engine)["state"]),
+        lambda: is_engine_term_state(get_engine(ctx, engine, deadline=deadline)["state"]),
         overhead_rate=0.2,
-        timeout=30 * 60,
+        timeout=timeout,
     )
-    return get_engine(ctx, engine)
+    return get_engine(ctx, engine, deadline=deadline)
 
 
 def create_user(ctx: Context, email: str, roles: List[Role] = None, **kwargs):
@@ -409,7 +851,7 @@ def create_user(ctx: Context, email: str, roles: List[Role] = None, **kwargs):
     data = {"email": email, "roles": [r.value for r in rs]}
     url = _mkurl(ctx, PATH_USER)
     rsp = rest.post(ctx, url, data, **kwargs)
-    return json.loads(rsp.read())
+    return _decode(ctx, rsp)
 
 
 def create_oauth_client(ctx: Context, name: str, permissions: List[Permission] = None, **kwargs):
@@ -417,7 +859,7 @@ def create_oauth_client(ctx: Context, name: str, permissions: List[Permission] =
     data = {"name": name, "permissions": ps}
     url = _mkurl(ctx, PATH_OAUTH_CLIENT)
     rsp = rest.post(ctx, url, data, **kwargs)
-    return json.loads(rsp.read())["client"]
+    return _decode(ctx, rsp, "client")
 
 
 # Derives the database open_mode based on the given arguments.
@@ -433,20 +875,20 @@ def delete_database(ctx: Context, database: str, **kwargs) -> Dict:
     data = {"name": database}
     url = _mkurl(ctx, PATH_DATABASE)
     rsp = rest.delete(ctx, url, data, **kwargs)
-    return json.loads(rsp.read())
+    return _decode(ctx, rsp)
 
 
 def delete_engine(ctx: Context, engine: str, **kwargs) -> Dict:
     data = {"name": engine}
     url = _mkurl(ctx, PATH_ENGINE)
     rsp = rest.delete(ctx, url, data, **kwargs)
-    return json.loads(rsp.read())
+    return _decode(ctx, rsp)
 
 
 def delete_user(ctx: Context, id: str, **kwargs) -> Dict:
     url = _mkurl(ctx, f"{PATH_USER}/{id}")
     rsp = rest.delete(ctx, url, None, **kwargs)
-    return json.loads(rsp.read())
+    return _decode(ctx, rsp)
 
 
 def disable_user(ctx: Context, userid: str, **kwargs) -> Dict:
@@ -456,7 +898,7 @@ def disable_user(ctx: Context, userid: str, **kwargs) -> Dict:
 def delete_oauth_client(ctx: Context, id: str, **kwargs) -> Dict:
     url = _mkurl(ctx, f"{PATH_OAUTH_CLIENT}/{id}")
     rsp = rest.delete(ctx, url, None, **kwargs)
-    return json.loads(rsp.read())
+    return _decode(ctx, rsp)
 
 
 def enable_user(ctx: Context, userid: str, **kwargs) -> Dict:
@@ -477,7 +919,7 @@ def get_oauth_client(ctx: Context, id: str, **kwargs) -> Dict:
 
 def cancel_transaction(ctx: Context, id: str, **kwargs) -> Dict:
     rsp = rest.post(ctx, _mkurl(ctx, f"{PATH_TRANSACTIONS}/{id}/cancel"), {}, **kwargs)
-    return json.loads(rsp.read())
+    return _decode(ctx, rsp)
 
 
 def get_transaction(ctx: Context, id: str, **kwargs) -> Dict:
@@ -504,21 +946,124 @@ def get_transaction_results(ctx: Context, id: str, **kwargs) -> List:
     rsp = rest.get(ctx, url, **kwargs)
     content_type = rsp.headers.get("content-type", "")
     if "multipart/form-data" in content_type:
-        parts = _parse_multipart_form(content_type, rsp.read())
-        return _parse_arrow_results(parts)
+        return _read_results(ctx, rsp, content_type)
 
     raise Exception("invalid response type")
 
 
+# Reads the given results response into memory, unless it's larger than the
+# context's spill threshold, in which case results are spilled to disk.
+def _read_results(ctx: Context, rsp, content_type: str):
+    threshold = ctx.spill_threshold
+    if threshold is None:
+        return _parse_arrow_results(_parse_multipart_form(content_type, rsp.read()))
+
+    prefix = b""
+    length = rsp.headers.get("content-length")
+    if length is None or int(length) <= threshold:
+        prefix = _read_at_most(rsp, threshold + 1)
+        if len(prefix) <= threshold:
+            return _parse_arrow_results(_parse_multipart_form(content_type, prefix))
+
+    with rsp:
+        return _spill_results(ctx, _PrefixedStream(prefix, rsp), content_type)
+
+
+# Reads up to `n` bytes from the given stream, stopping early only at EOF.
+def _read_at_most(stream, n: int) -> bytes:
+    chunks = []
+    while n > 0:
+        data = stream.read(n)
+        if not data:
+            break
+        chunks.append(data)
+        n -= len(data)
+    return b"".join(chunks)
+
+
+# A stream that returns the given prefix, followed by the rest of the given
+# stream.
+class _PrefixedStream(object):
+    def __init__(self, prefix: bytes, stream):
+        self._prefix = memoryview(prefix)
+        self._stream = stream
+
+    def read(self, n: int) -> bytes:
+        if self._prefix:
+            data, self._prefix = self._prefix[:n], self._prefix[n:]
+            return bytes(data)
+        return self._stream.read(n)
+
+
+# Writes each Arrow part of the given response stream to a file as it
+# arrives, and returns results backed by memory maps of those files, so the
+# OS can page results in and out instead of holding them on the heap. The
+# files are removed once mapped, the mappings keep their data alive.
+def _spill_results(ctx: Context, stream, content_type: str):
+    import pyarrow as pa
+
+    directory = tempfile.mkdtemp(prefix="rai-results-", dir=ctx.spill_directory)
+    files = []
+    try:
+        for i, part in enumerate(_MultipartReader(stream, content_type).parts()):
+            if part.content_type != "application/vnd.apache.arrow.stream":
+                continue
+            path = os.path.join(directory, f"{i}.arrow")
+            with open(path, "wb") as f:
+                shutil.copyfileobj(part, f)
+            content = pa.memory_map(path).read_buffer() if os.path.getsize(path) else b""
+            files.append(TransactionAsyncFile(part.name, part.filename, part.content_type, content))
+    finally:
+        # on Windows mapped files can't be removed and are left behind
+        shutil.rmtree(directory, ignore_errors=True)
+    return TransactionResults(files)
+
+
+# Streams the results of the given transaction, decoding Arrow record
+# batches as the response body arrives instead of waiting for the whole
+# body. Yields a dict with the relation id and a `pa.RecordBatchReader` per
+# result, each reader must be consumed before advancing to the next one.
+def get_transaction_results_stream(ctx: Context, id: str, **kwargs):
+    import pyarrow as pa
+
+    url = _mkurl(ctx, f"{PATH_TRANSACTIONS}/{id}/results")
+    rsp = rest.get(ctx, url, **kwargs)
+    content_type = rsp.headers.get("content-type", "")
+    if "multipart/form-data" not in content_type:
+        rsp.close()
+        raise Exception("invalid response type")
+
+    with rsp:
+        for part in _MultipartReader(rsp, content_type).parts():
+            if part.content_type == "application/vnd.apache.arrow.stream":
+                yield {"relationId": part.name, "reader": pa.ipc.open_stream(part)}
+
+
 # When problems are part of the results relations, this function should be
 # deprecated, get_transaction_results should be called instead
 def get_transaction_results_and_problems(ctx: Context, id: str, **kwargs) -> List:
+    _with_deadline(kwargs)
     rsp = TransactionAsyncResponse()
-    rsp.problems = get_transaction_problems(ctx, id, **kwargs)
-    rsp.results = get_transaction_results(ctx, id, **kwargs)
+    rsp.problems, rsp.results = _fetch_all(ctx, [
+        lambda: get_transaction_problems(ctx, id, **kwargs),
+        lambda: get_transaction_results(ctx, id, **kwargs),
+    ])
     return rsp
 
 
+# Calls the given functions, requests made with the context, concurrently,
+# and returns their results. Some are called on the context's fetch pool,
+# the others in turn on the calling thread. When the context limits its
+# outstanding requests, at most that many are made at once, so a call
+# doesn't have its own requests rejected.
+def _fetch_all(ctx: Context, fs: list) -> list:
+    concurrency = len(fs) if ctx.max_requests is None else min(len(fs), ctx.max_requests)
+    pool = ctx._fetch_pool()
+    futures = [pool.submit(f) for f in fs[:concurrency - 1]]
+    results = [f() for f in fs[concurrency - 1:]]
+    return [future.result() for future in futures] + results
+
+
 def get_transaction_query(ctx: Context, id: str, **kwargs) -> str:
     url = _mkurl(ctx, f"{PATH_TRANSACTIONS}/{id}/query")
     rsp = rest.get(ctx, url, **kwargs)
@@ -533,15 +1078,13 @@ def get_user(ctx: Context, userid: str, **kwargs) -> Dict:
     return _get_resource(ctx, f"{PATH_USER}/{userid}", name=userid, **kwargs)
 
 
-def list_engines(ctx: Context, state=None) -> List:
-    kwargs = {}
+def list_engines(ctx: Context, state=None, **kwargs) -> List:
     if state is not None:
         kwargs["state"] = state
     return _get_collection(ctx, PATH_ENGINE, key="computes", **kwargs)
 
 
-def list_databases(ctx: Context, state=None) -> List:
-    kwargs = {}
+def list_databases(ctx: Context, state=None, **kwargs) -> List:
     if state is not None:
         kwargs["state"] = state
     return _get_collection(ctx, PATH_DATABASE, key="databases", **kwargs)
@@ -563,7 +1106,7 @@ def update_user(ctx: Context, userid: str, status: str = None, roles=None, **kwa
         data["roles"] = roles
     url = _mkurl(ctx, f"{PATH_USER}/{userid}")
     rsp = rest.patch(ctx, url, data, **kwargs)
-    return json.loads(rsp.read())
+    return _decode(ctx, rsp)
 
 
 class Transaction(object):
@@ -615,7 +1158,8 @@ class Transaction(object):
             result["source_dbname"] = self.source_database
         return result
 
-    def run(self, ctx: Context, *args) -> Dict:
+    # Returns the request body and query params for the given actions.
+    def _request(self, ctx: Context, *args):
         data = self.data
         data["actions"] = self._actions(args)
         # several of the request params are duplicated in the query
@@ -627,9 +1171,14 @@ class Transaction(object):
         }
         if self.source_database:
             kwargs["source_dbname"] = self.source_database
+        return data, kwargs
+
+    def run(self, ctx: Context, *args, **kwargs) -> Dict:
+        data, params = self._request(ctx, *args)
         url = _mkurl(ctx, PATH_TRANSACTION)
-        rsp = rest.post(ctx, url, data, **kwargs)
-        return json.loads(rsp.read())
+        # readonly transactions are safe to retry
+        rsp = rest.post(ctx, url, data, idempotent=self.readonly, **params, **kwargs)
+        return _decode(ctx, rsp)
 
 
 class TransactionAsync(object):
@@ -653,24 +1202,34 @@ class TransactionAsync(object):
             result["engine_name"] = self.engine
         return result
 
-    def run(self, ctx: Context, command: str, language: str, inputs: dict = None, **kwargs) -> Union[dict, list]:
+    # Returns the request body for the given query.
+    def _request(self, command: str, language: str, inputs: dict = None) -> dict:
         data = self.data
         data["query"] = command
         data["language"] = language
         if inputs is not None:
             inputs = [_query_action_input(k, v) for k, v in inputs.items()]
             data["v1_inputs"] = inputs
-        rsp = rest.post(ctx, _mkurl(ctx, PATH_TRANSACTIONS), data, **kwargs)
+        return data
+
+    def run(self, ctx: Context, command: str, language: str, inputs: dict = None, **kwargs) -> Union[dict, list]:
+        data = self._request(command, language, inputs)
+        # readonly transactions are safe to retry
+        rsp = rest.post(ctx, _mkurl(ctx, PATH_TRANSACTIONS), data, idempotent=self.readonly, **kwargs)
         content_type = rsp.headers.get("content-type", None)
-        content = rsp.read()
-        # todo: response model should be based on status code (200 v. 201)
-        # async mode
-        if content_type.lower() == "application/json":
-            return json.loads(content)
-        # sync mode
-        if "multipart/form-data" in content_type.lower():
-            return _parse_multipart_form(content_type, content)
-        raise Exception("invalid response type")
+        return _parse_run_response(content_type, rsp.read(), ctx.json_codec)
+
+
+# Parse the response of a TransactionAsync request.
+def _parse_run_response(content_type: str, content: bytes, codec: rest.JsonCodec = None) -> Union[dict, list]:
+    # todo: response model should be based on status code (200 v. 201)
+    # async mode
+    if content_type.lower() == "application/json":
+        return (codec or rest.default_json_codec()).decode(content)
+    # sync mode
+    if "multipart/form-data" in content_type.lower():
+        return _parse_multipart_form(content_type, content)
+    raise Exception("invalid response type")
 
 
 def _delete_model_action(name: str) -> Dict:
@@ -747,7 +1306,7 @@ def create_database(ctx: Context, database: str, source: str = None, **kwargs) -
     data = {"name": database, "source_name": source}
     url = _mkurl(ctx, PATH_DATABASE)
     rsp = rest.put(ctx, url, data, **kwargs)
-    return json.loads(rsp.read())
+    return _decode(ctx, rsp)
 
 
 def delete_model(ctx: Context, database: str, engine: str, model: str) -> Dict:
@@ -852,17 +1411,18 @@ def load_csv(
     relation: str,
     data: str or io.TextIOBase,
     syntax: dict = {},
+    **kwargs
 ) -> Dict:
-    if isinstance(data, str):
-        pass  # ok
-    elif isinstance(data, io.TextIOBase):
-        data = data.read()
-    else:
-        raise TypeError(f"bad type for arg 'data': {data.__class__.__name__}")
-    inputs = {"data": data}
+    command, inputs = _load_csv_query(relation, data, syntax)
+    return exec_v1(ctx, database, engine, command, inputs=inputs, readonly=False, **kwargs)
+
+
+# Returns the query and inputs that load the given CSV data.
+def _load_csv_query(relation: str, data: str or io.TextIOBase, syntax: dict = {}):
+    inputs = {"data": _load_data(data)}
     command = _gen_syntax_config(syntax)
     command += "def config[:data]: data\n" "def insert[:%s]: load_csv[config]" % relation
-    return exec_v1(ctx, database, engine, command, inputs=inputs, readonly=False)
+    return command, inputs
 
 
 def load_json(
@@ -871,16 +1431,28 @@ def load_json(
     engine: str,
     relation: str,
     data: str or io.TextIOBase,
+    **kwargs
 ) -> Dict:
+    command, inputs = _load_json_query(relation, data)
+    return exec_v1(ctx, database, engine, command, inputs=inputs, readonly=False, **kwargs)
+
+
+# Returns the query and inputs that load the given JSON data.
+def _load_json_query(relation: str, data: str or io.TextIOBase):
+    inputs = {"data": _load_data(data)}
+    command = "def config[:data]: data\n" "def insert[:%s]: load_json[config]" % relation
+    return command, inputs
+
+
+# Returns the data to load as a string.
+def _load_data(data: str or io.TextIOBase) -> str:
     if isinstance(data, str):
         pass  # ok
     elif isinstance(data, io.TextIOBase):
         data = data.read()
     else:
         raise TypeError(f"bad type for arg 'data': {data.__class__.__name__}")
-    inputs = {"data": data}
-    command = "def config[:data]: data\n" "def insert[:%s]: load_json[config]" % relation
-    return exec_v1(ctx, database, engine, command, inputs=inputs, readonly=False)
+    return data
 
 
 def exec_v1(
@@ -890,9 +1462,10 @@ def exec_v1(
     command: str,
     inputs: dict = None,
     readonly: bool = True,
+    **kwargs
 ) -> Dict:
     tx = Transaction(database, engine, readonly=readonly)
-    return tx.run(ctx, _query_action(command, inputs=inputs))
+    return tx.run(ctx, _query_action(command, inputs=inputs), **kwargs)
 
 
 # Answers if the given transaction state is a terminal state.
@@ -900,6 +1473,135 @@ def is_txn_term_state(state: str) -> bool:
     return state == "COMPLETED" or state == "ABORTED"
 
 
+class _PollWaiter(object):
+    def __init__(self, start_time: float):
+        self.start_time = start_time
+        self.next_poll = time.time()
+        self.event = threading.Event()
+        self.transaction = None
+        self.error = None
+
+
+# Polls the state of many outstanding transactions on behalf of `exec`
+# callers from a single thread, rather than a polling loop per caller. Each
+# tick polls the transactions that are due with `get_transaction`, in a
+# batch of concurrent requests made on the context's fetch pool, which
+# listing all the transactions of the account would not bound. Polls are
+# scheduled with the same overhead rate as `poll_with_specified_overhead`,
+# and ticks are at least `min_interval` seconds apart, so the polls of
+# transactions that are due at about the same time are batched. To use it:
+#
+#     ctx.poller = api.TransactionPoller(ctx)
+class TransactionPoller(object):
+    def __init__(
+        self,
+        ctx: Context,
+        overhead_rate: float = 0.2,
+        min_interval: float = 0.5,
+        max_delay: int = 120,
+    ):
+        if overhead_rate < 0:
+            raise ValueError("overhead_rate must be non-negative")
+        self._ctx = ctx
+        self.overhead_rate = overhead_rate
+        self.min_interval = min_interval
+        self.max_delay = max_delay
+        self._waiters = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    # Blocks until the given transaction reaches a terminal state, and
+    # returns the transaction.
+    def wait(self, id: str, start_time: float = None, timeout: float = None) -> Dict:
+        waiter = _PollWaiter(start_time or time.time())
+        with self._cond:
+            self._waiters.setdefault(id, []).append(waiter)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="rai-transaction-poller", daemon=True
+                )
+                self._thread.start()
+            self._cond.notify()
+
+        if not waiter.event.wait(timeout):
+            with self._cond:
+                waiters = self._waiters.get(id, [])
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                if not waiters:
+                    self._waiters.pop(id, None)
+            raise TimeoutError(f'timed out after {timeout} seconds')
+        if waiter.error is not None:
+            raise waiter.error
+        return waiter.transaction
+
+    # The polling thread exits once there are no more waiters, and is
+    # restarted by the next call to `wait`. If polling fails unexpectedly,
+    # the waiters fail with the error rather than waiting for a thread that
+    # is gone.
+    def _run(self):
+        try:
+            self._loop()
+        except Exception as e:
+            logger.error(f"poller: stopped polling: {e}")
+            with self._cond:
+                waiters, self._waiters = self._waiters, {}
+                self._thread = None
+            for ws in waiters.values():
+                for w in ws:
+                    w.error = e
+                    w.event.set()
+
+    def _loop(self):
+        last_tick = 0
+        while True:
+            with self._cond:
+                while True:
+                    if not self._waiters:
+                        self._thread = None
+                        return
+                    now = time.time()
+                    next_poll = min(w.next_poll for ws in self._waiters.values() for w in ws)
+                    next_poll = max(next_poll, last_tick + self.min_interval)
+                    if next_poll <= now:
+                        break
+                    self._cond.wait(next_poll - now)
+                due = [id for id, ws in self._waiters.items() if any(w.next_poll <= now for w in ws)]
+
+            last_tick = time.time()
+            states = self._poll(due)
+
+            with self._cond:
+                now = time.time()
+                for id, state in states.items():
+                    waiters = self._waiters.get(id)
+                    if not waiters:
+                        continue
+                    if isinstance(state, Exception) or is_txn_term_state(state["state"]):
+                        del self._waiters[id]
+                        for w in waiters:
+                            if isinstance(state, Exception):
+                                w.error = state
+                            else:
+                                w.transaction = state
+                            w.event.set()
+                    else:
+                        for w in waiters:
+                            duration = (now - w.start_time) * self.overhead_rate
+                            w.next_poll = now + min(duration, self.max_delay)
+
+    # Returns the current state, or the error raised while retrieving it,
+    # of the given transactions.
+    def _poll(self, ids: List[str]) -> Dict:
+        return dict(zip(ids, _fetch_all(self._ctx, [lambda id=id: self._get(id) for id in ids])))
+
+    def _get(self, id: str):
+        try:
+            return get_transaction(self._ctx, id)
+        except Exception as e:
+            return e
+
+
 def exec(
     ctx: Context,
     database: str,
@@ -910,30 +1612,214 @@ def exec(
     **kwargs
 ) -> TransactionAsyncResponse:
     logger.info('exec: database %s engine %s readonly %s' % (database, engine, readonly))
+    _with_deadline(kwargs)
+    key = None
+    if readonly and (ctx.result_cache is not None or ctx.single_flight is not None):
+        key = _query_key(database, command, inputs)
+    if key is not None and ctx.result_cache is not None:
+        rsp = ctx.result_cache.get(key)
+        if rsp is not None:
+            logger.debug('exec: result cache hit')
+            return rsp
+
+    if key is not None and ctx.single_flight is not None:
+        return ctx.single_flight.do(
+            key,
+            lambda: _exec(ctx, database, engine, command, inputs, readonly, key, **kwargs),
+            deadline=kwargs.get("deadline"),
+            copy_result=_copy_response,
+        )
+    return _exec(ctx, database, engine, command, inputs, readonly, key, **kwargs)
+
+
+def _exec(
+    ctx: Context,
+    database: str,
+    engine: str,
+    command: str,
+    inputs: dict,
+    readonly: bool,
+    key: str,
+    **kwargs
+) -> TransactionAsyncResponse:
     start_time = time.time()
-    txn = exec_async(ctx, database, engine, command, inputs=inputs, readonly=readonly)
+    txn = exec_async(
+        ctx, database, engine, command,
+        inputs=inputs, readonly=readonly, deadline=kwargs.get("deadline")
+    )
     logger.debug('exec: transaction id - %s' % txn.transaction["id"])
+    rsp = _wait_transaction(ctx, txn, start_time, command=command, **kwargs)
+
+    if key is not None and ctx.result_cache is not None:
+        ctx.result_cache.put(key, rsp)
+    return rsp
+
+
+# Coalesces concurrent calls with the same key, so that only the first call
+# runs and the others wait for, and share, its result. To have `exec`
+# share a single transaction between identical in-flight readonly queries:
+#
+#     ctx.single_flight = api.SingleFlight()
+class SingleFlight(object):
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    # Returns the result of calling `f`, or of the in-flight call with the
+    # same key, passed through `copy_result` when given, so callers don't
+    # share a mutable result. Waiting for an in-flight call is bounded by the
+    # caller's own `timeout` or `deadline`, and when the in-flight call times
+    # out, callers whose deadline hasn't passed make a call of their own.
+    def do(self, key: str, f, timeout: float = None, deadline: float = None, copy_result=None):
+        deadline = rest._deadline(timeout, deadline)
+        while True:
+            with self._lock:
+                future = self._calls.get(key)
+                leader = future is None
+                if leader:
+                    future = self._calls[key] = Future()
+            if leader:
+                return self._call(key, future, f)
+
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            try:
+                result = future.result(remaining)
+            except (TimeoutError, concurrent.futures.TimeoutError):
+                if not future.done():
+                    raise TimeoutError(f"deadline exceeded waiting for in-flight call {key}")
+                if deadline is not None and time.time() >= deadline:
+                    raise
+                continue
+            return result if copy_result is None else copy_result(result)
+
+    def _call(self, key: str, future: Future, f):
+        try:
+            result = f()
+        except BaseException as e:
+            self._forget(key)
+            future.set_exception(e)
+            raise
+        self._forget(key)
+        future.set_result(result)
+        return result
 
+    # Removes the given call before its result is set, so that callers
+    # retrying after it failed don't find it again.
+    def _forget(self, key: str):
+        with self._lock:
+            del self._calls[key]
+
+
+# Returns a key identifying the given query, independent of the engine
+# it runs on.
+def _query_key(database: str, command: str, inputs: dict = None, language: str = "") -> str:
+    inputs = sorted((inputs or {}).items())
+    data = json.dumps([database, command, inputs, language])
+    return hashlib.sha256(data.encode("utf8")).hexdigest()
+
+
+# The time allowed to cancel a transaction whose deadline expired.
+_CANCEL_TIMEOUT = 10
+
+
+# Waits for the transaction created by `exec_async` to reach a terminal
+# state, and returns its response.
+def _wait_transaction(
+    ctx: Context, txn: TransactionAsyncResponse, start_time: float, command: str = None, **kwargs
+) -> TransactionAsyncResponse:
     # in case of if short-path, return results directly, no need to poll for state
     if not (txn.results is None):
         return txn
 
-    logger.debug('exec: polling for transaction with id - %s' % txn.transaction["id"])
-    rsp = TransactionAsyncResponse()
-    txn = get_transaction(ctx, txn.transaction["id"], **kwargs)
-
-    poll_with_specified_overhead(
-        lambda: is_txn_term_state(get_transaction(ctx, txn["id"], **kwargs)["state"]),
-        overhead_rate=0.2,
-        start_time=start_time,
-    )
+    id = txn.transaction["id"]
+    logger.debug('exec: polling for transaction with id - %s' % id)
+    deadline = kwargs.get("deadline")
+    try:
+        long_poll = ctx.server_wait and ctx._server_wait_supported is not False
+        if not (long_poll and _long_poll_transaction(ctx, id, **kwargs)):
+            _poll_transaction(ctx, id, start_time, command, **kwargs)
+    except Exception as e:
+        if deadline is None or time.time() < deadline:
+            raise
+        # don't leave the transaction running once the caller gave up on it
+        logger.info('exec: deadline exceeded, cancelling transaction %s' % id)
+        try:
+            cancel_transaction(ctx, id, timeout=_CANCEL_TIMEOUT)
+        except Exception as cancel_error:
+            logger.warning(f"exec: failed to cancel transaction {id}: {cancel_error}")
+        if isinstance(e, TimeoutError):
+            raise
+        raise TimeoutError(f"deadline exceeded waiting for transaction {id}") from e
+
+    return _get_transaction_response(ctx, id, **kwargs)
+
+
+# Polls the state of the given transaction until it reaches a terminal state.
+def _poll_transaction(ctx: Context, id: str, start_time: float, command: str = None, **kwargs):
+    deadline = kwargs.get("deadline")
+    timeout = deadline - time.time() if deadline is not None else None
+    if ctx.poller is not None:
+        ctx.poller.wait(id, start_time=start_time, timeout=timeout)
+    elif ctx.polling_schedule is not None and command is not None:
+        ctx.polling_schedule.poll(
+            lambda: is_txn_term_state(get_transaction(ctx, id, **kwargs)["state"]),
+            ctx.polling_schedule.fingerprint(command),
+            start_time=start_time,
+            deadline=deadline,
+        )
+    else:
+        poll_with_specified_overhead(
+            lambda: is_txn_term_state(get_transaction(ctx, id, **kwargs)["state"]),
+            overhead_rate=0.2,
+            start_time=start_time,
+            timeout=timeout,
+        )
 
-    rsp.transaction = get_transaction(ctx, txn["id"], **kwargs)
-    rsp.metadata = get_transaction_metadata(ctx, txn["id"], **kwargs)
-    rsp.problems = get_transaction_problems(ctx, txn["id"], **kwargs)
-    rsp.results = get_transaction_results(ctx, txn["id"], **kwargs)
 
-    return rsp
+# Waits for the given transaction to reach a terminal state by asking the
+# server to hold each status request open for up to `ctx.server_wait`
+# seconds. Returns False, so the caller can fall back to polling, when the
+# server doesn't support long polling, ie it rejects the `wait` parameter or
+# answers with a non-terminal state well before the wait budget elapsed.
+def _long_poll_transaction(ctx: Context, id: str, **kwargs) -> bool:
+    deadline = kwargs.get("deadline")
+    while True:
+        start_time = time.time()
+        wait = ctx.server_wait
+        if deadline is not None:
+            # don't ask the server to wait past the deadline
+            wait = min(wait, int(deadline - start_time))
+            if wait < 1:
+                return False
+        try:
+            # long polls are slow by design, so they aren't hedged
+            txn = get_transaction(ctx, id, wait=wait, hedge=False, **kwargs)
+        except HTTPError as e:
+            if e.code != 400:
+                raise
+            txn = None
+        if txn is not None and is_txn_term_state(txn["state"]):
+            ctx._server_wait_supported = True
+            return True
+        if txn is None or time.time() - start_time < wait / 2:
+            if ctx._server_wait_supported is None:
+                logger.info("exec: server does not support long polling, falling back to polling")
+                ctx._server_wait_supported = False
+            return False
+
+
+# Fetch the transaction, metadata, problems and results of a transaction
+# that reached a terminal state. The requests are independent, so they are
+# issued concurrently, with the results (usually the largest) fetched on
+# the calling thread.
+def _get_transaction_response(ctx: Context, id: str, **kwargs) -> TransactionAsyncResponse:
+    transaction, metadata, problems, results = _fetch_all(ctx, [
+        lambda: get_transaction(ctx, id, **kwargs),
+        lambda: get_transaction_metadata(ctx, id, **kwargs),
+        lambda: get_transaction_problems(ctx, id, **kwargs),
+        lambda: get_transaction_results(ctx, id, **kwargs),
+    ])
+    return TransactionAsyncResponse(transaction, metadata, results, problems)
 
 
 def exec_async(
@@ -948,11 +1834,276 @@ def exec_async(
 ) -> TransactionAsyncResponse:
     tx = TransactionAsync(database, engine, readonly=readonly)
     rsp = tx.run(ctx, command, language=language, inputs=inputs, **kwargs)
+    return _transaction_async_response(rsp, ctx.json_codec)
+
 
+# Returns the TransactionAsyncResponse for the given TransactionAsync.run
+# result, which only carries the transaction when it runs asynchronously.
+def _transaction_async_response(rsp: Union[dict, list], codec: rest.JsonCodec = None) -> TransactionAsyncResponse:
     if isinstance(rsp, dict):
         return TransactionAsyncResponse(rsp, None, None, None)
 
-    return _parse_transaction_async_response(rsp)
+    return _parse_transaction_async_response(rsp, codec)
+
+
+_BATCH_PREFIX = "rai_batch"
+
+
+# Wraps the given query in a module, exporting its output as
+# `output[:name]`, so it doesn't interfere with the other queries of the
+# batch.
+def _batch_query(name: str, query: str) -> str:
+    return f"module {name}\n{query}\nend\ndef output[:{name}] = {name}[:output]\n"
+
+
+# Answers the string value of the given constant type argument, if any.
+def _constant_string(arg) -> str:
+    from .pb import schema_pb2
+
+    if arg.tag != schema_pb2.CONSTANT_TYPE:
+        return None
+    values = arg.constant_type.value.arguments
+    if len(values) != 1 or values[0].tag not in (schema_pb2.STRING, schema_pb2.SYMBOL):
+        return None
+    return values[0].string_val.decode()
+
+
+# Returns the name of the batch query that produced the given result, along
+# with the result's relation id once the batch name has been removed.
+def _batch_relation(relation_id: str, relation) -> tuple:
+    parts = relation_id.split("/")
+    name = None
+    if len(parts) > 2 and parts[1] == ":output" and parts[2].startswith(f":{_BATCH_PREFIX}"):
+        name = parts[2][1:]
+    elif relation is not None:
+        args = relation.relation_id.arguments
+        if len(args) > 1 and _constant_string(args[0]) == "output":
+            name = _constant_string(args[1])
+    if name is not None and f":{name}" in parts:
+        parts.remove(f":{name}")
+    return name, "/".join(parts)
+
+
+# Splits the response of a batch into a response per query. The problems of
+# the batch can't be attributed to a query, so they are shared.
+def _split_batch_response(rsp: TransactionAsyncResponse, names: List[str]) -> List[TransactionAsyncResponse]:
+    from .pb.message_pb2 import MetadataInfo
+
+    rsps = {}
+    items = {}
+    for name in names:
+        rsps[name] = TransactionAsyncResponse(
+            rsp.transaction,
+            MetadataInfo() if rsp.metadata is not None else None,
+            None,
+            rsp.problems,
+        )
+        items[name] = []
+    relations = {}
+    if rsp.metadata is not None:
+        relations = {relation.file_name: relation for relation in rsp.metadata.relations}
+
+    for batch_relation_id, stream, table in _result_items(rsp.results):
+        relation = relations.get(batch_relation_id)
+        name, relation_id = _batch_relation(batch_relation_id, relation)
+        target = rsps.get(name)
+        if target is None:
+            continue
+        items[name].append((relation_id, stream, table))
+        if relation is not None:
+            metadata = target.metadata.relations.add()
+            metadata.CopyFrom(relation)
+            metadata.file_name = relation_id
+            del metadata.relation_id.arguments[1]
+
+    if rsp.results is not None:
+        for name in names:
+            rsps[name].results = TransactionResults._of(items[name])
+    return [rsps[name] for name in names]
+
+
+# Runs the given independent readonly queries in a single transaction, and
+# returns a response per query. Each query is wrapped in its own module, so
+# relations defined by one query are not visible to the others. The `inputs`
+# are shared by all queries.
+def exec_batch(
+    ctx: Context,
+    database: str,
+    engine: str,
+    queries: List[str],
+    inputs: dict = None,
+    **kwargs
+) -> List[TransactionAsyncResponse]:
+    names = [f"{_BATCH_PREFIX}{i}" for i in range(len(queries))]
+    command = "\n".join(_batch_query(name, query) for name, query in zip(names, queries))
+    rsp = exec(ctx, database, engine, command, inputs=inputs, readonly=True, **kwargs)
+    return _split_batch_response(rsp, names)
+
+
+# A future for the response of a transaction submitted to a
+# TransactionExecutor. The future stays pending until its transaction
+# completes, so it can be cancelled while the transaction runs, in which
+# case the transaction is cancelled on the server, and `result` raises
+# `CancelledError`.
+class TransactionFuture(Future):
+    def __init__(self, cancel_transaction):
+        super().__init__()
+        self._cancel_transaction = cancel_transaction
+        self._lock = threading.Lock()
+        self.transaction_id = None
+
+    def cancel(self) -> bool:
+        with self._lock:
+            if not super().cancel():
+                return False
+            id = self.transaction_id
+        # notifies `wait` and `as_completed` callers right away, rather than
+        # once the transaction completes
+        self.set_running_or_notify_cancel()
+        # otherwise the transaction is cancelled once it's created
+        if id is not None:
+            self._cancel_transaction(id)
+        return True
+
+    # Sets the result, or exception, of the future unless it was cancelled.
+    def _finish(self, result=None, exception: BaseException = None):
+        with self._lock:
+            if self.cancelled() or not self.set_running_or_notify_cancel():
+                return
+        if exception is not None:
+            self.set_exception(exception)
+        else:
+            self.set_result(result)
+
+    # Records the id of the created transaction, and answers if the
+    # transaction should keep running.
+    def _set_transaction_id(self, id: str) -> bool:
+        with self._lock:
+            self.transaction_id = id
+            cancelled = self.cancelled()
+        if cancelled:
+            self._cancel_transaction(id)
+        return not cancelled
+
+
+# Runs transactions on a bounded pool of worker threads, allowing at most
+# `max_per_engine` transactions to run concurrently on each engine.
+# Transactions over the engine limit are queued without occupying a worker.
+class TransactionExecutor(object):
+    def __init__(self, ctx: Context, max_workers: int = 8, max_per_engine: int = None):
+        if max_per_engine is not None and max_per_engine < 1:
+            raise ValueError("max_per_engine must be a positive integer")
+        self._ctx = ctx
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rai-executor")
+        self.max_per_engine = max_per_engine
+        self._running = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        self._shutdown = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown(wait=True)
+
+    # Submits the given query, accepts the same arguments as `exec`.
+    def submit(
+        self,
+        database: str,
+        engine: str,
+        command: str,
+        inputs: dict = None,
+        readonly: bool = True,
+        language: str = "",
+        **kwargs,
+    ) -> TransactionFuture:
+        _with_deadline(kwargs)
+        future = TransactionFuture(self._cancel_transaction)
+        args = (database, engine, command, inputs, readonly, language)
+        task = (future, args, kwargs)
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot submit transactions after shutdown")
+            running = self._running.get(engine, 0)
+            if self.max_per_engine is not None and running >= self.max_per_engine:
+                self._pending.setdefault(engine, deque()).append(task)
+                return future
+            self._running[engine] = running + 1
+        self._pool.submit(self._run, *task)
+        return future
+
+    # Shuts the executor down. When `wait` is true, waits for the queued and
+    # running transactions to complete, otherwise fails the queued ones.
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            self._shutdown = True
+            if wait:
+                self._released.wait_for(lambda: not any(self._pending.values()))
+            pending, self._pending = self._pending, {}
+        for tasks in pending.values():
+            for future, _, _ in tasks:
+                future._finish(exception=RuntimeError("executor shut down"))
+        self._pool.shutdown(wait=wait)
+
+    def _run(self, future: TransactionFuture, args: tuple, kwargs: dict):
+        try:
+            if not future.cancelled():
+                self._exec(future, args, kwargs)
+        finally:
+            self._release(args[1])
+
+    def _exec(self, future: TransactionFuture, args: tuple, kwargs: dict):
+        database, engine, command, inputs, readonly, language = args
+        try:
+            start_time = time.time()
+            txn = exec_async(
+                self._ctx, database, engine, command,
+                readonly=readonly, inputs=inputs, language=language,
+                deadline=kwargs.get("deadline"),
+            )
+            if not future._set_transaction_id(txn.transaction["id"]):
+                return
+            rsp = _wait_transaction(self._ctx, txn, start_time, command=command, **kwargs)
+        except BaseException as e:
+            future._finish(exception=e)
+        else:
+            future._finish(rsp)
+
+    # Cancels the given transaction on the server from a worker, so that
+    # `TransactionFuture.cancel` doesn't wait for, or fail with, the request.
+    def _cancel_transaction(self, id: str):
+        try:
+            self._pool.submit(self._cancel, id)
+        except RuntimeError:  # the pool was shut down
+            self._cancel(id)
+
+    def _cancel(self, id: str):
+        try:
+            cancel_transaction(self._ctx, id, timeout=_CANCEL_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"executor: failed to cancel transaction {id}: {e}")
+
+    # Starts the next transaction queued for the given engine, if any.
+    def _release(self, engine: str):
+        with self._lock:
+            pending = self._pending.get(engine)
+            if not pending:
+                self._running[engine] -= 1
+                return
+            task = pending.popleft()
+            self._released.notify_all()
+        try:
+            self._pool.submit(self._run, *task)
+        except RuntimeError as e:  # the pool was shut down without waiting
+            task[0]._finish(exception=e)
+            self._release(engine)
+
+
+# Yields the given futures as they complete.
+def as_completed(futures, timeout: float = None):
+    return concurrent.futures.as_completed(futures, timeout=timeout)
 
 
 create_compute = create_engine  # deprecated, use create_engine
@@ -0,0 +1,286 @@
+# Copyright 2021 RelationalAI, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Client side cache of readonly query results."""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import pyarrow as pa
+
+__all__ = ["ResultCache"]
+
+logger = logging.getLogger(__package__)
+
+_RESPONSE_FILE = "response.json"
+_METADATA_FILE = "metadata.pb"
+
+
+class _Entry(object):
+    def __init__(self, rsp, nbytes: int, expires: float):
+        self.rsp = rsp
+        self.nbytes = nbytes
+        self.expires = expires
+
+
+# Returns an approximation of the memory held by the given response,
+# without decoding its results.
+def _nbytes(rsp) -> int:
+    from .api import TransactionResults
+
+    if isinstance(rsp.results, TransactionResults):
+        return rsp.results.nbytes
+    return sum(result["table"].nbytes for result in rsp.results or [])
+
+
+# Returns a copy of the given response, so that callers can't change the
+# cached one.
+def _copy(rsp):
+    from .api import _copy_response
+
+    return _copy_response(rsp)
+
+
+# An in-memory cache of transaction responses, keyed by query, with LRU
+# eviction once the size of the cached tables exceeds `max_bytes`, and
+# entries expiring after `ttl` seconds. When a `directory` is given,
+# responses are also written there as Arrow IPC files, which are memory
+# mapped when read back, so they survive eviction and process restarts. The
+# directory is also bounded by `max_bytes`, its least recently used entries
+# and expired entries are removed when a response is cached. To use it with
+# `exec`:
+#
+#     ctx.result_cache = ResultCache(max_bytes=256 * 1024 * 1024, ttl=300)
+class ResultCache(object):
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float = None, directory: str = None):
+        if max_bytes < 0:
+            raise ValueError("max_bytes must be a non-negative integer")
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.directory = directory
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        # the (size, expiry time, last use time) of the directory entries,
+        # scanned on first use
+        self._files = None
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    # Returns the cached response for the given key, or None. Responses read
+    # from the directory are also kept in memory, so later hits don't read
+    # the directory again.
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.expires is None or now < entry.expires:
+                    self._entries.move_to_end(key)
+                    return _copy(entry.rsp)
+                self._remove(key)
+        if self.directory is None:
+            return None
+        result = self._read(key, now)
+        if result is None:
+            return None
+        rsp, expires = result
+        self._insert(key, rsp, expires)
+        return _copy(rsp)
+
+    # Caches the given response, only responses of completed transactions
+    # are cached.
+    def put(self, key: str, rsp):
+        if not rsp.transaction or rsp.transaction.get("state") != "COMPLETED":
+            return
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        self._insert(key, _copy(rsp), expires)
+        if self.directory is not None:
+            self._write(key, rsp, expires)
+            self._sweep()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+            self._files = None
+        if self.directory is not None:
+            for name in os.listdir(self.directory):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    # Adds the given response to the in-memory entries, unless it's larger
+    # than `max_bytes`, evicting the least recently used entries.
+    def _insert(self, key: str, rsp, expires: float):
+        nbytes = _nbytes(rsp)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(rsp, nbytes, expires)
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self._nbytes -= entry.nbytes
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    # Writes the response to a temporary directory which is then renamed, so
+    # readers never see partially written entries. Results are written as
+    # Arrow streams, results that haven't been decoded are written as is.
+    def _write(self, key: str, rsp, expires: float):
+        from .api import _result_items
+
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix=".tmp-")
+        try:
+            relations = []
+            for i, (relation_id, stream, table) in enumerate(_result_items(rsp.results)):
+                filename = f"{i}.arrows"
+                if stream is not None:
+                    with open(os.path.join(tmp, filename), "wb") as f:
+                        f.write(stream)
+                else:
+                    with pa.OSFile(os.path.join(tmp, filename), "wb") as sink:
+                        with pa.ipc.new_stream(sink, table.schema) as writer:
+                            writer.write_table(table)
+                relations.append({"relationId": relation_id, "file": filename})
+            if rsp.metadata is not None:
+                with open(os.path.join(tmp, _METADATA_FILE), "wb") as f:
+                    f.write(rsp.metadata.SerializeToString())
+            with open(os.path.join(tmp, _RESPONSE_FILE), "w") as f:
+                json.dump({
+                    "expires": expires,
+                    "transaction": rsp.transaction,
+                    "problems": rsp.problems,
+                    "results": relations,
+                }, f)
+            path = self._path(key)
+            shutil.rmtree(path, ignore_errors=True)
+            os.replace(tmp, path)
+            with self._lock:
+                if self._files is not None:
+                    self._files[key] = (_size(path), expires, time.time())
+        except Exception as e:
+            logger.warning(f"failed to write result cache entry {key}: {e}")
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    # Removes the expired entries of the directory, and its least recently
+    # used entries while it's larger than `max_bytes`.
+    def _sweep(self):
+        now = time.time()
+        with self._lock:
+            if self._files is None:
+                self._files = self._scan()
+            files = self._files
+            for key, (_, expires, _) in list(files.items()):
+                if expires is not None and now >= expires:
+                    self._remove_file(key)
+            nbytes = sum(size for size, _, _ in files.values())
+            for key in sorted(files, key=lambda key: files[key][2]):
+                if nbytes <= self.max_bytes:
+                    break
+                nbytes -= files[key][0]
+                self._remove_file(key)
+
+    # Returns the (size, expiry time, last use time) of the entries of the
+    # directory, including those written by other processes.
+    def _scan(self) -> dict:
+        result = {}
+        for name in os.listdir(self.directory):
+            if name.startswith(".tmp-"):
+                continue
+            path = self._path(name)
+            try:
+                with open(os.path.join(path, _RESPONSE_FILE)) as f:
+                    expires = json.load(f)["expires"]
+                result[name] = (_size(path), expires, os.path.getmtime(path))
+            except Exception:
+                # partially removed, or not an entry
+                continue
+        return result
+
+    def _remove_file(self, key: str):
+        self._files.pop(key, None)
+        shutil.rmtree(self._path(key), ignore_errors=True)
+
+    # Returns the response of the given directory entry and its expiry time,
+    # or None.
+    def _read(self, key: str, now: float):
+        from .api import TransactionAsyncFile, TransactionAsyncResponse, TransactionResults, _parse_metadata_proto
+
+        path = self._path(key)
+        try:
+            with open(os.path.join(path, _RESPONSE_FILE)) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"failed to read result cache entry {key}: {e}")
+            return None
+        if data["expires"] is not None and now >= data["expires"]:
+            with self._lock:
+                if self._files is not None:
+                    self._files.pop(key, None)
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+        try:
+            # results are decoded lazily from the mapped files
+            files = []
+            for relation in data["results"]:
+                stream = pa.memory_map(os.path.join(path, relation["file"])).read_buffer()
+                files.append(TransactionAsyncFile(
+                    relation["relationId"], relation["file"], "application/vnd.apache.arrow.stream", stream
+                ))
+            results = TransactionResults(files)
+            metadata = None
+            if os.path.exists(os.path.join(path, _METADATA_FILE)):
+                with open(os.path.join(path, _METADATA_FILE), "rb") as f:
+                    metadata = _parse_metadata_proto(f.read())
+        except Exception as e:
+            logger.warning(f"failed to read result cache entry {key}: {e}")
+            return None
+        # the modification time of the entry is its last use time for other
+        # caches sharing the directory
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            if self._files is not None and key in self._files:
+                size, expires, _ = self._files[key]
+                self._files[key] = (size, expires, now)
+        rsp = TransactionAsyncResponse(data["transaction"], metadata, results, data["problems"])
+        return rsp, data["expires"]
+
+
+# Returns the size of the files in the given directory.
+def _size(path: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
@@ -0,0 +1,406 @@
+# Copyright 2021 RelationalAI, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An in-process mock of the RelationalAI REST API, to test and benchmark
+the SDK without a RAI account."""
+
+import json
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+import pyarrow as pa
+
+from . import api
+from .credentials import ClientCredentials
+from .pb import schema_pb2
+from .pb.message_pb2 import MetadataInfo
+
+__all__ = ["MockServer"]
+
+_BOUNDARY = "rai-mock-boundary"
+
+# (method, path pattern, handler method name)
+_ROUTES = [
+    ("POST", r"/oauth2/token", "_token"),
+    ("POST", r"/transaction", "_run_transaction"),
+    ("GET", r"/transactions", "_list_transactions"),
+    ("POST", r"/transactions", "_create_transaction"),
+    ("GET", r"/transactions/([^/]+)", "_get_transaction"),
+    ("POST", r"/transactions/([^/]+)/cancel", "_cancel_transaction"),
+    ("GET", r"/transactions/([^/]+)/results", "_get_results"),
+    ("GET", r"/transactions/([^/]+)/metadata", "_get_metadata"),
+    ("GET", r"/transactions/([^/]+)/problems", "_get_problems"),
+    ("GET", r"/compute", "_list_engines"),
+    ("PUT", r"/compute", "_create_engine"),
+    ("PATCH", r"/compute/([^/]+)", "_update_engine"),
+    ("DELETE", r"/compute", "_delete_engine"),
+    ("GET", r"/database", "_list_databases"),
+    ("PUT", r"/database", "_create_database"),
+    ("DELETE", r"/database", "_delete_database"),
+]
+
+
+class _NotFound(Exception):
+    pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately
+    disable_nagle_algorithm = True
+
+    def do_DELETE(self):
+        self._handle()
+
+    def do_GET(self):
+        self._handle()
+
+    def do_PATCH(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def do_PUT(self):
+        self._handle()
+
+    def _handle(self):
+        mock = self.server.mock
+        path, _, query = self.path.partition("?")
+        query = dict(parse_qsl(query))
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            data = self._read_chunked()
+        else:
+            data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        data = json.loads(data) if data else None
+        mock._record(self.command, self.path)
+        if mock.latency:
+            time.sleep(mock.latency)
+        try:
+            status, content_type, body = mock._dispatch(self.command, path, query, data)
+        except _NotFound as e:
+            status, content_type, body = 404, "application/json", _json({"message": str(e)})
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_chunked(self) -> bytes:
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b";")[0], 16)
+            if size == 0:
+                self.rfile.readline()  # no trailers
+                return b"".join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # clients closing their connections aren't errors
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def _json(value) -> bytes:
+    return json.dumps(value).encode("utf8")
+
+
+def _constant(relation_id, value: str):
+    arg = relation_id.arguments.add()
+    arg.tag = schema_pb2.CONSTANT_TYPE
+    arg.constant_type.rel_type.tag = schema_pb2.PRIMITIVE_TYPE
+    arg.constant_type.rel_type.primitive_type = schema_pb2.STRING
+    v = arg.constant_type.value.arguments.add()
+    v.tag = schema_pb2.STRING
+    v.string_val = value.encode()
+
+
+# Returns the metadata and the multipart results body of a transaction with
+# the given number of relations, each with `rows` rows of an Int64 column.
+def _results(relations: int, rows: int) -> tuple:
+    metadata = MetadataInfo()
+    table = pa.table({"v1": pa.array(range(rows), type=pa.int64())})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    content = sink.getvalue().to_pybytes()
+    body = []
+    for i in range(relations):
+        name = f"/:output/:r{i}/Int64"
+        relation = metadata.relations.add()
+        relation.file_name = name
+        _constant(relation.relation_id, "output")
+        _constant(relation.relation_id, f"r{i}")
+        arg = relation.relation_id.arguments.add()
+        arg.tag = schema_pb2.PRIMITIVE_TYPE
+        arg.primitive_type = schema_pb2.INT_64
+        body.append(
+            f"--{_BOUNDARY}\r\n"
+            f'Content-Disposition: form-data; name="{name}"; filename="{name}"\r\n'
+            "Content-Type: application/vnd.apache.arrow.stream\r\n\r\n".encode()
+        )
+        body.append(content)
+        body.append(b"\r\n")
+    body.append(f"--{_BOUNDARY}--\r\n".encode())
+    return metadata.SerializeToString(), b"".join(body)
+
+
+# A mock of the RAI REST API, served on a local port by a background thread.
+# It implements the transaction (v1 and v2), engine and database endpoints
+# used by `railib.api`, and the OAuth token endpoint, keeping its state in
+# memory. Every response is delayed by `latency` seconds, transactions
+# complete `duration` seconds after they are created, and their results are
+# `relations` relations of `rows` rows each. Status requests with a `wait`
+# parameter are held open until the transaction completes, unless
+# `long_poll` is disabled. The settings can be changed while the server
+# runs, and the requests it received are recorded in `requests`, as
+# (method, path) pairs. To use it:
+#
+#     with MockServer(duration=0.5, rows=1000) as server:
+#         ctx = server.context()
+#         rsp = api.exec(ctx, "db", "engine", "def output = 1")
+class MockServer(object):
+    def __init__(
+        self,
+        latency: float = 0,
+        duration: float = 0,
+        relations: int = 1,
+        rows: int = 10,
+        long_poll: bool = True,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.latency = latency
+        self.duration = duration
+        self.relations = relations
+        self.rows = rows
+        self.long_poll = long_poll
+        self.requests = []
+        self._host = host
+        self._port = port
+        self._server = None
+        self._transactions = {}
+        self._engines = {}
+        self._databases = {}
+        self._payloads = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def port(self) -> int:
+        return self._server.server_port
+
+    @property
+    def url(self) -> str:
+        return f"http://{self._host}:{self.port}"
+
+    def start(self):
+        self._server = _Server((self._host, self._port), _Handler)
+        self._server.mock = self
+        threading.Thread(
+            target=self._server.serve_forever, args=(0.01,), name="rai-mock-server", daemon=True
+        ).start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    # Returns a context for the server, authenticating with its OAuth token
+    # endpoint when `authenticate` is set. Other arguments are passed to
+    # `api.Context`.
+    def context(self, authenticate: bool = False, **kwargs) -> api.Context:
+        if authenticate:
+            kwargs["credentials"] = ClientCredentials(
+                "mock-client-id", "mock-client-secret", f"{self.url}/oauth2/token"
+            )
+        return api.Context(host=self._host, port=str(self.port), scheme="http", **kwargs)
+
+    def _record(self, method: str, path: str):
+        with self._lock:
+            self.requests.append((method, path))
+
+    def _dispatch(self, method: str, path: str, query: dict, data) -> tuple:
+        for route_method, pattern, name in _ROUTES:
+            if route_method != method:
+                continue
+            match = re.fullmatch(pattern, path)
+            if match is not None:
+                return getattr(self, name)(query, data, *match.groups())
+        raise _NotFound(f"{method} {path} not found")
+
+    def _token(self, query: dict, data) -> tuple:
+        token = {"access_token": uuid.uuid4().hex, "expires_in": 3600, "scope": "run:transaction"}
+        return 200, "application/json", _json(token)
+
+    # transactions
+
+    # The v1 transaction endpoint, used by `exec_v1`, `load_csv` and
+    # `load_json`.
+    def _run_transaction(self, query: dict, data) -> tuple:
+        if self.duration:
+            time.sleep(self.duration)
+        actions = [{"name": a["name"], "type": "LabeledActionResult", "result": {}} for a in data["actions"]]
+        rsp = {"aborted": False, "output": [], "problems": [], "actions": actions, "type": "TransactionResult"}
+        return 200, "application/json", _json(rsp)
+
+    def _transaction(self, id: str) -> dict:
+        with self._lock:
+            txn = self._transactions.get(id)
+            if txn is None:
+                raise _NotFound(f"transaction {id} not found")
+            if txn["state"] not in ("COMPLETED", "ABORTED") and time.time() >= txn["completes_at"]:
+                txn["state"] = "COMPLETED"
+            return {k: v for k, v in txn.items() if k != "completes_at"}
+
+    def _list_transactions(self, query: dict, data) -> tuple:
+        ids = list(self._transactions)
+        return 200, "application/json", _json({"transactions": [self._transaction(id) for id in ids]})
+
+    def _create_transaction(self, query: dict, data) -> tuple:
+        id = str(uuid.uuid4())
+        now = time.time()
+        txn = {
+            "id": id,
+            "state": "CREATED",
+            "database": data.get("dbname"),
+            "engine": data.get("engine_name"),
+            "query": data.get("query"),
+            "read_only": data.get("readonly"),
+            "created_on": int(now * 1000),
+            "completes_at": now + self.duration,
+        }
+        with self._lock:
+            self._transactions[id] = txn
+        return 200, "application/json", _json({"id": id, "state": "CREATED"})
+
+    def _get_transaction(self, query: dict, data, id: str) -> tuple:
+        txn = self._transaction(id)
+        if self.long_poll and "wait" in query and txn["state"] not in ("COMPLETED", "ABORTED"):
+            with self._lock:
+                completes_at = self._transactions[id]["completes_at"]
+            time.sleep(max(0, min(completes_at - time.time(), float(query["wait"]))))
+            txn = self._transaction(id)
+        return 200, "application/json", _json({"transaction": txn})
+
+    def _cancel_transaction(self, query: dict, data, id: str) -> tuple:
+        txn = self._transaction(id)
+        if txn["state"] not in ("COMPLETED", "ABORTED"):
+            with self._lock:
+                self._transactions[id]["state"] = "ABORTED"
+        return 200, "application/json", _json({})
+
+    def _payload(self) -> tuple:
+        key = (self.relations, self.rows)
+        with self._lock:
+            payload = self._payloads.get(key)
+            if payload is None:
+                payload = self._payloads[key] = _results(*key)
+            return payload
+
+    def _get_results(self, query: dict, data, id: str) -> tuple:
+        self._transaction(id)
+        return 200, f"multipart/form-data; boundary={_BOUNDARY}", self._payload()[1]
+
+    def _get_metadata(self, query: dict, data, id: str) -> tuple:
+        self._transaction(id)
+        return 200, "application/x-protobuf", self._payload()[0]
+
+    def _get_problems(self, query: dict, data, id: str) -> tuple:
+        self._transaction(id)
+        return 200, "application/json", _json([])
+
+    # engines and databases
+
+    def _list(self, resources: dict, query: dict) -> list:
+        with self._lock:
+            result = list(resources.values())
+        for key in ("name", "state"):
+            if query.get(key):
+                result = [r for r in result if r[key] == query[key]]
+        return result
+
+    def _get(self, resources: dict, kind: str, name: str) -> dict:
+        resource = resources.get(name)
+        if resource is None:
+            raise _NotFound(f"{kind} {name} not found")
+        return resource
+
+    def _list_engines(self, query: dict, data) -> tuple:
+        return 200, "application/json", _json({"computes": self._list(self._engines, query)})
+
+    def _create_engine(self, query: dict, data) -> tuple:
+        engine = {
+            "name": data["name"],
+            "size": data.get("size"),
+            "region": data.get("region"),
+            "state": "PROVISIONED",
+            "created_on": int(time.time() * 1000),
+        }
+        with self._lock:
+            self._engines[engine["name"]] = engine
+        return 200, "application/json", _json({"compute": engine})
+
+    def _update_engine(self, query: dict, data, name: str) -> tuple:
+        with self._lock:
+            engine = self._get(self._engines, "engine", name)
+            engine["state"] = "SUSPENDED" if data.get("suspend") else "PROVISIONED"
+        return 200, "application/json", _json({"compute": engine})
+
+    def _delete_engine(self, query: dict, data) -> tuple:
+        with self._lock:
+            engine = self._get(self._engines, "engine", data["name"])
+            del self._engines[engine["name"]]
+        status = {"name": engine["name"], "state": "DELETING", "message": "engine deleted"}
+        return 200, "application/json", _json({"status": status})
+
+    def _list_databases(self, query: dict, data) -> tuple:
+        return 200, "application/json", _json({"databases": self._list(self._databases, query)})
+
+    def _create_database(self, query: dict, data) -> tuple:
+        database = {
+            "name": data["name"],
+            "region": "us-east",
+            "state": "CREATED",
+            "created_on": int(time.time() * 1000),
+        }
+        with self._lock:
+            if data.get("source_name"):
+                self._get(self._databases, "database", data["source_name"])
+            self._databases[database["name"]] = database
+        return 200, "application/json", _json({"database": database})
+
+    def _delete_database(self, query: dict, data) -> tuple:
+        with self._lock:
+            database = self._get(self._databases, "database", data["name"])
+            del self._databases[database["name"]]
+        return 200, "application/json", _json({"name": database["name"], "message": "database deleted"})
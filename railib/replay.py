@@ -0,0 +1,283 @@
+# Copyright 2021 RelationalAI, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Transports that record the HTTP traffic of a context to an archive, and
+serve the recorded responses offline, eg to run a workload against another
+SDK version with the recorded server behavior and timings, without network
+access. The workload itself is run by the caller, the replay only answers
+its requests."""
+
+import bisect
+import hashlib
+import http.client
+import io
+import json
+import threading
+import time
+import zipfile
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+from urllib.request import Request
+
+from .rest import ConnectionPool, Transport
+
+__all__ = ["RecordingTransport", "ReplayTransport"]
+
+_FORMAT_VERSION = 1
+_INDEX_FILE = "index.json"
+_BODIES_DIR = "bodies/"
+
+# request headers that are not recorded
+_SECRET_HEADERS = ("authorization", "cookie")
+# JSON keys whose values are not recorded, eg in access token exchanges
+_SECRET_KEYS = ("client_secret", "access_token")
+_REDACTED = "redacted"
+
+# connection errors that are replayed as such, others are replayed as
+# `URLError`s or `OSError`s with the recorded message
+_ERRORS = {
+    cls.__name__: cls for cls in (
+        BrokenPipeError,
+        ConnectionAbortedError,
+        ConnectionError,
+        ConnectionRefusedError,
+        ConnectionResetError,
+        TimeoutError,
+    )
+}
+
+
+# A response read from a recording, a file like object over its body.
+class _Response(io.BytesIO):
+    def __init__(self, method: str, url: str, status: int, reason: str, headers, body: bytes):
+        super().__init__(body)
+        self._method = method
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.version = 11
+
+
+def _headers(items) -> http.client.HTTPMessage:
+    result = http.client.HTTPMessage()
+    for name, value in items:
+        result[name] = value
+    return result
+
+
+# Returns the path and query of the given url, so that recordings can be
+# replayed against another host.
+def _target(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.path}?{parts.query}" if parts.query else parts.path
+
+
+def _digest(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()
+
+
+# Replaces the secrets of the given JSON object body.
+def _redact(body: bytes) -> bytes:
+    if not body or not any(key.encode() in body for key in _SECRET_KEYS):
+        return body
+    try:
+        value = json.loads(body)
+    except ValueError:
+        return body
+    if not isinstance(value, dict):
+        return body
+    for key in _SECRET_KEYS:
+        if key in value:
+            value[key] = _REDACTED
+    return json.dumps(value).encode("utf-8")
+
+
+# Records the requests sent with the wrapped transport, along with their
+# responses, timings and connection errors, to a zip archive at `path`.
+# Bodies are compressed, and stored once however many responses share them,
+# eg the polls of a long running transaction. Authorization headers and
+# client secrets and access tokens in JSON bodies are not recorded. The
+# archive is written when the transport is closed:
+#
+#     with RecordingTransport("traffic.zip") as transport:
+#         ctx = api.Context(..., transport=transport)
+#         ...
+#
+# Response bodies are read whole before being returned, so recording adds
+# latency to streamed results.
+class RecordingTransport(Transport):
+    def __init__(self, path: str, transport: Transport = None):
+        self.path = path
+        self.transport = transport if transport is not None else ConnectionPool()
+        self._exchanges = []
+        self._start_time = None
+        self._lock = threading.Lock()
+        self._archive = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED)
+        self._bodies = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def urlopen(self, req: Request, timeout: float = None):
+        now = time.monotonic()
+        with self._lock:
+            if self._start_time is None:
+                self._start_time = now
+            offset = now - self._start_time
+        method = req.get_method()
+        exchange = {
+            "offset": offset,
+            "method": method,
+            "url": req.full_url,
+            "request_headers": [
+                [name, value] for name, value in req.header_items() if name.lower() not in _SECRET_HEADERS
+            ],
+            "request_body": self._write_body(_redact(req.data)) if req.data else None,
+        }
+        try:
+            rsp = self.transport.urlopen(req, timeout)
+            with rsp:
+                body = rsp.read()
+        except HTTPError as e:
+            body = e.read()
+            e.close()
+            self._record(exchange, now, e.code, e.reason, e.headers, body)
+            raise HTTPError(e.url, e.code, e.reason, e.headers, io.BytesIO(body))
+        except OSError as e:
+            reason = e.reason if isinstance(e, URLError) else e
+            exchange["error"] = {
+                "type": type(reason).__name__ if type(reason).__name__ in _ERRORS else None,
+                "url_error": isinstance(e, URLError),
+                "message": str(reason),
+            }
+            self._record(exchange, now)
+            raise
+        self._record(exchange, now, rsp.status, rsp.reason, rsp.headers, body)
+        return _Response(method, req.full_url, rsp.status, rsp.reason, rsp.headers, body)
+
+    def _record(self, exchange: dict, start_time: float, status=None, reason=None, headers=None, body=None):
+        exchange["duration"] = time.monotonic() - start_time
+        if status is not None:
+            exchange["status"] = status
+            exchange["reason"] = reason
+            exchange["headers"] = [[name, value] for name, value in headers.items()]
+            exchange["body"] = self._write_body(_redact(body))
+        with self._lock:
+            self._exchanges.append(exchange)
+
+    # Adds the given body to the archive, unless it's already there, and
+    # returns its name.
+    def _write_body(self, body: bytes) -> str:
+        name = _digest(body)
+        with self._lock:
+            if name not in self._bodies:
+                self._archive.writestr(_BODIES_DIR + name, body)
+                self._bodies.add(name)
+        return name
+
+    # Writes the index of the recorded requests and closes the archive, and
+    # the wrapped transport.
+    def close(self):
+        with self._lock:
+            if self._archive is None:
+                return
+            exchanges = sorted(self._exchanges, key=lambda exchange: exchange["offset"])
+            index = {"version": _FORMAT_VERSION, "exchanges": exchanges}
+            self._archive.writestr(_INDEX_FILE, json.dumps(index))
+            self._archive.close()
+            self._archive = None
+        self.transport.close()
+
+
+# Serves the responses recorded by a `RecordingTransport`, without network
+# access. Requests are matched to recorded ones by method, path, query and
+# body, falling back to method, path and query, so the replay doesn't depend
+# on the host, and responses take as long as they originally did, divided
+# by `speedup`. Among the matching requests, the one recorded last before
+# the time elapsed since the first replayed request, scaled by `speedup`, is
+# served, so polls see transactions complete at the recorded times whatever
+# the polling schedule of the SDK being replayed. With `speedup=None`,
+# responses are served immediately and the matching requests are served in
+# recorded order instead, repeating the last one, eg:
+#
+#     transport = ReplayTransport("traffic.zip", speedup=10)
+#     ctx = api.Context(..., transport=transport)
+#
+# The recorded bodies are held in memory.
+class ReplayTransport(Transport):
+    def __init__(self, path: str, speedup: float = 1.0):
+        if speedup is not None and speedup <= 0:
+            raise ValueError("speedup must be positive")
+        self.path = path
+        self.speedup = speedup
+        with zipfile.ZipFile(path) as archive:
+            index = json.loads(archive.read(_INDEX_FILE))
+            if index.get("version") != _FORMAT_VERSION:
+                raise Exception(f"unsupported recording version {index.get('version')}")
+            self._bodies = {
+                name[len(_BODIES_DIR):]: archive.read(name)
+                for name in archive.namelist() if name.startswith(_BODIES_DIR)
+            }
+        self.exchanges = index["exchanges"]
+        self._matches = {}
+        for exchange in self.exchanges:
+            target = (exchange["method"], _target(exchange["url"]))
+            self._matches.setdefault(target + (exchange["request_body"],), []).append(exchange)
+            self._matches.setdefault(target, []).append(exchange)
+        self._offsets = {key: [exchange["offset"] for exchange in matches] for key, matches in self._matches.items()}
+        self._served = {}
+        self._start_time = None
+        self._lock = threading.Lock()
+
+    # Returns the recorded exchange to replay for the given request.
+    def _match(self, req: Request) -> dict:
+        target = (req.get_method(), _target(req.full_url))
+        key = target + (_digest(_redact(req.data)) if req.data else None,)
+        if key not in self._matches:
+            key = target
+        matches = self._matches.get(key)
+        if not matches:
+            raise Exception(f"no recorded response to {req.get_method()} {req.full_url}")
+        now = time.monotonic()
+        with self._lock:
+            if self._start_time is None:
+                self._start_time = now
+            if self.speedup is None:
+                i = self._served.get(key, 0)
+                self._served[key] = i + 1
+                return matches[min(i, len(matches) - 1)]
+        elapsed = (now - self._start_time) * self.speedup
+        i = bisect.bisect_right(self._offsets[key], elapsed)
+        return matches[max(0, i - 1)]
+
+    def urlopen(self, req: Request, timeout: float = None):
+        exchange = self._match(req)
+        if self.speedup is not None:
+            time.sleep(exchange["duration"] / self.speedup)
+        error = exchange.get("error")
+        if error is not None:
+            reason = _ERRORS[error["type"]](error["message"]) if error["type"] else error["message"]
+            if error["url_error"]:
+                raise URLError(reason)
+            raise reason if error["type"] else OSError(reason)
+        headers = _headers(exchange["headers"])
+        body = self._bodies[exchange["body"]]
+        status = exchange["status"]
+        if status >= 400:
+            raise HTTPError(req.full_url, status, exchange["reason"], headers, io.BytesIO(body))
+        return _Response(req.get_method(), req.full_url, status, exchange["reason"], headers, body)
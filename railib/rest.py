@@ -14,12 +14,30 @@
 
 """Low level HTTP interface to the RelationalAI REST API."""
 
+import http.client
 import json
 import logging
-from os import path, makedirs
-from urllib.error import URLError
+import random
+import socket
+import ssl
+import tempfile
+import threading
+import time
+import typing
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from os import path, makedirs, remove, replace, stat
+from urllib.error import HTTPError, URLError
 from urllib.parse import urlencode, urlsplit, quote
-from urllib.request import Request, urlopen
+from urllib.request import Request, getproxies, proxy_bypass, urlopen
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+    import msvcrt
 
 from .__init__ import __version__
 from .credentials import (
@@ -28,7 +46,25 @@ from .credentials import (
     ClientCredentials,
 )
 
-__all__ = ["Context", "get", "put", "post", "request"]
+__all__ = [
+    "CircuitBreaker",
+    "CircuitOpenError",
+    "ConnectionPool",
+    "Context",
+    "HedgingPolicy",
+    "JsonCodec",
+    "MsgspecCodec",
+    "OrjsonCodec",
+    "OverloadedError",
+    "RetryPolicy",
+    "Transport",
+    "UrllibTransport",
+    "default_json_codec",
+    "get",
+    "put",
+    "post",
+    "request",
+]
 
 
 ACCESS_KEY_TOKEN_KEY = "access_token"
@@ -44,16 +80,690 @@ SCOPE = "scope"
 logger = logging.getLogger(__package__)
 
 
-# Context contains the state required to make rAI REST API calls.
+# Response class used by pooled connections, it hands the connection back to
+# the pool once the body has been fully read.
+class _PooledResponse(http.client.HTTPResponse):
+    _release = None
+    _discard = None
+
+    def _close_conn(self):
+        super()._close_conn()
+        release, self._release, self._discard = self._release, None, None
+        if release is not None:
+            release()
+
+    def close(self):
+        # the body was not fully consumed, so the connection is left in an
+        # unknown state and can't be reused
+        if self.fp is not None:
+            discard, self._release, self._discard = self._discard, None, None
+            if discard is not None:
+                discard()
+        super().close()
+
+
+# Sends the HTTP requests made with a Context. `urlopen` sends the given
+# request and returns its response, a file like object with the `status`,
+# `reason`, `headers`, `version` and `url` of the response, and mirrors
+# `urllib.request.urlopen` when the request fails, raising `HTTPError` on
+# error status codes and `URLError` on connection failures. The `timeout`
+# applies to each blocking socket operation.
+class Transport(object):
+    def urlopen(self, req: Request, timeout: float = None):
+        raise NotImplementedError()
+
+    # Releases the resources held by the transport.
+    def close(self):
+        pass
+
+
+# Sends each request on a new connection, with `urllib.request.urlopen`.
+class UrllibTransport(Transport):
+    def urlopen(self, req: Request, timeout: float = None):
+        return _urlopen(req, timeout)
+
+
+# A thread-safe pool of persistent (keep-alive) HTTP connections, keyed by
+# (scheme, host, port). A connection is checked out for the duration of a
+# single request and returned to the pool once its response has been read.
+# At most `maxsize` idle connections are kept per key, and idle connections
+# older than `idle_timeout` seconds are evicted. This is the default
+# transport.
+class ConnectionPool(Transport):
+    def __init__(self, maxsize: int = 10, idle_timeout: float = 60):
+        if maxsize < 0:
+            raise ValueError("maxsize must be a non-negative integer")
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._ssl_context = None
+
+    def _new_connection(self, key: tuple):
+        scheme, host, port = key
+        if scheme == "https":
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            conn = http.client.HTTPSConnection(host, port, context=self._ssl_context)
+        else:
+            conn = http.client.HTTPConnection(host, port)
+        conn.response_class = _PooledResponse
+        return conn
+
+    # Returns an idle connection for the given key, or a new one if there
+    # is none, along with a flag indicating if the connection is reused.
+    def _get(self, key: tuple):
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.get(key)
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return conn, True
+                conn.close()
+        return self._new_connection(key), False
+
+    def _put(self, key: tuple, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, deque())
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    # Closes all idle connections.
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+    def close(self):
+        self.clear()
+
+    def _send(self, conn, req: Request, url: str, timeout: float):
+        # connections are reused across requests with different timeouts
+        conn.timeout = timeout if timeout is not None else socket.getdefaulttimeout()
+        if conn.sock is not None:
+            conn.sock.settimeout(conn.timeout)
+        conn.request(req.get_method(), url, body=req.data, headers=dict(req.header_items()))
+        return conn.getresponse()
+
+    # Issues the given request on a pooled connection.
+    def urlopen(self, req: Request, timeout: float = None):
+        parts = urlsplit(req.full_url)
+        scheme = parts.scheme.lower()
+        if scheme not in ("http", "https"):
+            return _urlopen(req, timeout)
+        # let urllib deal with proxies
+        if scheme in getproxies() and not proxy_bypass(parts.hostname):
+            return _urlopen(req, timeout)
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        url = parts.path or "/"
+        if parts.query:
+            url = f"{url}?{parts.query}"
+
+        conn, reused = self._get(key)
+        try:
+            try:
+                rsp = self._send(conn, req, url, timeout)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not reused:
+                    raise
+                # the server closed the idle connection, retry on a new one
+                conn.close()
+                conn = self._new_connection(key)
+                rsp = self._send(conn, req, url, timeout)
+        except OSError as e:
+            conn.close()
+            if isinstance(e, ConnectionError):
+                raise
+            raise URLError(e)
+        except BaseException:
+            conn.close()
+            raise
+
+        rsp.url = req.full_url
+        if not rsp.will_close:
+            rsp._release = lambda: self._put(key, conn)
+        rsp._discard = conn.close
+
+        if 300 <= rsp.status < 400:
+            # let urllib follow redirects
+            rsp.read()
+            return _urlopen(req, timeout)
+        if rsp.status >= 400:
+            raise HTTPError(req.full_url, rsp.status, rsp.reason, rsp.headers, rsp)
+        return rsp
+
+
+# Calls `urlopen`, only passing the timeout when there is one, so the
+# default socket timeout applies otherwise.
+def _urlopen(req: Request, timeout: float = None):
+    if timeout is None:
+        return urlopen(req)
+    return urlopen(req, timeout=timeout)
+
+
+# Decides which failed requests are retried, and how long to wait before
+# retrying them. Retries back off exponentially with full jitter, ie the
+# delay before retry `n` is random between 0 and `backoff * 2**n` seconds,
+# capped at `max_backoff`, unless the server asks for a specific delay with
+# a `Retry-After` header, in which case the request is retried after that
+# delay, or not at all if it's longer than `max_backoff`.
+#
+# Connection errors and `retry_statuses` responses are retried for
+# idempotent requests. Other requests, eg creating a transaction, are only
+# retried when the server can't have processed them, ie when the connection
+# was refused or the server answered 429 or 503.
+#
+# Retries are limited by a retry budget shared by all the requests made with
+# the policy: every request adds `budget_ratio` of a retry to the budget, up
+# to `budget` retries, and every retry takes one from it, so retries can't
+# multiply the load on a server that is failing most requests.
+class RetryPolicy(object):
+    retry_statuses = (429, 502, 503, 504)
+    idempotent_methods = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+    # statuses answered without processing the request
+    _rejected_statuses = (429, 503)
+
+    def __init__(
+        self,
+        retries: int = 0,
+        backoff: float = 0.1,
+        max_backoff: float = 20,
+        budget: float = 10,
+        budget_ratio: float = 0.1,
+    ):
+        if retries < 0:
+            raise ValueError("Retries must be a non-negative integer")
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget
+        self.budget_ratio = budget_ratio
+        self._tokens = budget
+        self._lock = threading.Lock()
+
+    # Answers if the request that failed with the given error may be retried.
+    def retryable(self, method: str, error: Exception, idempotent: bool = None) -> bool:
+        if idempotent is None:
+            idempotent = method.upper() in self.idempotent_methods
+        if isinstance(error, HTTPError):
+            if idempotent:
+                return error.code in self.retry_statuses
+            return error.code in self._rejected_statuses
+        if idempotent:
+            return True
+        reason = error.reason if isinstance(error, URLError) else error
+        return isinstance(reason, (ConnectionRefusedError, socket.gaierror))
+
+    # Returns the delay before the given retry (0 based) of a request that
+    # failed with the given error, or None if it shouldn't be retried.
+    def delay(self, retry: int, error: Exception = None) -> float:
+        retry_after = _retry_after(error) if isinstance(error, HTTPError) else None
+        if retry_after is not None:
+            return retry_after if retry_after <= self.max_backoff else None
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** retry))
+
+    # Records a request, adding to the retry budget.
+    def _deposit(self):
+        if self.budget is None:
+            return
+        with self._lock:
+            self._tokens = min(self.budget, self._tokens + self.budget_ratio)
+
+    # Takes a retry from the budget, answers False if there is none left.
+    def _withdraw(self) -> bool:
+        if self.budget is None:
+            return True
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+# Returns the delay, in seconds, requested by the `Retry-After` header of
+# the given error response, if any.
+def _retry_after(error: HTTPError) -> float:
+    value = error.headers.get("Retry-After") if error.headers is not None else None
+    if value is None:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# Raised, without sending the request, when the circuit breaker of the
+# request's host is open.
+class CircuitOpenError(Exception):
+    pass
+
+
+# Raised, without sending the request, when the context already has its
+# maximum number of outstanding requests.
+class OverloadedError(Exception):
+    pass
+
+
+_CLOSED = "closed"
+_OPEN = "open"
+_HALF_OPEN = "half-open"
+
+
+class _Circuit(object):
+    def __init__(self):
+        self.state = _CLOSED
+        self.outcomes = deque()  # (time, failed)
+        self.failures = 0
+        self.opened_at = 0
+        self.probes = 0
+
+
+# Tracks the outcome of the requests made to each host, and fails requests
+# fast, with `CircuitOpenError`, while the host is unhealthy. A host's
+# circuit opens when at least `failure_rate` of the requests of the last
+# `window` seconds failed, counting only once there are `min_requests` of
+# them. Connection errors, timeouts, 5xx and 429 responses, and requests
+# taking longer than `slow_call_duration` seconds count as failures. After
+# `open_duration` seconds the circuit is half open, and lets through up to
+# `probes` concurrent requests: it closes again if they succeed, and opens
+# again if they fail. To use it:
+#
+#     ctx = api.Context(..., circuit_breaker=rest.CircuitBreaker())
+class CircuitBreaker(object):
+    def __init__(
+        self,
+        failure_rate: float = 0.5,
+        min_requests: int = 10,
+        window: float = 30,
+        open_duration: float = 30,
+        slow_call_duration: float = None,
+        probes: int = 1,
+    ):
+        if not 0 < failure_rate <= 1:
+            raise ValueError("failure_rate must be in (0, 1]")
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.open_duration = open_duration
+        self.slow_call_duration = slow_call_duration
+        self.probes = probes
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    # Returns the state of the given host's circuit, one of "closed", "open"
+    # and "half-open".
+    def state(self, host: str) -> str:
+        with self._lock:
+            circuit = self._circuits.get(host)
+            if circuit is None:
+                return _CLOSED
+            if circuit.state == _OPEN and time.monotonic() - circuit.opened_at >= self.open_duration:
+                return _HALF_OPEN
+            return circuit.state
+
+    # Returns the result of calling `f`, a request to the given host, unless
+    # the host's circuit is open.
+    def call(self, host: str, f):
+        self._admit(host)
+        start_time = time.monotonic()
+        try:
+            result = f()
+        except BaseException as e:
+            self._record(host, _is_failure(e), time.monotonic() - start_time)
+            raise
+        self._record(host, False, time.monotonic() - start_time)
+        return result
+
+    def _admit(self, host: str):
+        with self._lock:
+            circuit = self._circuits.setdefault(host, _Circuit())
+            if circuit.state == _OPEN:
+                if time.monotonic() - circuit.opened_at < self.open_duration:
+                    raise CircuitOpenError(f"circuit breaker open for {host}")
+                circuit.state = _HALF_OPEN
+            if circuit.state == _HALF_OPEN:
+                if circuit.probes >= self.probes:
+                    raise CircuitOpenError(f"circuit breaker open for {host}")
+                circuit.probes += 1
+
+    def _record(self, host: str, failed: bool, duration: float):
+        if self.slow_call_duration is not None and duration >= self.slow_call_duration:
+            failed = True
+        now = time.monotonic()
+        with self._lock:
+            circuit = self._circuits.setdefault(host, _Circuit())
+            if circuit.state == _HALF_OPEN:
+                circuit.probes -= 1
+                if failed:
+                    self._open(host, circuit, now)
+                else:
+                    logger.info(f"circuit breaker closed for {host}")
+                    self._circuits[host] = _Circuit()
+                return
+            if circuit.state == _OPEN:
+                return  # admitted before the circuit opened
+            circuit.outcomes.append((now, failed))
+            circuit.failures += failed
+            while circuit.outcomes[0][0] < now - self.window:
+                _, expired = circuit.outcomes.popleft()
+                circuit.failures -= expired
+            count = len(circuit.outcomes)
+            if count >= self.min_requests and circuit.failures >= self.failure_rate * count:
+                self._open(host, circuit, now)
+
+    def _open(self, host: str, circuit: _Circuit, now: float):
+        logger.warning(f"circuit breaker opened for {host}")
+        circuit.state = _OPEN
+        circuit.opened_at = now
+        circuit.outcomes.clear()
+        circuit.failures = 0
+
+
+# Answers if the given request error indicates an unhealthy host.
+def _is_failure(e: BaseException) -> bool:
+    if isinstance(e, HTTPError):
+        return e.code >= 500 or e.code == 429
+    return isinstance(e, OSError)
+
+
+# Hedges idempotent GET requests: when a request hasn't returned within the
+# `quantile` of the latencies observed so far (once there are `min_samples`
+# of them), a duplicate is sent on another connection, and the first
+# response is used, the other one is closed. Hedges are limited to
+# `max_rate` of the requests, and requests are sent on the calling thread
+# unless the budget allows hedging them. Latency is measured until the
+# response headers are received. To use it:
+#
+#     ctx = api.Context(..., hedging=rest.HedgingPolicy())
+#
+# The threads sending the requests are stopped when the policy, or the
+# context using it, is closed.
+class HedgingPolicy(object):
+    def __init__(
+        self,
+        quantile: float = 0.95,
+        min_delay: float = 0.01,
+        max_rate: float = 0.05,
+        window: int = 1000,
+        min_samples: int = 20,
+        max_workers: int = 64,
+    ):
+        if not 0 < quantile < 1:
+            raise ValueError("quantile must be in (0, 1)")
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._tokens = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rai-hedging")
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Stops the threads sending the requests once the requests in flight
+    # complete, later requests are no longer hedged.
+    def close(self):
+        with self._lock:
+            self._closed = True
+        self._executor.shutdown(wait=False)
+
+    # Returns the delay after which requests are hedged, or None until
+    # enough latencies have been observed.
+    def delay(self) -> float:
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self.min_samples:
+            return None
+        return max(self.min_delay, latencies[int(self.quantile * (len(latencies) - 1))])
+
+    # Returns the result of calling `f`, a request, or of a duplicate call
+    # to `f` if the first one is slow.
+    def call(self, f):
+        delay = self.delay()
+        # the hedge is paid for up front, so the requests that can't be
+        # hedged, most of them, are sent on the calling thread
+        if delay is None or not self._withdraw():
+            return self._timed(f)
+        started = threading.Event()
+        try:
+            primary = self._executor.submit(self._timed, f, started)
+        except RuntimeError:  # closed
+            self._refund()
+            return self._timed(f)
+        # the delay runs from when the request is sent, not queued
+        started.wait()
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            self._refund()
+            return primary.result()
+        logger.debug(f"hedging request after {delay:.3f} seconds")
+        try:
+            futures = [primary, self._executor.submit(self._timed, f)]
+        except RuntimeError:
+            return primary.result()
+        winner = None
+        for future in as_completed(futures):
+            if future.exception() is None:
+                winner = future
+                break
+        if winner is None:
+            return primary.result()  # both failed
+        for future in futures:
+            if future is not winner:
+                future.add_done_callback(_close_response)
+        return winner.result()
+
+    def _timed(self, f, started: threading.Event = None):
+        if started is not None:
+            started.set()
+        start_time = time.monotonic()
+        result = f()
+        with self._lock:
+            self._latencies.append(time.monotonic() - start_time)
+        return result
+
+    # Adds this request's share of the hedging budget, and withdraws a hedge
+    # from the budget if it allows one.
+    def _withdraw(self) -> bool:
+        with self._lock:
+            self._tokens = min(1, self._tokens + self.max_rate)
+            if self._closed or self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    # Returns the hedge withdrawn for a request that wasn't hedged.
+    def _refund(self):
+        with self._lock:
+            self._tokens = min(1, self._tokens + 1)
+
+
+# Closes the response of the losing request of a hedged pair.
+def _close_response(future: Future):
+    if future.exception() is None:
+        future.result().close()
+
+
+# Encodes request bodies to, and decodes response bodies from, JSON with the
+# standard library. `decode` returns the value of `key` in the decoded
+# object, when given, which codecs may select without building the rest of
+# the object.
+class JsonCodec(object):
+    def encode(self, value) -> bytes:
+        return json.dumps(value).encode("utf8")
+
+    def decode(self, data, key: str = None):
+        if isinstance(data, memoryview):
+            data = bytes(data)
+        value = json.loads(data)
+        return value[key] if key is not None else value
+
+
+# A `JsonCodec` using `orjson`.
+class OrjsonCodec(JsonCodec):
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def encode(self, value) -> bytes:
+        return self._orjson.dumps(value)
+
+    def decode(self, data, key: str = None):
+        value = self._orjson.loads(data)
+        return value[key] if key is not None else value
+
+
+# A `JsonCodec` using `msgspec`. Objects decoded for a key are decoded as
+# structs with that single, untyped field, so their other fields are parsed
+# but skipped rather than built. This is only key selection, the value of the
+# key is decoded to builtin types, without a schema of the response.
+class MsgspecCodec(JsonCodec):
+    def __init__(self):
+        import msgspec
+        self._msgspec = msgspec
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder()
+        self._decoders = {}
+
+    def encode(self, value) -> bytes:
+        return self._encoder.encode(value)
+
+    def decode(self, data, key: str = None):
+        if key is None:
+            return self._decoder.decode(data)
+        decoder = self._decoders.get(key)
+        if decoder is None:
+            struct = self._msgspec.defstruct("Envelope", [(key, typing.Any)])
+            decoder = self._decoders[key] = self._msgspec.json.Decoder(struct)
+        try:
+            return getattr(decoder.decode(data), key)
+        except self._msgspec.ValidationError as e:
+            raise KeyError(key) from e
+
+
+_default_json_codec = None
+
+
+# Returns the default JSON codec, which uses the fastest JSON library
+# installed among `msgspec`, `orjson` and the standard library.
+def default_json_codec() -> JsonCodec:
+    global _default_json_codec
+    if _default_json_codec is None:
+        for codec in (MsgspecCodec, OrjsonCodec):
+            try:
+                _default_json_codec = codec()
+                break
+            except ImportError:
+                pass
+        else:
+            _default_json_codec = JsonCodec()
+    return _default_json_codec
+
+
+# Context contains the state required to make rAI REST API calls. The
+# `timeout` is the socket timeout, in seconds, of every request made with
+# the context, it must be larger than any server side wait requested.
+#
+# At most `max_requests` requests made with the context may be outstanding,
+# ie waiting for their response, at any time; further requests wait up to
+# `admission_timeout` seconds (None to wait until their deadline) for one to
+# complete, and are otherwise rejected with `OverloadedError`.
+#
+# Request and response bodies are encoded and decoded with `json_codec`,
+# which defaults to `default_json_codec()`.
 class Context(object):
-    def __init__(self, region: str = None, credentials: Credentials = None, retries: int = 0):
+    def __init__(
+        self,
+        region: str = None,
+        credentials: Credentials = None,
+        retries: int = 0,
+        transport: Transport = None,
+        timeout: float = None,
+        retry_policy: RetryPolicy = None,
+        circuit_breaker: CircuitBreaker = None,
+        max_requests: int = None,
+        admission_timeout: float = 0,
+        hedging: HedgingPolicy = None,
+        json_codec: JsonCodec = None,
+    ):
         if retries < 0:
             raise ValueError("Retries must be a non-negative integer")
+        if timeout is not None and timeout <= 0:
+            raise ValueError("timeout must be a positive number")
+        if max_requests is not None and max_requests <= 0:
+            raise ValueError("max_requests must be a positive integer")
 
         self.region = region or "us-east"
         self.credentials = credentials
         self.service = "transaction"
-        self.retries = retries
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy(retries)
+        self.transport = transport if transport is not None else ConnectionPool()
+        self.timeout = timeout
+        self.circuit_breaker = circuit_breaker
+        self.max_requests = max_requests
+        self.admission_timeout = admission_timeout
+        self.hedging = hedging
+        self.json_codec = json_codec if json_codec is not None else default_json_codec()
+        self._admission = threading.BoundedSemaphore(max_requests) if max_requests else None
+
+    # The maximum number of retries of a failed request.
+    @property
+    def retries(self) -> int:
+        return self.retry_policy.retries
+
+    @retries.setter
+    def retries(self, retries: int):
+        self.retry_policy.retries = retries
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Releases the resources held by the context, the connections of its
+    # transport and the threads of its hedging policy.
+    def close(self):
+        self.transport.close()
+        if self.hedging is not None:
+            self.hedging.close()
+
+
+# Returns the deadline of a call that must complete within `timeout`
+# seconds, or by the given `deadline`, whichever comes first.
+def _deadline(timeout: float = None, deadline: float = None) -> float:
+    if timeout is not None:
+        timeout = time.time() + timeout
+        if deadline is None or timeout < deadline:
+            deadline = timeout
+    return deadline
+
+
+# Returns the socket timeout of a request made before the given deadline,
+# raises `TimeoutError` if the deadline has passed.
+def _socket_timeout(timeout: float = None, deadline: float = None) -> float:
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise TimeoutError("deadline exceeded")
+    return remaining if timeout is None else min(timeout, remaining)
 
 
 # Answers if the keys of the passed dict contain a case insensitive match
@@ -85,12 +795,13 @@ def _default_user_agent() -> str:
     return f"rai-sdk-python/{__version__}"
 
 
-def _encode(data) -> bytes:
-    if not data:
+def _encode(data, codec: JsonCodec = None) -> bytes:
+    # note: empty dicts are encoded, otherwise they are sent chunked
+    if data is None or isinstance(data, bytes):
         return data
-    if not isinstance(data, str):
-        data = json.dumps(data)
-    return data.encode("utf8")
+    if isinstance(data, str):
+        return data.encode("utf8")
+    return (codec or default_json_codec()).encode(data)
 
 
 def _encode_path(path: str) -> str:
@@ -126,17 +837,86 @@ def _cache_file() -> str:
     return path.join(path.expanduser('~'), '.rai', 'tokens.json')
 
 
-# Read oauth cache
+# the last token cache read, and the (path, inode, mtime, size) of the file
+# it was read from
+_cache_key = None
+_cache = {}
+
+
+# Read oauth cache, the file is only parsed when it has changed since the
+# last read.
 def _read_cache() -> dict:
+    global _cache_key, _cache
     filename = _cache_file()
-    if not path.exists(filename):
+    try:
+        st = stat(filename)
+    except FileNotFoundError:
         return {}
+    except Exception as e:
+        logger.error(f"can't read token cache {filename}: {e}")
+        return {}
+    key = (filename, st.st_ino, st.st_mtime_ns, st.st_size)
+    if key == _cache_key:
+        return dict(_cache)
     try:
         with open(filename, 'r') as cache:
-            return json.loads(cache.read())
+            result = json.loads(cache.read())
     except Exception as e:
         logger.error(f"can't read token cache {filename}: {e}")
         return {}
+    _cache_key, _cache = key, result
+    return dict(result)
+
+
+# Holds an exclusive lock on the token cache, shared by all processes, for
+# the duration of the block, so only one of them refreshes a token at a time
+# and the others pick up its token. After `timeout` seconds the block runs
+# without the lock, so a stuck process can't block the others forever.
+@contextmanager
+def _token_cache_lock(timeout: float = 30):
+    filename = _cache_file() + ".lock"
+    try:
+        makedirs(path.dirname(filename), exist_ok=True)
+        f = open(filename, "a+b")
+    except Exception as e:
+        logger.warning(f"can't lock token cache {filename}: {e}")
+        yield
+        return
+    with f:
+        locked = _lock_file(f, timeout)
+        if not locked:
+            logger.warning(f"timed out locking token cache {filename}")
+        try:
+            yield
+        finally:
+            if locked:
+                _unlock_file(f)
+
+
+# Locks the given file, waiting at most `timeout` seconds, and returns if
+# it's locked.
+def _lock_file(f, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
 
 
 # Read access token from cache
@@ -148,29 +928,123 @@ def _read_token_cache(creds: ClientCredentials) -> AccessToken:
         return None
 
 
-# write access token to cache
+# write access token to cache, with the cache locked by `_token_cache_lock`.
+# The cache is written to a temporary file which then replaces it, so
+# readers never see a partially written cache.
 def _write_token_cache(creds: ClientCredentials):
+    tmp = None
     try:
         cache_dir = path.dirname(_cache_file())
         makedirs(cache_dir, exist_ok=True)
         cache = _read_cache()
         cache[creds.client_id] = creds.access_token
-        with open(_cache_file(), 'w') as f:
+        with tempfile.NamedTemporaryFile('w', dir=cache_dir, prefix=".tokens-", delete=False) as f:
+            tmp = f.name
             f.write(json.dumps(cache, default=vars))
+        replace(tmp, _cache_file())
     except Exception as e:
         logger.warning(f'Failed to write to token cache {_cache_file()}: {e}')
+        if tmp is not None and path.exists(tmp):
+            remove(tmp)
+
+
+# Manages the access token of a client, shared by all the contexts of the
+# process with the same credentials and audience. Requests only wait for the
+# token endpoint when there is no valid token: once the token is within
+# `refresh_ahead` seconds of expiring (on top of the 60 seconds anticipated
+# by `AccessToken.is_expired`), it is refreshed in the background while
+# requests keep using it. Only one thread requests a token at a time, the
+# others wait for its token. The token file cache is only read and written
+# when refreshing, with the cache locked, so that the processes sharing the
+# cache request one token between them.
+class _TokenManager(object):
+    def __init__(self, refresh_ahead: float = 300, retry_interval: float = 10):
+        self.refresh_ahead = refresh_ahead
+        self.retry_interval = retry_interval
+        self.token = None
+        self._lock = threading.Lock()  # held while refreshing
+        self._retry_at = 0
 
+    # Returns a valid access token, waiting for a new one if needed, or
+    # None if there is none and `block` is false.
+    def get(self, ctx: Context, url: str, block: bool = True) -> AccessToken:
+        token = self.token
+        if token is not None and not token.is_expired():
+            if self._stale(token) and time.monotonic() >= self._retry_at and self._lock.acquire(blocking=False):
+                threading.Thread(target=self._refresh_in_background, args=(ctx, url), daemon=True).start()
+            return token
+        if not block:
+            return None
+        with self._lock:
+            token = self.token
+            if token is None or token.is_expired():
+                token = self._refresh(ctx, url)
+            return token
 
-# Returns the current access token if valid, otherwise requests new token.
-def _get_access_token(ctx: Context, url: str) -> AccessToken:
+    # Answers if the given token is due for a refresh.
+    def _stale(self, token: AccessToken) -> bool:
+        lifetime = token.expires_in - 60
+        return time.time() - token.created_on >= lifetime - min(self.refresh_ahead, lifetime / 2)
+
+    # Returns the cached token, unless it's expired, or stale and `fresh` is
+    # true, in which case a new token is requested and cached. Must be
+    # called with the lock held.
+    def _refresh(self, ctx: Context, url: str, fresh: bool = False) -> AccessToken:
+        creds = ctx.credentials
+        with _token_cache_lock():
+            token = _read_token_cache(creds)
+            if token is None or token.is_expired() or (fresh and self._stale(token)):
+                token = _request_access_token(ctx, url)
+                creds.access_token = token
+                _write_token_cache(creds)
+        self.token = token
+        return token
+
+    def _refresh_in_background(self, ctx: Context, url: str):
+        try:
+            token = self.token
+            if token is None or self._stale(token):
+                self._refresh(ctx, url, fresh=True)
+        except Exception as e:
+            self._retry_at = time.monotonic() + self.retry_interval
+            logger.warning(f"failed to refresh the access token: {e}")
+        finally:
+            self._lock.release()
+
+
+_token_managers = {}
+_token_managers_lock = threading.Lock()
+
+
+def _token_manager(ctx: Context, url: str) -> _TokenManager:
+    creds = ctx.credentials
+    key = (creds.client_id, creds.client_credentials_url, _audience(ctx, url))
+    manager = _token_managers.get(key)
+    if manager is None:
+        with _token_managers_lock:
+            manager = _token_managers.setdefault(key, _TokenManager())
+    return manager
+
+
+# Returns a valid access token, requesting a new one if needed, or None if
+# there is none and `block` is false.
+def _get_access_token(ctx: Context, url: str, block: bool = True) -> str:
     creds = ctx.credentials
     assert isinstance(creds, ClientCredentials)
-    if creds.access_token is None or creds.access_token.is_expired():
-        creds.access_token = _read_token_cache(creds)
-        if creds.access_token is None or creds.access_token.is_expired():
-            creds.access_token = _request_access_token(ctx, url)
-            _write_token_cache(creds)
-    return creds.access_token.access_token
+    manager = _token_manager(ctx, url)
+    if manager.token is None and creds.access_token is not None and not creds.access_token.is_expired():
+        manager.token = creds.access_token
+    token = manager.get(ctx, url, block)
+    if token is None:
+        return None
+    creds.access_token = token
+    return token.access_token
+
+
+# Returns the audience of the access tokens used to call the given url.
+def _audience(ctx: Context, url: str) -> str:
+    # ensure the audience contains the protocol scheme
+    return ctx.audience or f"https://{_get_host(url)}"
 
 
 def _log_request_response(req, rsp):
@@ -183,8 +1057,7 @@ def _log_request_response(req, rsp):
 def _request_access_token(ctx: Context, url: str) -> AccessToken:
     creds = ctx.credentials
     assert isinstance(creds, ClientCredentials)
-    # ensure the audience contains the protocol scheme
-    audience = ctx.audience or f"https://{_get_host(url)}"
+    audience = _audience(ctx, url)
     headers = {
         "Accept": "application/json",
         "Content-Type": "application/json",
@@ -197,7 +1070,7 @@ def _request_access_token(ctx: Context, url: str) -> AccessToken:
         AUDIENCE_KEY: audience,
         GRANT_TYPE_KEY: CLIENT_CREDENTIALS_KEY,
     }
-    data = _encode(body)
+    data = _encode(body, ctx.json_codec)
     req = Request(
         method="POST",
         url=creds.client_credentials_url,
@@ -205,9 +1078,13 @@ def _request_access_token(ctx: Context, url: str) -> AccessToken:
         data=data,
     )
     _print_request(req)
-    with _urlopen_with_retry(req, ctx.retries) as rsp:
+    # requesting a token has no side effects, so it's safe to retry
+    with _urlopen_with_retry(
+        req, ctx.retries, ctx.transport, ctx.timeout,
+        policy=ctx.retry_policy, idempotent=True, breaker=ctx.circuit_breaker,
+    ) as rsp:
         _log_request_response(req, rsp)
-        result = json.loads(rsp.read())
+        result = ctx.json_codec.decode(rsp.read())
         token = result.get(ACCESS_KEY_TOKEN_KEY, None)
         if token is not None:
             expires_in = result.get(EXPIRES_IN_KEY, None)
@@ -229,38 +1106,203 @@ def _authenticate(ctx: Context, req: Request) -> Request:
     raise Exception("unknown credential type")
 
 
-# Issues an HTTP request and retries if failed due to URLError.
-def _urlopen_with_retry(req: Request, retries: int = 0):
-    if retries < 0:
-        raise ValueError("Retries must be a non-negative integer")
+# Issues an HTTP request and retries failures as decided by the given retry
+# policy, which defaults to retrying idempotent requests up to `retries`
+# times. The request is sent with the given transport, or `urlopen`. Each
+# attempt uses the given socket `timeout`, bounded by the time left before
+# the `deadline`, and no attempt is made once the deadline has passed.
+# Attempts go through the circuit breaker, when given, and GET attempts are
+# hedged when a hedging policy is given.
+def _urlopen_with_retry(
+    req: Request,
+    retries: int = 0,
+    transport: Transport = None,
+    timeout: float = None,
+    deadline: float = None,
+    policy: RetryPolicy = None,
+    idempotent: bool = None,
+    breaker: CircuitBreaker = None,
+    hedging: HedgingPolicy = None,
+):
+    if policy is None:
+        policy = RetryPolicy(retries)
 
-    attempts = retries + 1
+    attempts = policy.retries + 1
+    policy._deposit()
 
     for attempt in range(attempts):
         try:
-            return urlopen(req)
+            socket_timeout = _socket_timeout(timeout, deadline)
+        except TimeoutError:
+            raise TimeoutError(f"deadline exceeded before {req.full_url} (attempt {attempt + 1}/{attempts})")
+
+        def attempt_request():
+            if transport is not None:
+                return transport.urlopen(req, socket_timeout)
+            return _urlopen(req, socket_timeout)
+
+        def send():
+            if breaker is not None:
+                return breaker.call(urlsplit(req.full_url).netloc, attempt_request)
+            return attempt_request()
+
+        try:
+            if hedging is not None and req.get_method() == "GET":
+                return hedging.call(send)
+            return send()
         except (URLError, ConnectionError) as e:
-            logger.warning(f"URL/Connection error occured {req.full_url} (attempt {attempt + 1}/{attempts}). Error message: {str(e)}")
+            delay = _retry_delay(policy, req.get_method(), req.full_url, e, attempt, attempts, idempotent)
+            if deadline is not None and time.time() + delay >= deadline:
+                raise TimeoutError(f"deadline exceeded before retrying {req.full_url}") from e
+            time.sleep(delay)
+
+
+# Logs the given failed attempt, and returns the delay before retrying it,
+# or raises the error if it's not retried.
+def _retry_delay(
+    policy: RetryPolicy,
+    method: str,
+    url: str,
+    e: Exception,
+    attempt: int,
+    attempts: int,
+    idempotent: bool = None,
+) -> float:
+    if isinstance(e, HTTPError):
+        if e.code not in policy.retry_statuses:
+            raise e
+        logger.warning(f"HTTP error {e.code} {url} (attempt {attempt + 1}/{attempts})")
+    else:
+        logger.warning(f"URL/Connection error occured {url} (attempt {attempt + 1}/{attempts}). Error message: {str(e)}")
 
-            if attempt == attempts - 1:
-                logger.error(f"Failed to connect to {req.full_url} after {attempts} attempt{'s' if attempts > 1 else ''}")
-                raise e
+    if attempt == attempts - 1:
+        if isinstance(e, HTTPError):
+            logger.error(f"Request to {url} failed after {attempts} attempt{'s' if attempts > 1 else ''}")
+        else:
+            logger.error(f"Failed to connect to {url} after {attempts} attempt{'s' if attempts > 1 else ''}")
+        raise e
+    if not policy.retryable(method, e, idempotent):
+        raise e
+    delay = policy.delay(attempt, e)
+    if delay is None:
+        raise e
+    if not policy._withdraw():
+        logger.warning(f"retry budget exhausted, not retrying {url}")
+        raise e
+    logger.debug(f"retrying {url} in {delay:.2f} seconds")
+    return delay
 
 
 # Issues an RAI REST API request, and returns response contents if successful.
-def request(ctx: Context, method: str, url: str, headers={}, data=None, **kwargs):
+# The request, including retries, must complete within `timeout` seconds, or
+# by the given `deadline` (a `time.time()` value), otherwise `TimeoutError`
+# is raised. `idempotent` overrides whether the request is safe to retry,
+# which otherwise depends on its method, and `hedge=False` opts a GET out of
+# hedging. The other keyword arguments, and the `query` dict, are sent as
+# query parameters; query parameters named like the above can only be sent
+# with `query`.
+def request(
+    ctx: Context,
+    method: str,
+    url: str,
+    headers={},
+    data=None,
+    timeout: float = None,
+    deadline: float = None,
+    idempotent: bool = None,
+    hedge: bool = True,
+    query: dict = None,
+    **kwargs
+):
+    deadline = _deadline(timeout, deadline)
     headers = _default_headers(url, headers)
-    if kwargs:
-        url = f"{url}?{_encode_qs(kwargs)}"
-    data = _encode(data)
+    url = _with_query(url, query, kwargs)
+    data = _encode(data, ctx.json_codec)
     req = Request(method=method, url=url, headers=headers, data=data)
     req = _authenticate(ctx, req)
     _print_request(req)
-    rsp = _urlopen_with_retry(req, ctx.retries)
+    _admit(ctx, deadline)
+    try:
+        rsp = _urlopen_with_retry(
+            req, ctx.retries, ctx.transport, ctx.timeout, deadline, ctx.retry_policy, idempotent,
+            ctx.circuit_breaker, ctx.hedging if hedge else None,
+        )
+    except BaseException:
+        if ctx._admission is not None:
+            ctx._admission.release()
+        raise
     _log_request_response(req, rsp)
+    if ctx._admission is not None:
+        rsp = _AdmittedResponse(rsp, ctx._admission.release)
     return rsp
 
 
+# Returns the given url with the given query parameters.
+def _with_query(url: str, query: dict = None, kwargs: dict = None) -> str:
+    params = dict(kwargs or {})
+    params.update(query or {})
+    return f"{url}?{_encode_qs(params)}" if params else url
+
+
+# A response that holds its request's admission slot until its body has been
+# read, or it's closed, so that `max_requests` also bounds the responses
+# being streamed.
+class _AdmittedResponse(object):
+    def __init__(self, rsp, release):
+        self._rsp = rsp
+        self._release = release
+
+    def __getattr__(self, name):
+        return getattr(self._rsp, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, n: int = None) -> bytes:
+        data = self._rsp.read() if n is None or n < 0 else self._rsp.read(n)
+        if n is None or n < 0 or not data or self._exhausted():
+            self._done()
+        return data
+
+    def readinto(self, b) -> int:
+        n = self._rsp.readinto(b)
+        if not n or self._exhausted():
+            self._done()
+        return n
+
+    def close(self):
+        try:
+            self._rsp.close()
+        finally:
+            self._done()
+
+    # Answers if the body has been read whole, for responses that tell.
+    def _exhausted(self) -> bool:
+        isclosed = getattr(self._rsp, "isclosed", None)
+        return isclosed is not None and isclosed()
+
+    def _done(self):
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+
+
+# Waits for the context to admit another outstanding request, raises
+# `OverloadedError` if it doesn't within its admission timeout.
+def _admit(ctx: Context, deadline: float = None):
+    if ctx._admission is None:
+        return
+    timeout = ctx.admission_timeout
+    if deadline is not None:
+        remaining = max(0, deadline - time.time())
+        timeout = remaining if timeout is None else min(timeout, remaining)
+    if not ctx._admission.acquire(timeout=timeout):
+        raise OverloadedError(f"too many outstanding requests (max {ctx.max_requests})")
+
+
 def delete(ctx: Context, url: str, data, headers={}, **kwargs):
     return request(ctx, "DELETE", url, headers=headers, data=data, **kwargs)
 
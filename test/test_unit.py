@@ -1,11 +1,30 @@
+import asyncio
+import io
+import json
+import os
+import re
 import socket
+import subprocess
+import sys
+import tempfile
+import threading
 import time
 import unittest
+import zipfile
+from concurrent.futures import CancelledError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import patch, MagicMock
-from urllib.error import URLError
+from urllib.error import HTTPError, URLError
 from urllib.request import Request
 
-from railib import api
+import pyarrow as pa
+
+from railib import aio, api, mock, rest
+from railib.cache import ResultCache, _size as cache_size
+from railib.credentials import AccessToken, ClientCredentials
+from railib.replay import RecordingTransport, ReplayTransport, _Response as _ReplayResponse
+from railib.pb import schema_pb2
+from railib.pb.message_pb2 import MetadataInfo
 from railib.rest import _urlopen_with_retry
 
 
@@ -134,6 +153,1684 @@ class TestURLOpenWithRetry(unittest.TestCase):
         self.assertIn(TestURLOpenWithRetry.ERROR_LOG_PREFIX, log.output[3])
 
 
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        status = 404 if self.path == "/missing" else 200
+        body = self.path.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _KeepAliveHandler)
+        self.server.connections = 0
+        threading.Thread(target=self.server.serve_forever, args=(0.01,), daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuses_connection(self):
+        pool = rest.ConnectionPool()
+        for i in range(5):
+            with pool.urlopen(Request(f"{self.url}/{i}")) as rsp:
+                self.assertEqual(rsp.read(), f"/{i}".encode())
+        self.assertEqual(self.server.connections, 1)
+
+    def test_unread_response_is_not_reused(self):
+        pool = rest.ConnectionPool()
+        pool.urlopen(Request(f"{self.url}/a")).close()
+        self.assertEqual(pool.urlopen(Request(f"{self.url}/b")).read(), b"/b")
+        self.assertEqual(self.server.connections, 2)
+
+    def test_maxsize(self):
+        pool = rest.ConnectionPool(maxsize=1)
+        rsps = [pool.urlopen(Request(f"{self.url}/{i}")) for i in range(3)]
+        for rsp in rsps:
+            rsp.read()
+        key = ("http", "127.0.0.1", self.server.server_port)
+        self.assertEqual(len(pool._idle[key]), 1)
+
+    def test_idle_timeout(self):
+        pool = rest.ConnectionPool(idle_timeout=0)
+        pool.urlopen(Request(f"{self.url}/a")).read()
+        pool.urlopen(Request(f"{self.url}/b")).read()
+        self.assertEqual(self.server.connections, 2)
+
+    def test_http_error(self):
+        pool = rest.ConnectionPool()
+        with self.assertRaises(HTTPError) as e:
+            pool.urlopen(Request(f"{self.url}/missing"))
+        self.assertEqual(e.exception.code, 404)
+        self.assertEqual(e.exception.read(), b"/missing")
+        pool.urlopen(Request(f"{self.url}/a")).read()
+        self.assertEqual(self.server.connections, 1)
+
+    def test_request(self):
+        ctx = rest.Context()
+        for _ in range(3):
+            rsp = rest.get(ctx, f"{self.url}/path", foo="bar")
+            self.assertEqual(rsp.read(), b"/path?foo=bar")
+        self.assertEqual(self.server.connections, 1)
+
+
+class _JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    routes = {
+        ("GET", "/compute"): {"computes": [{"name": "e", "state": "PROVISIONED"}]},
+        ("POST", "/transactions"): {"id": "t1", "state": "CREATED"},
+        ("POST", "/transactions/t1/cancel"): {},
+    }
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def _respond(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.server.requests.append((self.command, self.path, self.rfile.read(length)))
+        body = self.routes.get((self.command, self.path.split("?")[0]))
+        status = 200 if body is not None else 404
+        body = json.dumps(body if body is not None else {"message": "not found"}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_PATCH = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+class TestAio(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _JSONHandler)
+        self.server.connections = 0
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, args=(0.01,), daemon=True).start()
+        self.ctx = aio.Context(host="127.0.0.1", port=self.server.server_port, scheme="http")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_engine(self):
+        async def run():
+            return await aio.get_engine(self.ctx, "e")
+
+        self.assertEqual(asyncio.run(run()), {"name": "e", "state": "PROVISIONED"})
+        method, path, _ = self.server.requests[0]
+        self.assertEqual(method, "GET")
+        self.assertEqual(path, "/compute?deleted_on=&name=e")
+
+    def test_exec_async(self):
+        async def run():
+            return await aio.exec_async(self.ctx, "db", "e", "def output = 1")
+
+        rsp = asyncio.run(run())
+        self.assertEqual(rsp.transaction, {"id": "t1", "state": "CREATED"})
+        self.assertIsNone(rsp.results)
+        _, _, body = self.server.requests[0]
+        body = json.loads(body)
+        self.assertEqual(body["query"], "def output = 1")
+        self.assertEqual(body["dbname"], "db")
+
+    def test_concurrent_requests(self):
+        async def run():
+            ids = ["t1"] * 5
+            return await asyncio.gather(*[aio.cancel_transaction(self.ctx, id) for id in ids])
+
+        self.assertEqual(asyncio.run(run()), [{}] * 5)
+        self.assertEqual(len(self.server.requests), 5)
+
+    def test_keep_alive(self):
+        async def run():
+            for _ in range(3):
+                await aio.list_engines(self.ctx)
+
+        asyncio.run(run())
+        self.assertEqual(self.server.connections, 1)
+
+    def test_http_error(self):
+        async def run():
+            return await aio.get_transaction(self.ctx, "missing")
+
+        with self.assertRaises(HTTPError) as e:
+            asyncio.run(run())
+        self.assertEqual(e.exception.code, 404)
+        self.assertEqual(json.loads(e.exception.read()), {"message": "not found"})
+
+    def test_timeout(self):
+        async def run():
+            return await aio.get_engine(self.ctx, "e", timeout=5)
+
+        self.assertEqual(asyncio.run(run()), {"name": "e", "state": "PROVISIONED"})
+        _, path, _ = self.server.requests[0]
+        self.assertEqual(path, "/compute?deleted_on=&name=e")
+
+        async def urlopen(*args):
+            await asyncio.sleep(5)
+
+        async def run_slow():
+            with patch.object(self.ctx.aio_pool, "urlopen", urlopen):
+                await aio.get_engine(self.ctx, "e", deadline=time.time() + 0.1)
+
+        start_time = time.time()
+        with self.assertRaises(TimeoutError):
+            asyncio.run(run_slow())
+        self.assertLess(time.time() - start_time, 2)
+
+
+class TestExec(unittest.TestCase):
+    def test_fetches_artifacts_concurrently(self):
+        barrier = threading.Barrier(4, timeout=5)
+
+        def fetch(value):
+            def f(ctx, id):
+                self.assertEqual(id, "t1")
+                barrier.wait()  # fails unless all four requests are in flight
+                return value
+            return f
+
+        txn = api.TransactionAsyncResponse({"id": "t1", "state": "CREATED"})
+        with patch.object(api, "exec_async", return_value=txn), \
+                patch.object(api, "get_transaction", side_effect=fetch({"id": "t1", "state": "COMPLETED"})), \
+                patch.object(api, "get_transaction_metadata", side_effect=fetch("metadata")), \
+                patch.object(api, "get_transaction_problems", side_effect=fetch([])), \
+                patch.object(api, "get_transaction_results", side_effect=fetch(["results"])), \
+                patch.object(api, "poll_with_specified_overhead"):
+            rsp = api.exec(api.Context(), "db", "e", "def output = 1")
+
+        self.assertEqual(rsp.transaction, {"id": "t1", "state": "COMPLETED"})
+        self.assertEqual(rsp.metadata, "metadata")
+        self.assertEqual(rsp.problems, [])
+        self.assertEqual(rsp.results, ["results"])
+
+    def test_shared_fetch_pool(self):
+        ctx = api.Context()
+        txn = api.TransactionAsyncResponse({"id": "t1", "state": "CREATED"})
+        threads = set()
+
+        def fetch(ctx, id):
+            threads.add(threading.current_thread().name)
+
+        with patch.object(api, "exec_async", return_value=txn), \
+                patch.object(api, "get_transaction", side_effect=fetch), \
+                patch.object(api, "get_transaction_metadata", side_effect=fetch), \
+                patch.object(api, "get_transaction_problems", side_effect=fetch), \
+                patch.object(api, "get_transaction_results", side_effect=fetch), \
+                patch.object(api, "poll_with_specified_overhead"):
+            api.exec(ctx, "db", "e", "def output = 1")
+            executor = ctx._fetch_executor
+            api.exec(ctx, "db", "e", "def output = 2")
+            self.assertIs(ctx._fetch_executor, executor)
+        self.assertTrue(all(name.startswith("rai-fetch") or name == threading.current_thread().name for name in threads))
+        ctx.close()
+        self.assertIsNone(ctx._fetch_executor)
+        self.assertTrue(executor._shutdown)
+
+
+class TestTransactionPoller(unittest.TestCase):
+    def setUp(self):
+        self.states = {f"t{i}": "RUNNING" for i in range(5)}
+        self.polls = {id: 0 for id in self.states}
+        self.lock = threading.Lock()
+
+    def get_transaction(self, ctx, id):
+        with self.lock:
+            self.polls[id] += 1
+            # transactions complete after a poll per their number
+            if self.polls[id] > int(id[1:]):
+                self.states[id] = "COMPLETED"
+            return {"id": id, "state": self.states[id]}
+
+    def test_wait(self):
+        poller = api.TransactionPoller(api.Context(), min_interval=0.01, overhead_rate=0)
+        results = {}
+
+        def wait(id):
+            results[id] = poller.wait(id)
+
+        with patch.object(api, "get_transaction", side_effect=self.get_transaction), \
+                patch.object(api, "list_transactions") as list_transactions:
+            threads = [threading.Thread(target=wait, args=(id,)) for id in self.states]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join(5)
+            list_transactions.assert_not_called()
+
+        self.assertEqual(results, {id: {"id": id, "state": "COMPLETED"} for id in self.states})
+        # polls stop once transactions complete
+        self.assertEqual(self.polls, {id: int(id[1:]) + 1 for id in self.states})
+
+    def test_batch(self):
+        ctx = api.Context()
+        poller = api.TransactionPoller(ctx, min_interval=0.01)
+        barrier = threading.Barrier(3, timeout=5)
+
+        def get_transaction(ctx, id):
+            barrier.wait()  # fails unless the polls are concurrent
+            return {"id": id, "state": "COMPLETED"}
+
+        with patch.object(api, "get_transaction", side_effect=get_transaction):
+            self.assertEqual(poller._poll(["t0", "t1", "t2"]), {
+                id: {"id": id, "state": "COMPLETED"} for id in ["t0", "t1", "t2"]
+            })
+        ctx.close()
+
+    def test_error(self):
+        poller = api.TransactionPoller(api.Context(), min_interval=0.01)
+        with patch.object(api, "get_transaction", side_effect=URLError("down")):
+            with self.assertRaises(URLError):
+                poller.wait("t0", timeout=5)
+
+    def test_timeout(self):
+        poller = api.TransactionPoller(api.Context(), min_interval=0.01)
+        with patch.object(api, "get_transaction", return_value={"id": "t0", "state": "RUNNING"}):
+            with self.assertRaises(Exception) as e:
+                poller.wait("t0", timeout=0.1)
+        self.assertEqual('timed out after 0.1 seconds', str(e.exception))
+        self.assertEqual(poller._waiters, {})
+
+    def test_unexpected_error(self):
+        poller = api.TransactionPoller(api.Context(), min_interval=0.01)
+        with patch.object(poller, "_poll", side_effect=RuntimeError("bug")):
+            with self.assertLogs(), self.assertRaises(RuntimeError):
+                poller.wait("t0", timeout=5)
+        self.assertIsNone(poller._thread)
+        self.assertEqual(poller._waiters, {})
+        # the next wait restarts polling
+        txn = {"id": "t0", "state": "COMPLETED"}
+        with patch.object(api, "get_transaction", return_value=txn):
+            self.assertEqual(poller.wait("t0", timeout=5), txn)
+
+
+class TestTransactionExecutor(unittest.TestCase):
+    def setUp(self):
+        self.ctx = api.Context()
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+        self.release = threading.Event()
+        self.created = threading.Event()
+
+    def exec_async(self, ctx, database, engine, command, **kwargs):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        self.created.set()
+        return api.TransactionAsyncResponse({"id": command, "state": "CREATED"})
+
+    def wait_transaction(self, ctx, txn, start_time, **kwargs):
+        self.release.wait(5)
+        with self.lock:
+            self.running -= 1
+        return api.TransactionAsyncResponse(dict(txn.transaction, state="COMPLETED"), None, [], [])
+
+    def patch_exec(self):
+        return patch.multiple(api, exec_async=self.exec_async, _wait_transaction=self.wait_transaction)
+
+    def test_submit(self):
+        self.release.set()
+        with self.patch_exec(), api.TransactionExecutor(self.ctx) as executor:
+            futures = [executor.submit("db", "e", f"q{i}") for i in range(5)]
+            ids = {f.result(5).transaction["id"] for f in api.as_completed(futures, timeout=5)}
+        self.assertEqual(ids, {f"q{i}" for i in range(5)})
+        self.assertEqual({f.transaction_id for f in futures}, ids)
+
+    def test_max_per_engine(self):
+        with self.patch_exec(), api.TransactionExecutor(self.ctx, max_workers=4, max_per_engine=2) as executor:
+            futures = [executor.submit("db", "e", f"q{i}") for i in range(6)]
+            futures.append(executor.submit("db", "other", "q"))
+            time.sleep(0.1)
+            self.assertEqual(self.max_running, 3)
+            self.release.set()
+            for f in futures:
+                f.result(5)
+        self.assertEqual(self.max_running, 3)
+
+    def test_cancel_running(self):
+        with self.patch_exec(), patch.object(api, "cancel_transaction") as cancel:
+            with api.TransactionExecutor(self.ctx) as executor:
+                future = executor.submit("db", "e", "q")
+                self.created.wait(5)
+                self.assertTrue(future.cancel())
+                self.assertTrue(future.cancelled())
+                self.release.set()
+                with self.assertRaises(CancelledError):
+                    future.result(5)
+        self.assertTrue(future.cancelled())
+        cancel.assert_called_once_with(self.ctx, "q", timeout=api._CANCEL_TIMEOUT)
+
+    def test_cancel_error(self):
+        with self.patch_exec(), patch.object(api, "cancel_transaction", side_effect=URLError("down")) as cancel:
+            with self.assertLogs(level="WARNING"):
+                with api.TransactionExecutor(self.ctx) as executor:
+                    future = executor.submit("db", "e", "q")
+                    self.created.wait(5)
+                    # the failure to cancel on the server is logged, not raised
+                    self.assertTrue(future.cancel())
+                    self.assertEqual(list(api.as_completed([future], timeout=1)), [future])
+                    self.release.set()
+        self.assertTrue(future.cancelled())
+        cancel.assert_called_once()
+
+    def test_cancel_pending(self):
+        with self.patch_exec(), patch.object(api, "cancel_transaction") as cancel:
+            with api.TransactionExecutor(self.ctx, max_per_engine=1) as executor:
+                first = executor.submit("db", "e", "q0")
+                second = executor.submit("db", "e", "q1")
+                self.assertTrue(second.cancel())
+                self.release.set()
+                first.result(5)
+        self.assertTrue(second.cancelled())
+        cancel.assert_not_called()
+
+    def test_shutdown(self):
+        self.release.set()
+        with self.patch_exec(), api.TransactionExecutor(self.ctx, max_per_engine=1) as executor:
+            futures = [executor.submit("db", "e", f"q{i}") for i in range(3)]
+        # queued transactions run before the executor shuts down
+        self.assertEqual([f.result(5).transaction["id"] for f in futures], ["q0", "q1", "q2"])
+        with self.assertRaises(RuntimeError):
+            executor.submit("db", "e", "q")
+
+    def test_shutdown_nowait(self):
+        with self.patch_exec():
+            executor = api.TransactionExecutor(self.ctx, max_per_engine=1)
+            first = executor.submit("db", "e", "q0")
+            second = executor.submit("db", "e", "q1")
+            self.created.wait(5)
+            executor.shutdown(wait=False)
+            with self.assertRaises(RuntimeError):
+                second.result(5)
+            self.release.set()
+            self.assertEqual(first.result(5).transaction["id"], "q0")
+
+
+def _response(n: int = 3, state: str = "COMPLETED") -> api.TransactionAsyncResponse:
+    table = pa.table({"v1": list(range(n))})
+    with open(os.path.join(os.path.dirname(__file__), "metadata.pb"), "rb") as f:
+        metadata = api._parse_metadata_proto(f.read())
+    return api.TransactionAsyncResponse(
+        {"id": "t1", "state": state}, metadata, [{"relationId": "/:output/Int64", "table": table}], []
+    )
+
+
+# Returns a response with results that haven't been decoded, as returned
+# by `exec`.
+def _lazy_response(n: int = 3, state: str = "COMPLETED") -> api.TransactionAsyncResponse:
+    rsp = _response(n, state)
+    table = rsp.results[0]["table"]
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    stream = memoryview(sink.getvalue().to_pybytes())
+    file = api.TransactionAsyncFile("/:output/Int64", "0.arrow", "application/vnd.apache.arrow.stream", stream)
+    rsp.results = api.TransactionResults([file])
+    return rsp
+
+
+class TestResultCache(unittest.TestCase):
+    def test_get_put(self):
+        cache = ResultCache()
+        self.assertIsNone(cache.get("k"))
+        rsp = _response()
+        cache.put("k", rsp)
+        cached = cache.get("k")
+        self.assertEqual(cached.transaction, rsp.transaction)
+        self.assertIs(cached.results[0]["table"], rsp.results[0]["table"])
+        cached.transaction["state"] = "changed"
+        self.assertEqual(cache.get("k").transaction["state"], "COMPLETED")
+
+    def test_only_completed(self):
+        cache = ResultCache()
+        cache.put("k", _response(state="ABORTED"))
+        self.assertIsNone(cache.get("k"))
+
+    def test_lru_eviction(self):
+        nbytes = _response(100).results[0]["table"].nbytes
+        cache = ResultCache(max_bytes=2 * nbytes)
+        for key in ["a", "b"]:
+            cache.put(key, _response(100))
+        cache.get("a")
+        cache.put("c", _response(100))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("c"))
+        self.assertEqual(cache.nbytes, 2 * nbytes)
+
+    def test_ttl(self):
+        cache = ResultCache(ttl=10)
+        with patch("time.time", return_value=100):
+            cache.put("k", _response())
+        with patch("time.time", return_value=105):
+            self.assertIsNotNone(cache.get("k"))
+        with patch("time.time", return_value=111):
+            self.assertIsNone(cache.get("k"))
+        self.assertEqual(len(cache), 0)
+
+    def test_directory(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            rsp = _response()
+            ResultCache(directory=tmp).put("k", rsp)
+            cached = ResultCache(directory=tmp).get("k")
+            self.assertEqual(cached.transaction, rsp.transaction)
+            self.assertEqual(cached.metadata, rsp.metadata)
+            self.assertEqual(cached.results[0]["relationId"], "/:output/Int64")
+            self.assertTrue(cached.results[0]["table"].equals(rsp.results[0]["table"]))
+
+    def test_results(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            rsp = _lazy_response()
+            cache = ResultCache(directory=tmp)
+            cache.put("k", rsp)
+            # caching doesn't decode the results
+            self.assertEqual(rsp.results._tables, [None])
+            for cached in (cache.get("k"), ResultCache(directory=tmp).get("k")):
+                self.assertIsInstance(cached.results, api.TransactionResults)
+                self.assertEqual(cached.results.keys(), ["/:output/Int64"])
+                self.assertEqual(cached.results["/:output/Int64"].num_rows, 3)
+
+    def test_directory_promotion(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            ResultCache(directory=tmp).put("k", _lazy_response())
+            cache = ResultCache(directory=tmp)
+            with patch.object(cache, "_read", wraps=cache._read) as read:
+                first = cache.get("k")
+                second = cache.get("k")
+                # the disk hit was kept in memory
+                self.assertEqual(read.call_count, 1)
+            self.assertEqual(len(cache), 1)
+            self.assertIsNot(first, second)
+            self.assertEqual(second.results["/:output/Int64"].num_rows, 3)
+        with tempfile.TemporaryDirectory() as tmp:
+            ResultCache(directory=tmp).put("k", _lazy_response())
+            # responses larger than max_bytes stay on disk only
+            cache = ResultCache(directory=tmp, max_bytes=1)
+            self.assertIsNotNone(cache.get("k"))
+            self.assertEqual(len(cache), 0)
+
+    def test_directory_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = ResultCache(directory=tmp, ttl=10)
+            with patch("time.time", return_value=100):
+                cache.put("a", _lazy_response())
+            with patch("time.time", return_value=105):
+                cache.put("b", _lazy_response())
+            # expired entries are removed
+            with patch("time.time", return_value=111):
+                cache.put("c", _lazy_response())
+            self.assertEqual(sorted(os.listdir(tmp)), ["b", "c"])
+        with tempfile.TemporaryDirectory() as tmp:
+            for key in ("a", "b"):
+                ResultCache(directory=tmp).put(key, _lazy_response())
+                time.sleep(0.01)
+            # least recently used entries are removed past max_bytes
+            cache = ResultCache(directory=tmp, max_bytes=2 * cache_size(os.path.join(tmp, "a")))
+            self.assertIsNotNone(cache.get("a"))
+            cache.put("c", _lazy_response())
+            self.assertEqual(sorted(os.listdir(tmp)), ["a", "c"])
+
+    def test_exec(self):
+        ctx = api.Context()
+        ctx.result_cache = ResultCache()
+        with patch.object(api, "exec_async", return_value=_response()) as exec_async:
+            api.exec(ctx, "db", "e1", "def output = 1")
+            rsp = api.exec(ctx, "db", "e2", "def output = 1")
+            self.assertEqual(exec_async.call_count, 1)
+            api.exec(ctx, "db", "e1", "def output = 2")
+            api.exec(ctx, "db", "e1", "def output = 1", readonly=False)
+            self.assertEqual(exec_async.call_count, 3)
+        self.assertEqual(rsp.transaction["state"], "COMPLETED")
+
+
+class TestSingleFlight(unittest.TestCase):
+    def run_concurrently(self, f, n=5):
+        results = [None] * n
+
+        def run(i):
+            try:
+                results[i] = f()
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(5)
+        return results
+
+    def test_do(self):
+        group = api.SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def f():
+            calls.append(1)
+            release.wait(5)
+            return object()
+
+        threading.Timer(0.1, release.set).start()
+        results = self.run_concurrently(lambda: group.do("k", f))
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(r is results[0] for r in results))
+        self.assertEqual(group._calls, {})
+
+    def test_error(self):
+        group = api.SingleFlight()
+        release = threading.Event()
+
+        def f():
+            release.wait(5)
+            raise ValueError("failed")
+
+        threading.Timer(0.1, release.set).start()
+        results = self.run_concurrently(lambda: group.do("k", f))
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+
+    def test_follower_deadline(self):
+        group = api.SingleFlight()
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def f():
+            release.wait(5)
+            return "leader"
+
+        leader = threading.Thread(target=group.do, args=("k", f))
+        leader.start()
+        time.sleep(0.05)
+        start_time = time.time()
+        with self.assertRaises(TimeoutError):
+            group.do("k", f, timeout=0.1)
+        self.assertLess(time.time() - start_time, 1)
+        release.set()
+        leader.join(5)
+
+    def test_leader_timeout(self):
+        group = api.SingleFlight()
+        release = threading.Event()
+
+        def leader():
+            release.wait(5)
+            raise TimeoutError("leader deadline exceeded")
+
+        results = []
+        thread = threading.Thread(target=lambda: results.append(group.do("k", lambda: "follower", timeout=5)))
+        with self.assertRaises(TimeoutError):
+            threading.Timer(0.1, thread.start).start()
+            threading.Timer(0.2, release.set).start()
+            group.do("k", leader)
+        thread.join(5)
+        # the follower's deadline hasn't passed, so it retried on its own
+        self.assertEqual(results, ["follower"])
+        self.assertEqual(group._calls, {})
+
+    def test_exec(self):
+        ctx = api.Context()
+        ctx.single_flight = api.SingleFlight()
+        release = threading.Event()
+
+        def exec_async(*args, **kwargs):
+            release.wait(5)
+            return _response()
+
+        threading.Timer(0.1, release.set).start()
+        with patch.object(api, "exec_async", side_effect=exec_async) as mock:
+            results = self.run_concurrently(lambda: api.exec(ctx, "db", "e", "def output = 1"))
+            self.assertEqual(mock.call_count, 1)
+        # each caller gets its own copy, sharing the (immutable) tables
+        self.assertEqual(len(set(map(id, results))), len(results))
+        self.assertTrue(all(r.results[0]["table"] is results[0].results[0]["table"] for r in results))
+        results[0].transaction["state"] = "ABORTED"
+        results[0].problems.append({"message": "changed"})
+        for rsp in results[1:]:
+            self.assertEqual(rsp.transaction["state"], "COMPLETED")
+            self.assertEqual(rsp.problems, [])
+
+    def test_copy_result(self):
+        group = api.SingleFlight()
+        release = threading.Event()
+
+        def f():
+            release.wait(5)
+            return ["leader"]
+
+        threading.Timer(0.1, release.set).start()
+        results = self.run_concurrently(lambda: group.do("k", f, copy_result=list))
+        self.assertTrue(all(r == ["leader"] for r in results))
+        self.assertEqual(len(set(map(id, results))), len(results))
+
+
+def _constant(relation_id, value: str):
+    arg = relation_id.arguments.add()
+    arg.tag = schema_pb2.CONSTANT_TYPE
+    arg.constant_type.rel_type.tag = schema_pb2.PRIMITIVE_TYPE
+    arg.constant_type.rel_type.primitive_type = schema_pb2.STRING
+    v = arg.constant_type.value.arguments.add()
+    v.tag = schema_pb2.STRING
+    v.string_val = value.encode()
+
+
+class TestExecBatch(unittest.TestCase):
+    def batch_response(self) -> api.TransactionAsyncResponse:
+        metadata = MetadataInfo()
+        results = []
+        for i, name in enumerate(["rai_batch1", "rai_batch0"]):
+            relation = metadata.relations.add()
+            relation.file_name = f"/:output/:{name}/Int64"
+            _constant(relation.relation_id, "output")
+            _constant(relation.relation_id, name)
+            arg = relation.relation_id.arguments.add()
+            arg.tag = schema_pb2.PRIMITIVE_TYPE
+            arg.primitive_type = schema_pb2.INT_64
+            results.append({"relationId": relation.file_name, "table": pa.table({"v1": [i]})})
+        results.append({"relationId": "/:output/:rai_batch1/String", "table": pa.table({"v1": ["a"]})})
+        return api.TransactionAsyncResponse({"id": "t1", "state": "COMPLETED"}, metadata, results, [])
+
+    def test_exec_batch(self):
+        with patch.object(api, "exec", return_value=self.batch_response()) as exec:
+            rsps = api.exec_batch(api.Context(), "db", "e", ["def output = 1", "def output = 2"])
+
+        command = exec.call_args[0][3]
+        self.assertIn("module rai_batch0\ndef output = 1\nend\ndef output[:rai_batch0] = rai_batch0[:output]\n", command)
+        self.assertIn("module rai_batch1\ndef output = 2\nend\n", command)
+        self.assertTrue(exec.call_args[1]["readonly"])
+
+        self.assertEqual(len(rsps), 2)
+        self.assertEqual([r["table"].to_pydict() for r in rsps[0].results], [{"v1": [1]}])
+        self.assertEqual(
+            [(r["relationId"], r["table"].to_pydict()) for r in rsps[1].results],
+            [("/:output/Int64", {"v1": [0]}), ("/:output/String", {"v1": ["a"]})],
+        )
+        for rsp in rsps:
+            self.assertEqual(rsp.transaction["state"], "COMPLETED")
+            # the metadata of the results is found by their relation id
+            self.assertEqual([r.file_name for r in rsp.metadata.relations], ["/:output/Int64"])
+        relation_id = rsps[0].metadata.relations[0].relation_id
+        self.assertEqual(len(relation_id.arguments), 2)
+        self.assertEqual(api._constant_string(relation_id.arguments[0]), "output")
+        self.assertEqual(relation_id.arguments[1].primitive_type, schema_pb2.INT_64)
+
+    def test_batch_relation(self):
+        relation = self.batch_response().metadata.relations[0]
+        # the name of the query is taken from the metadata when the
+        # relation id doesn't start with it
+        self.assertEqual(
+            api._batch_relation("/:output/Int64/:rai_batch1", relation),
+            ("rai_batch1", "/:output/Int64"),
+        )
+        self.assertEqual(api._batch_relation("/:other/Int64", None), (None, "/:other/Int64"))
+
+    def test_lazy_results(self):
+        content_type, body = _multipart([
+            (f"/:output/:rai_batch{i}/Int64", "application/vnd.apache.arrow.stream", _arrow_stream(pa.table({"v1": [i]})))
+            for i in range(2)
+        ])
+        results = api._parse_arrow_results(api._parse_multipart_form(content_type, body))
+        rsp = api.TransactionAsyncResponse({"id": "t1", "state": "COMPLETED"}, None, results, [])
+        with patch.object(api, "_decode_arrow", wraps=api._decode_arrow) as decode:
+            rsps = api._split_batch_response(rsp, ["rai_batch0", "rai_batch1"])
+            decode.assert_not_called()
+            for i, rsp in enumerate(rsps):
+                self.assertIsInstance(rsp.results, api.TransactionResults)
+                self.assertEqual(rsp.results.keys(), ["/:output/Int64"])
+                self.assertEqual(rsp.results["/:output/Int64"].to_pydict(), {"v1": [i]})
+            self.assertEqual(decode.call_count, 2)
+
+
+def _arrow_stream(table) -> bytes:
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+# Returns a multipart content type and body for the given
+# (name, content type, content) parts.
+def _multipart(parts, boundary="b0undary") -> tuple:
+    body = b""
+    for name, content_type, content in parts:
+        body += f"--{boundary}\r\n".encode()
+        body += f'Content-Disposition: form-data; name="{name}"; filename="{name}"\r\n'.encode()
+        body += f"Content-Type: {content_type}\r\n\r\n".encode()
+        body += content + b"\r\n"
+    body += f"--{boundary}--\r\n".encode()
+    return f"multipart/form-data; boundary={boundary}", body
+
+
+class TestMultipart(unittest.TestCase):
+    def test_parse(self):
+        content_type, body = _multipart([
+            ("transaction", "application/json", b'{"id": "t1"}'),
+            ("empty", "text/plain", b""),
+            ("crlf", "application/octet-stream", b"\r\n--b0und\r\n"),
+        ])
+        files = api._parse_multipart_form(content_type, body)
+        self.assertEqual([f.name for f in files], ["transaction", "empty", "crlf"])
+        self.assertEqual([f.filename for f in files], ["transaction", "empty", "crlf"])
+        self.assertEqual(files[0].content_type, "application/json")
+        self.assertEqual([bytes(f.content) for f in files], [b'{"id": "t1"}', b"", b"\r\n--b0und\r\n"])
+        for f in files:
+            self.assertIsInstance(f.content, memoryview)
+            self.assertIs(f.content.obj, body)
+
+    def test_quoted_boundary(self):
+        _, body = _multipart([("a", "text/plain", b"x")], boundary="b=1")
+        files = api._parse_multipart_form('multipart/form-data; boundary="b=1"', body)
+        self.assertEqual(bytes(files[0].content), b"x")
+
+    def test_invalid(self):
+        with self.assertRaises(Exception):
+            api._parse_multipart_form("multipart/form-data; boundary=b0undary", b"--b0undary\r\nbroken")
+
+    def test_arrow_results_zero_copy(self):
+        table = pa.table({"v1": list(range(1000))})
+        content_type, body = _multipart([("0.arrow", "application/vnd.apache.arrow.stream", _arrow_stream(table))])
+        results = api._parse_arrow_results(api._parse_multipart_form(content_type, body))
+        self.assertTrue(results[0]["table"].equals(table))
+        address = results[0]["table"].column(0).chunk(0).buffers()[1].address
+        start = pa.py_buffer(body).address
+        self.assertTrue(start <= address < start + len(body))
+
+
+# A stream returning the given content in small chunks, and recording how
+# much of it has been read.
+class _ChunkedStream(io.RawIOBase):
+    def __init__(self, content: bytes, chunk_size: int = 7):
+        self.content = content
+        self.chunk_size = chunk_size
+        self.pos = 0
+
+    def read(self, n=-1):
+        n = min(n, self.chunk_size)
+        data = self.content[self.pos:self.pos + n]
+        self.pos += len(data)
+        return data
+
+
+class TestMultipartReader(unittest.TestCase):
+    def parts(self, body_parts, chunk_size=7):
+        content_type, body = _multipart(body_parts)
+        stream = _ChunkedStream(b"preamble\r\n" + body, chunk_size)
+        reader = api._MultipartReader(stream, content_type, chunk_size=chunk_size)
+        return stream, reader.parts()
+
+    def test_parts(self):
+        contents = [b'{"id": "t1"}', b"", b"\r\n--b0und\r\n--b0undar", b"x" * 1000]
+        _, parts = self.parts([(f"p{i}", "text/plain", c) for i, c in enumerate(contents)])
+        result = [(part.name, part.filename, part.content_type, part.read()) for part in parts]
+        self.assertEqual(result, [(f"p{i}", f"p{i}", "text/plain", c) for i, c in enumerate(contents)])
+
+    def test_skip_part(self):
+        _, parts = self.parts([("a", "text/plain", b"a" * 100), ("b", "text/plain", b"b")])
+        self.assertEqual([part.name for part in parts], ["a", "b"])
+
+    def test_truncated(self):
+        content_type, body = _multipart([("a", "text/plain", b"abc")])
+        reader = api._MultipartReader(_ChunkedStream(body[:-20]), content_type)
+        with self.assertRaises(Exception):
+            for part in reader.parts():
+                part.read()
+
+    def test_arrow_stream(self):
+        table = pa.table({"v1": list(range(10000))})
+        batches = table.to_batches(max_chunksize=1000)
+        stream, parts = self.parts([
+            ("0.arrow", "application/vnd.apache.arrow.stream", _arrow_stream(pa.Table.from_batches(batches))),
+            ("1.arrow", "application/vnd.apache.arrow.stream", _arrow_stream(pa.table({"v1": ["a"]}))),
+        ], chunk_size=1024)
+        reader = pa.ipc.open_stream(next(parts))
+        first = reader.read_next_batch()
+        # the first batch is decoded before the body has been fully read
+        self.assertLess(stream.pos, len(stream.content) / 2)
+        rest = reader.read_all()
+        self.assertEqual(first.num_rows + rest.num_rows, 10000)
+        self.assertEqual(pa.ipc.open_stream(next(parts)).read_all().to_pydict(), {"v1": ["a"]})
+
+    def test_get_transaction_results_stream(self):
+        table = pa.table({"v1": [1, 2, 3]})
+        content_type, body = _multipart([
+            ("/:output/Int64", "application/vnd.apache.arrow.stream", _arrow_stream(table)),
+            ("problems", "application/json", b"[]"),
+        ])
+        rsp = MagicMock()
+        rsp.headers = {"content-type": content_type}
+        rsp.read = _ChunkedStream(body, 64).read
+        with patch.object(rest, "get", return_value=rsp):
+            results = [(r["relationId"], r["reader"].read_all()) for r in api.get_transaction_results_stream(api.Context(), "t1")]
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0][0], "/:output/Int64")
+        self.assertTrue(results[0][1].equals(table))
+
+
+class TestTransactionResults(unittest.TestCase):
+    def setUp(self):
+        self.tables = [pa.table({"v1": [i]}) for i in range(3)]
+        parts = [
+            (f"/:output/:r{i}/Int64", "application/vnd.apache.arrow.stream", _arrow_stream(t))
+            for i, t in enumerate(self.tables)
+        ]
+        parts.append(("problems", "application/json", b"[]"))
+        content_type, body = _multipart(parts)
+        self.results = api._parse_arrow_results(api._parse_multipart_form(content_type, body))
+
+    def test_lazy(self):
+        with patch.object(api, "_decode_arrow", wraps=api._decode_arrow) as decode:
+            self.assertEqual(len(self.results), 3)
+            self.assertEqual(self.results.keys(), [f"/:output/:r{i}/Int64" for i in range(3)])
+            self.assertIn("/:output/:r1/Int64", self.results)
+            decode.assert_not_called()
+            self.assertTrue(self.results["/:output/:r1/Int64"].equals(self.tables[1]))
+            self.assertTrue(self.results.table("/:output/:r1/Int64").equals(self.tables[1]))
+            self.assertEqual(decode.call_count, 1)
+
+    def test_list_access(self):
+        self.assertEqual(self.results[0]["relationId"], "/:output/:r0/Int64")
+        self.assertTrue(self.results[-1]["table"].equals(self.tables[2]))
+        self.assertEqual([r["relationId"] for r in self.results[1:]], ["/:output/:r1/Int64", "/:output/:r2/Int64"])
+        self.assertEqual(
+            self.results,
+            [{"relationId": f"/:output/:r{i}/Int64", "table": t} for i, t in enumerate(self.tables)],
+        )
+
+    def test_missing(self):
+        with self.assertRaises(KeyError):
+            self.results["/:output/String"]
+        with self.assertRaises(IndexError):
+            self.results[3]
+
+
+class TestSpillResults(unittest.TestCase):
+    def setUp(self):
+        self.table = pa.table({"v1": list(range(1000))})
+        self.content_type, self.body = _multipart([
+            ("/:output/Int64", "application/vnd.apache.arrow.stream", _arrow_stream(self.table)),
+        ])
+        self.tmp = tempfile.TemporaryDirectory()
+        self.ctx = api.Context()
+        self.ctx.spill_directory = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def get_results(self, content_length=True):
+        rsp = MagicMock()
+        rsp.headers = {"content-type": self.content_type}
+        if content_length:
+            rsp.headers["content-length"] = str(len(self.body))
+        rsp.read = _ChunkedStream(self.body, 1024).read
+        with patch.object(rest, "get", return_value=rsp):
+            return api.get_transaction_results(self.ctx, "t1")
+
+    def test_over_threshold(self):
+        self.ctx.spill_threshold = 1024
+        for content_length in [True, False]:
+            results = self.get_results(content_length)
+            self.assertIsInstance(results._contents[0], pa.Buffer)
+            self.assertTrue(results["/:output/Int64"].equals(self.table))
+            self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_under_threshold(self):
+        self.ctx.spill_threshold = len(self.body)
+        for content_length in [True, False]:
+            results = self.get_results(content_length)
+            self.assertIsInstance(results._contents[0], memoryview)
+            self.assertTrue(results["/:output/Int64"].equals(self.table))
+
+
+class TestServerWait(unittest.TestCase):
+    def setUp(self):
+        self.server = mock.MockServer(duration=0.3)
+        self.server.start()
+        self.ctx = self.server.context()
+        self.ctx.server_wait = 5
+
+    def tearDown(self):
+        self.server.stop()
+
+    def status_requests(self):
+        return [path for method, path in self.server.requests if re.fullmatch(r"/transactions/[^/?]+(\?.*)?", path)]
+
+    def test_long_poll(self):
+        start = time.time()
+        rsp = api.exec(self.ctx, "db", "e", "def output = 1")
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(rsp.transaction["state"], "COMPLETED")
+        self.assertEqual(rsp.results[0]["table"].to_pydict(), {"v1": list(range(10))})
+        # one long poll, and one request for the final transaction state
+        id = rsp.transaction["id"]
+        self.assertEqual(self.status_requests(), [f"/transactions/{id}?wait=5", f"/transactions/{id}"])
+        self.assertTrue(self.ctx._server_wait_supported)
+
+    def test_fallback(self):
+        self.server.long_poll = False
+        with self.assertLogs(level="INFO"):
+            rsp = api.exec(self.ctx, "db", "e", "def output = 1")
+        self.assertEqual(rsp.transaction["state"], "COMPLETED")
+        self.assertFalse(self.ctx._server_wait_supported)
+        self.assertGreater(len(self.status_requests()), 2)
+        self.assertIn(f"/transactions/{rsp.transaction['id']}?wait=5", self.status_requests())
+
+        # the fallback is remembered
+        self.server.requests.clear()
+        api.exec(self.ctx, "db", "e", "def output = 1")
+        self.assertFalse(any("wait" in path for path in self.status_requests()))
+
+
+class TestAdaptivePollingSchedule(unittest.TestCase):
+    def test_fingerprint(self):
+        f = api.AdaptivePollingSchedule.fingerprint
+        self.assertEqual(f("def output = 1"), f(" def  output =\n1 "))
+        self.assertNotEqual(f("def output = 1"), f("def output = 2"))
+
+    def test_delay_without_history(self):
+        schedule = api.AdaptivePollingSchedule(jitter=0)
+        self.assertEqual(schedule.delay("q", 0), schedule.min_interval)
+        self.assertAlmostEqual(schedule.delay("q", 10), 2)
+        self.assertEqual(schedule.delay("q", 10000), 120)
+
+    def test_delay_with_history(self):
+        schedule = api.AdaptivePollingSchedule(jitter=0)
+        for duration in [1, 1, 2, 3]:
+            schedule.record("q", duration)
+        self.assertAlmostEqual(schedule.delay("q", 0), 2)
+        self.assertAlmostEqual(schedule.delay("q", 2.5), 0.5)
+        # past the highest quantile, falls back to the overhead rate
+        self.assertAlmostEqual(schedule.delay("q", 10), 2)
+        self.assertEqual(schedule.delay("other", 0), schedule.min_interval)
+
+    def test_jitter(self):
+        schedule = api.AdaptivePollingSchedule(jitter=0.5)
+        delays = {schedule.delay("q", 10) for _ in range(20)}
+        self.assertTrue(all(1 <= d <= 3 for d in delays))
+        self.assertGreater(len(delays), 1)
+
+    def test_exec(self):
+        ctx = api.Context()
+        ctx.polling_schedule = api.AdaptivePollingSchedule(jitter=0)
+        fingerprint = ctx.polling_schedule.fingerprint("def output = 1")
+        for _ in range(3):
+            ctx.polling_schedule.record(fingerprint, 4)
+        states = ["RUNNING", "COMPLETED"]
+        txn = api.TransactionAsyncResponse({"id": "t1", "state": "CREATED"})
+        with patch.object(api, "exec_async", return_value=txn), \
+                patch.object(api, "get_transaction", side_effect=lambda *args: {"id": "t1", "state": states.pop(0)}), \
+                patch.object(api, "_get_transaction_response"), \
+                patch("time.sleep") as sleep:
+            api.exec(ctx, "db", "e", "def output = 1")
+        self.assertAlmostEqual(sleep.call_args_list[0][0][0], 4, places=1)
+        self.assertEqual(len(ctx.polling_schedule._durations[fingerprint]), 4)
+
+
+class TestDeadline(unittest.TestCase):
+    @patch('railib.rest.urlopen')
+    def test_urlopen_timeout(self, mock_urlopen):
+        req = Request('https://example.com')
+        _urlopen_with_retry(req, timeout=5, deadline=time.time() + 1)
+        self.assertLessEqual(mock_urlopen.call_args[1]["timeout"], 1)
+
+        with self.assertRaises(TimeoutError):
+            _urlopen_with_retry(req, 2, deadline=time.time() - 1)
+        self.assertEqual(mock_urlopen.call_count, 1)
+
+    @patch('railib.rest.urlopen')
+    def test_retry_budget(self, mock_urlopen):
+        def fail(req, timeout):
+            time.sleep(timeout)
+            raise URLError(socket.timeout())
+        mock_urlopen.side_effect = fail
+
+        req = Request('https://example.com')
+        with self.assertLogs():
+            with self.assertRaises(TimeoutError):
+                _urlopen_with_retry(
+                    req, timeout=0.1, deadline=time.time() + 0.25, policy=rest.RetryPolicy(10, backoff=0)
+                )
+        self.assertEqual(mock_urlopen.call_count, 3)
+
+    def test_socket_timeout(self):
+        # accepts connections, but never answers
+        server = socket.socket()
+        server.bind(("127.0.0.1", 0))
+        server.listen()
+        self.addCleanup(server.close)
+        pool = rest.ConnectionPool()
+        self.addCleanup(pool.clear)
+        req = Request(f"http://127.0.0.1:{server.getsockname()[1]}/")
+        start_time = time.time()
+        with self.assertRaises(URLError):
+            pool.urlopen(req, timeout=0.1)
+        self.assertLess(time.time() - start_time, 2)
+
+    def test_exec_cancels_on_timeout(self):
+        ctx = api.Context()
+        txn = api.TransactionAsyncResponse({"id": "t1", "state": "CREATED"})
+        with patch.object(api, "exec_async", return_value=txn) as exec_async, \
+                patch.object(api, "get_transaction", return_value={"id": "t1", "state": "RUNNING"}), \
+                patch.object(api, "cancel_transaction") as cancel:
+            start_time = time.time()
+            with self.assertRaises(TimeoutError):
+                api.exec(ctx, "db", "e", "def output = 1", timeout=0.3)
+        self.assertLess(time.time() - start_time, 2)
+        self.assertIsNotNone(exec_async.call_args[1]["deadline"])
+        cancel.assert_called_once_with(ctx, "t1", timeout=api._CANCEL_TIMEOUT)
+
+
+def _http_error(code: int, retry_after: str = None) -> HTTPError:
+    headers = {"Retry-After": retry_after} if retry_after is not None else {}
+    return HTTPError("https://example.com", code, "error", headers, io.BytesIO())
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_retryable(self):
+        policy = rest.RetryPolicy(3)
+        timeout = URLError(socket.timeout())
+        refused = URLError(ConnectionRefusedError())
+        self.assertTrue(policy.retryable("GET", _http_error(503)))
+        self.assertTrue(policy.retryable("GET", _http_error(502)))
+        self.assertFalse(policy.retryable("GET", _http_error(404)))
+        self.assertTrue(policy.retryable("GET", timeout))
+        # only retry non-idempotent requests the server didn't process
+        self.assertFalse(policy.retryable("POST", timeout))
+        self.assertFalse(policy.retryable("POST", _http_error(502)))
+        self.assertTrue(policy.retryable("POST", _http_error(429)))
+        self.assertTrue(policy.retryable("POST", refused))
+        self.assertTrue(policy.retryable("POST", timeout, idempotent=True))
+
+    def test_delay(self):
+        policy = rest.RetryPolicy(3, backoff=1, max_backoff=5)
+        for retry in range(6):
+            self.assertLessEqual(policy.delay(retry), min(5, 2 ** retry))
+        self.assertEqual(policy.delay(0, _http_error(503, "2")), 2)
+        self.assertIsNone(policy.delay(0, _http_error(503, "60")))
+        self.assertIsNone(policy.delay(0, _http_error(503, "Fri, 31 Dec 2100 23:59:59 GMT")))
+
+    def test_budget(self):
+        policy = rest.RetryPolicy(3, budget=1, budget_ratio=0.5)
+        self.assertTrue(policy._withdraw())
+        self.assertFalse(policy._withdraw())
+        policy._deposit()
+        policy._deposit()
+        self.assertTrue(policy._withdraw())
+
+    @patch('time.sleep')
+    @patch('railib.rest.urlopen')
+    def test_retry_after(self, mock_urlopen, mock_sleep):
+        mock_urlopen.side_effect = [_http_error(429, "1"), MagicMock()]
+        with self.assertLogs():
+            _urlopen_with_retry(Request('https://example.com', method="POST"), 2)
+        self.assertEqual(mock_urlopen.call_count, 2)
+        mock_sleep.assert_called_once_with(1)
+
+    @patch('railib.rest.urlopen')
+    def test_not_retried(self, mock_urlopen):
+        mock_urlopen.side_effect = _http_error(404)
+        with self.assertRaises(HTTPError):
+            _urlopen_with_retry(Request('https://example.com'), 2)
+        self.assertEqual(mock_urlopen.call_count, 1)
+
+        mock_urlopen.side_effect = URLError(socket.timeout())
+        with self.assertLogs(), self.assertRaises(URLError):
+            _urlopen_with_retry(Request('https://example.com', method="POST"), 2)
+        self.assertEqual(mock_urlopen.call_count, 2)
+
+    def test_context(self):
+        ctx = rest.Context(retries=2)
+        self.assertEqual(ctx.retry_policy.retries, 2)
+        ctx = rest.Context(retry_policy=rest.RetryPolicy(5))
+        self.assertEqual(ctx.retries, 5)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def fail(self):
+        raise URLError(ConnectionRefusedError())
+
+    def test_open(self):
+        breaker = rest.CircuitBreaker(min_requests=4, open_duration=0.05)
+        breaker.call("a", lambda: 1)
+        for _ in range(3):
+            with self.assertRaises(URLError):
+                breaker.call("a", self.fail)
+        self.assertEqual(breaker.state("a"), "open")
+        self.assertEqual(breaker.state("b"), "closed")
+        f = MagicMock()
+        with self.assertRaises(rest.CircuitOpenError):
+            breaker.call("a", f)
+        f.assert_not_called()
+        self.assertEqual(breaker.call("b", lambda: 2), 2)
+
+        time.sleep(0.05)
+        self.assertEqual(breaker.state("a"), "half-open")
+        self.assertEqual(breaker.call("a", lambda: 3), 3)
+        self.assertEqual(breaker.state("a"), "closed")
+
+    def test_half_open(self):
+        breaker = rest.CircuitBreaker(min_requests=1, open_duration=0.05)
+        with self.assertRaises(URLError):
+            breaker.call("a", self.fail)
+        time.sleep(0.05)
+
+        def probe():
+            # only one probe is let through at a time
+            with self.assertRaises(rest.CircuitOpenError):
+                breaker.call("a", lambda: None)
+            self.fail()
+        with self.assertRaises(URLError):
+            breaker.call("a", probe)
+        self.assertEqual(breaker.state("a"), "open")
+
+    def test_failures(self):
+        def not_found():
+            raise _http_error(404)
+        breaker = rest.CircuitBreaker(min_requests=2, slow_call_duration=0.01)
+        for _ in range(2):
+            with self.assertRaises(HTTPError):
+                breaker.call("a", not_found)
+        self.assertEqual(breaker.state("a"), "closed")
+        breaker.call("a", lambda: time.sleep(0.01))
+        breaker.call("a", lambda: time.sleep(0.01))
+        self.assertEqual(breaker.state("a"), "open")
+
+    @patch('railib.rest.urlopen')
+    def test_urlopen_with_retry(self, mock_urlopen):
+        mock_urlopen.side_effect = URLError(socket.timeout())
+        breaker = rest.CircuitBreaker(min_requests=2)
+        req = Request('https://example.com')
+        with self.assertLogs(), self.assertRaises(rest.CircuitOpenError):
+            _urlopen_with_retry(req, policy=rest.RetryPolicy(5, backoff=0), breaker=breaker)
+        self.assertEqual(mock_urlopen.call_count, 2)
+
+    def test_admission(self):
+        ctx = rest.Context(max_requests=1)
+        rest._admit(ctx)
+        with self.assertRaises(rest.OverloadedError):
+            rest._admit(ctx)
+        threading.Timer(0.05, ctx._admission.release).start()
+        ctx.admission_timeout = 5
+        rest._admit(ctx)
+
+    def test_admission_until_read(self):
+        urls = []
+
+        class Transport(rest.Transport):
+            def urlopen(self, req, timeout=None):
+                urls.append(req.full_url)
+                return _ReplayResponse(req.get_method(), req.full_url, 200, "OK", {}, b"body")
+
+        ctx = rest.Context(max_requests=1, transport=Transport())
+        rsp = rest.get(ctx, "https://host/path")
+        # the body of the first response hasn't been read yet
+        with self.assertRaises(rest.OverloadedError):
+            rest.get(ctx, "https://host/path")
+        self.assertEqual(rsp.read(), b"body")
+        with rest.get(ctx, "https://host/path", query={"timeout": 1}, deadline=time.time() + 5):
+            pass
+        rest.get(ctx, "https://host/path").read()
+        self.assertEqual(urls, ["https://host/path", "https://host/path?timeout=1", "https://host/path"])
+
+
+class TestHedgingPolicy(unittest.TestCase):
+    def policy(self, **kwargs) -> rest.HedgingPolicy:
+        policy = rest.HedgingPolicy(min_samples=5, **kwargs)
+        policy._latencies.extend([0.01] * 5)
+        policy._tokens = 1
+        self.addCleanup(policy.close)
+        return policy
+
+    def slow_then_fast(self):
+        responses = [MagicMock(name="slow"), MagicMock(name="fast")]
+        calls = []
+
+        def f():
+            calls.append(None)
+            if len(calls) == 1:
+                time.sleep(0.5)
+                return responses[0]
+            return responses[1]
+        return f, responses, calls
+
+    def test_delay(self):
+        policy = rest.HedgingPolicy(min_samples=5, quantile=0.5)
+        policy._latencies.extend([0.1, 0.2, 0.3, 0.4])
+        self.assertIsNone(policy.delay())
+        policy._latencies.append(0.5)
+        self.assertEqual(policy.delay(), 0.3)
+
+    def test_hedge(self):
+        f, responses, calls = self.slow_then_fast()
+        start_time = time.time()
+        self.assertIs(self.policy().call(f), responses[1])
+        self.assertLess(time.time() - start_time, 0.4)
+        self.assertEqual(len(calls), 2)
+        time.sleep(0.5)
+        responses[0].close.assert_called_once()
+        responses[1].close.assert_not_called()
+
+    def test_hedge_rate(self):
+        f, responses, calls = self.slow_then_fast()
+        policy = self.policy(max_rate=0)
+        policy._tokens = 0
+        self.assertIs(policy.call(f), responses[0])
+        self.assertEqual(len(calls), 1)
+
+    def test_calling_thread(self):
+        policy = self.policy()
+        policy._tokens = 0
+        # requests that can't be hedged are sent on the calling thread
+        self.assertIs(policy.call(threading.current_thread), threading.current_thread())
+        policy._tokens = 1
+        self.assertIsNot(policy.call(threading.current_thread), threading.current_thread())
+        # the hedge wasn't needed, so it's still available
+        self.assertEqual(policy._tokens, 1)
+
+    def test_hedge_errors(self):
+        calls = []
+
+        def f():
+            calls.append(None)
+            if len(calls) == 1:
+                time.sleep(0.05)
+                raise URLError("primary")
+            raise URLError("hedge")
+        with self.assertRaises(URLError) as e:
+            self.policy().call(f)
+        self.assertEqual(e.exception.reason, "primary")
+
+    @patch('railib.rest.urlopen')
+    def test_urlopen_with_retry(self, mock_urlopen):
+        f, responses, calls = self.slow_then_fast()
+        mock_urlopen.side_effect = lambda req, timeout=None: f()
+        policy = self.policy()
+        self.assertIs(_urlopen_with_retry(Request('https://example.com'), hedging=policy), responses[1])
+        self.assertEqual(len(calls), 2)
+        calls.clear()
+        _urlopen_with_retry(Request('https://example.com', method="POST"), hedging=policy)
+        self.assertEqual(len(calls), 1)
+
+    def test_close(self):
+        f, responses, calls = self.slow_then_fast()
+        policy = self.policy()
+        policy.call(lambda: None)
+        with rest.Context(hedging=policy) as ctx:
+            self.assertIs(ctx.hedging, policy)
+        self.assertTrue(policy._executor._shutdown)
+        # requests are no longer hedged
+        self.assertIs(policy.call(f), responses[0])
+        self.assertEqual(len(calls), 1)
+
+
+class TestMockServer(unittest.TestCase):
+    def setUp(self):
+        self.server = mock.MockServer(relations=2, rows=100)
+        self.server.start()
+        self.ctx = self.server.context()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_exec(self):
+        self.server.duration = 0.1
+        rsp = api.exec(self.ctx, "db", "e", "def output = 1")
+        self.assertEqual(rsp.transaction["state"], "COMPLETED")
+        self.assertEqual(rsp.results.keys(), ["/:output/:r0/Int64", "/:output/:r1/Int64"])
+        self.assertEqual(rsp.results["/:output/:r1/Int64"].num_rows, 100)
+        self.assertEqual(len(rsp.metadata.relations), 2)
+        self.assertEqual(rsp.problems, [])
+        self.assertEqual(api.list_transactions(self.ctx)[0]["query"], "def output = 1")
+
+    def test_cancel(self):
+        self.server.duration = 10
+        txn = api.exec_async(self.ctx, "db", "e", "def output = 1")
+        api.cancel_transaction(self.ctx, txn.transaction["id"])
+        self.assertEqual(api.get_transaction(self.ctx, txn.transaction["id"])["state"], "ABORTED")
+        with self.assertRaises(HTTPError) as e:
+            api.get_transaction(self.ctx, "missing")
+        self.assertEqual(e.exception.code, 404)
+
+    def test_exec_max_requests(self):
+        for max_requests in (1, 2):
+            with self.server.context(max_requests=max_requests) as ctx:
+                rsp = api.exec(ctx, "db", "e", "def output = 1")
+                self.assertEqual(rsp.transaction["state"], "COMPLETED")
+                self.assertEqual(len(rsp.results), 2)
+                self.assertEqual(len(api.get_transaction_results_and_problems(ctx, rsp.transaction["id"]).results), 2)
+
+    def test_aio_exec_timeout(self):
+        self.server.duration = 3
+        ctx = aio.Context(host="127.0.0.1", port=str(self.server.port), scheme="http")
+
+        async def run():
+            return await aio.exec(ctx, "db", "e", "def output = 1", timeout=0.5)
+
+        start_time = time.time()
+        with self.assertRaises(TimeoutError):
+            asyncio.run(run())
+        self.assertLess(time.time() - start_time, 2)
+        self.assertTrue(any(method == "POST" and path.endswith("/cancel") for method, path in self.server.requests))
+
+    def test_engines_and_databases(self):
+        api.create_engine(self.ctx, "e1", "S")
+        api.create_database(self.ctx, "db1")
+        api.suspend_engine(self.ctx, "e1")
+        self.assertEqual(api.get_engine(self.ctx, "e1")["state"], "SUSPENDED")
+        self.assertEqual([e["name"] for e in api.list_engines(self.ctx)], ["e1"])
+        self.assertEqual(api.get_database(self.ctx, "db1")["state"], "CREATED")
+        api.delete_engine(self.ctx, "e1")
+        api.delete_database(self.ctx, "db1")
+        self.assertEqual(api.list_engines(self.ctx), [])
+        self.assertEqual(api.list_databases(self.ctx), [])
+
+    def test_token(self):
+        ctx = self.server.context(authenticate=True)
+        token = rest._request_access_token(ctx, self.server.url)
+        self.assertFalse(token.is_expired())
+
+    def test_token_retry(self):
+        pool = rest.ConnectionPool()
+        calls = []
+
+        class Transport(rest.Transport):
+            def urlopen(self, req, timeout=None):
+                calls.append(req.full_url)
+                if len(calls) == 1:
+                    raise ConnectionResetError("connection reset by peer")
+                return pool.urlopen(req, timeout)
+
+        ctx = self.server.context(authenticate=True, retries=1, transport=Transport())
+        ctx.retry_policy.backoff = 0
+        with self.assertLogs():
+            token = rest._request_access_token(ctx, self.server.url)
+        self.assertFalse(token.is_expired())
+        self.assertEqual(len(calls), 2)
+        pool.close()
+
+    def test_latency(self):
+        self.server.latency = 0.1
+        start_time = time.time()
+        api.list_engines(self.ctx)
+        self.assertGreaterEqual(time.time() - start_time, 0.1)
+
+    def test_transport(self):
+        sent = []
+
+        class Transport(rest.UrllibTransport):
+            def urlopen(self, req, timeout=None):
+                sent.append(req.full_url)
+                return super().urlopen(req, timeout)
+        ctx = self.server.context(transport=Transport())
+        api.list_databases(ctx)
+        self.assertEqual(sent, [f"{self.server.url}/database"])
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "traffic.zip")
+        self.server = mock.MockServer(relations=2, rows=100, duration=0.3, long_poll=False)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.dir.cleanup()
+
+    def record(self, f):
+        with RecordingTransport(self.path) as transport:
+            return f(self.server.context(transport=transport))
+
+    def replay(self, f, speedup=None):
+        self.server.stop()
+        return f(self.server.context(transport=ReplayTransport(self.path, speedup)))
+
+    def test_replay(self):
+        def run(ctx):
+            api.create_engine(ctx, "e", "S")
+            return api.exec(ctx, "db", "e", "def output = 1")
+        recorded = self.record(run)
+        transport = ReplayTransport(self.path)
+        self.assertTrue(any(exchange["method"] == "PUT" for exchange in transport.exchanges))
+        rsp = self.replay(run)
+        self.assertEqual(rsp.transaction, recorded.transaction)
+        self.assertEqual(rsp.results.keys(), recorded.results.keys())
+        self.assertTrue(rsp.results["/:output/:r1/Int64"].equals(recorded.results["/:output/:r1/Int64"]))
+        self.assertEqual(len(rsp.metadata.relations), 2)
+
+    def test_timings(self):
+        def run(ctx):
+            id = api.exec_async(ctx, "db", "e", "def output = 1").transaction["id"]
+            start_time = time.time()
+            while api.get_transaction(ctx, id)["state"] != "COMPLETED":
+                time.sleep(0.01)
+            return time.time() - start_time
+        self.assertGreaterEqual(self.record(run), 0.2)
+        # the transaction completes at the recorded time, however often
+        # it's polled
+        self.assertLess(self.replay(run, speedup=4), 0.2)
+
+    def test_errors(self):
+        def run(ctx):
+            with self.assertRaises(HTTPError) as e:
+                api.get_transaction(ctx, "missing")
+            return e.exception
+        self.record(run)
+        self.assertEqual(self.replay(run).code, 404)
+        with self.assertRaises(Exception):
+            self.replay(api.list_engines)
+
+    def test_connection_errors(self):
+        errors = [OSError("connection dropped mid-body"), ConnectionResetError("reset"), URLError("down")]
+        transport = MagicMock()
+        transport.urlopen.side_effect = errors
+        with RecordingTransport(self.path, transport) as recording:
+            for _ in errors:
+                with self.assertRaises(OSError):
+                    recording.urlopen(Request("https://host/path"))
+        replay = ReplayTransport(self.path, speedup=None)
+        for error in errors:
+            with self.assertRaises(OSError) as e:
+                replay.urlopen(Request("https://host/path"))
+            self.assertIs(type(e.exception), type(error))
+            self.assertEqual(str(e.exception), str(error))
+
+    def test_secrets(self):
+        def run(ctx):
+            return rest._request_access_token(ctx, self.server.url)
+        ctx = self.server.context(authenticate=True)
+        with RecordingTransport(self.path) as transport:
+            ctx.transport = transport
+            run(ctx)
+        with zipfile.ZipFile(self.path) as archive:
+            content = b"".join(archive.read(name) for name in archive.namelist())
+        self.assertNotIn(b"mock-client-secret", content)
+        ctx.transport = ReplayTransport(self.path)
+        self.assertEqual(run(ctx).access_token, "redacted")
+
+
+@patch("railib.rest._write_token_cache")
+@patch("railib.rest._read_token_cache", return_value=None)
+class TestTokenManager(unittest.TestCase):
+    def setUp(self):
+        self.requests = 0
+        self.ctx = api.Context(credentials=ClientCredentials(f"client-{time.time()}", "secret"))
+        self.dir = tempfile.TemporaryDirectory()
+        cache_file = patch("railib.rest._cache_file", return_value=os.path.join(self.dir.name, "tokens.json"))
+        cache_file.start()
+        self.addCleanup(cache_file.stop)
+        self.addCleanup(self.dir.cleanup)
+
+    def request_access_token(self, ctx, url):
+        self.requests += 1
+        time.sleep(0.1)
+        return AccessToken(f"token-{self.requests}", "", 3600)
+
+    def test_single_flight(self, *args):
+        tokens = []
+        with patch("railib.rest._request_access_token", self.request_access_token):
+            threads = [
+                threading.Thread(target=lambda: tokens.append(rest._get_access_token(self.ctx, "https://host")))
+                for _ in range(8)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # other contexts with the same credentials share the token
+            ctx = api.Context(credentials=ClientCredentials(self.ctx.credentials.client_id, "secret"))
+            self.assertEqual(rest._get_access_token(ctx, "https://host"), "token-1")
+        self.assertEqual(tokens, ["token-1"] * 8)
+        self.assertEqual(self.requests, 1)
+
+    def test_background_refresh(self, read_token_cache, write_token_cache):
+        # within the refresh window, but not expired yet
+        self.ctx.credentials.access_token = AccessToken("token-0", "", 3600, time.time() - 3300)
+        with patch("railib.rest._request_access_token", self.request_access_token):
+            start_time = time.time()
+            self.assertEqual(rest._get_access_token(self.ctx, "https://host"), "token-0")
+            self.assertEqual(rest._get_access_token(self.ctx, "https://host"), "token-0")
+            self.assertLess(time.time() - start_time, 0.1)
+            time.sleep(0.3)
+            self.assertEqual(rest._get_access_token(self.ctx, "https://host"), "token-1")
+        self.assertEqual(self.requests, 1)
+        write_token_cache.assert_called_once()
+
+    def test_expired(self, *args):
+        self.ctx.credentials.access_token = AccessToken("token-0", "", 3600, time.time() - 3550)
+        with patch("railib.rest._request_access_token", self.request_access_token):
+            self.assertEqual(rest._get_access_token(self.ctx, "https://host"), "token-1")
+        ctx = api.Context(credentials=ClientCredentials(f"client-{time.time()}", "secret"))
+        self.assertIsNone(rest._get_access_token(ctx, "https://host", block=False))
+
+
+class TestTokenCache(unittest.TestCase):
+    def setUp(self):
+        self.requests = 0
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self.dir.name, "tokens.json")
+        cache_file = patch("railib.rest._cache_file", return_value=self.cache_file)
+        cache_file.start()
+        self.addCleanup(cache_file.stop)
+        self.addCleanup(self.dir.cleanup)
+
+    def request_access_token(self, ctx, url):
+        self.requests += 1
+        time.sleep(0.1)
+        return AccessToken(f"token-{self.requests}", "", 3600)
+
+    def test_write(self):
+        creds = ClientCredentials("client", "secret")
+        creds.access_token = AccessToken("token", "", 3600)
+        rest._write_token_cache(creds)
+        creds = ClientCredentials("other", "secret")
+        creds.access_token = AccessToken("other-token", "", 3600)
+        rest._write_token_cache(creds)
+        self.assertEqual(os.listdir(self.dir.name), ["tokens.json"])
+        self.assertEqual(rest._read_token_cache(ClientCredentials("client", "secret")).access_token, "token")
+        # unchanged caches aren't parsed again
+        with patch("json.loads", side_effect=AssertionError):
+            self.assertEqual(rest._read_token_cache(creds).access_token, "other-token")
+
+    def test_processes(self):
+        # managers of separate processes share one token
+        client_id = f"client-{time.time()}"
+        tokens = []
+
+        def run():
+            ctx = api.Context(credentials=ClientCredentials(client_id, "secret"))
+            tokens.append(rest._TokenManager().get(ctx, "https://host").access_token)
+        with patch("railib.rest._request_access_token", self.request_access_token):
+            threads = [threading.Thread(target=run) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(tokens, ["token-1"] * 4)
+        self.assertEqual(self.requests, 1)
+
+
+class TestJsonCodec(unittest.TestCase):
+    def codecs(self):
+        result = [rest.JsonCodec()]
+        for codec in (rest.OrjsonCodec, rest.MsgspecCodec):
+            try:
+                result.append(codec())
+            except ImportError:
+                pass
+        return result
+
+    def test_codecs(self):
+        value = {"transaction": {"id": "1", "state": "COMPLETED"}, "problems": [{"message": "é"}]}
+        for codec in self.codecs():
+            with self.subTest(codec=type(codec).__name__):
+                data = codec.encode(value)
+                self.assertIsInstance(data, bytes)
+                self.assertEqual(json.loads(data), value)
+                self.assertEqual(codec.decode(data), value)
+                self.assertEqual(codec.decode(memoryview(data)), value)
+                self.assertEqual(codec.decode(data, "transaction"), value["transaction"])
+                self.assertEqual(codec.decode(data, "problems"), value["problems"])
+                with self.assertRaises(KeyError):
+                    codec.decode(data, "missing")
+                self.assertEqual(codec.encode([api.Permission.LIST_COMPUTES]), b'["list:compute"]')
+
+    def test_context(self):
+        decoded = []
+
+        class Codec(rest.JsonCodec):
+            def decode(self, data, key=None):
+                decoded.append(key)
+                return super().decode(data, key)
+        self.assertIsInstance(api.Context().json_codec, rest.JsonCodec)
+        with mock.MockServer() as server:
+            ctx = server.context(json_codec=Codec())
+            rsp = api.exec_async(ctx, "db", "e", "def output = 1")
+            self.assertEqual(api.get_transaction(ctx, rsp.transaction["id"])["state"], "COMPLETED")
+        self.assertEqual(decoded, [None, "transaction"])
+
+
+class TestImports(unittest.TestCase):
+    # the time allowed to import railib.api, importing pyarrow and protobuf
+    # alone takes longer
+    IMPORT_TIME_LIMIT = 0.2
+
+    def run_python(self, code: str) -> str:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(api.__file__)))
+        out = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, check=True, text=True)
+        return out.stdout.strip()
+
+    # heavy dependencies are only imported when parsing results
+    def test_lazy_imports(self):
+        code = (
+            "import sys, railib.api, railib.aio, railib.rest\n"
+            "modules = ('numpy', 'pandas', 'pyarrow', 'google.protobuf', 'requests_toolbelt')\n"
+            "print(sorted(m for m in modules if m in sys.modules))"
+        )
+        self.assertEqual(self.run_python(code), "[]")
+
+    def test_import_time(self):
+        code = "import time\nt = time.perf_counter()\nimport railib.api\nprint(time.perf_counter() - t)"
+        # the best of a few runs, the first may compile the modules
+        elapsed = min(float(self.run_python(code)) for _ in range(3))
+        self.assertLess(elapsed, self.IMPORT_TIME_LIMIT)
+
 
 if __name__ == '__main__':
     unittest.main()